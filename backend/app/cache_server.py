@@ -1,20 +1,55 @@
 from fastapi import FastAPI, Request, Response, Header
-from itertools import cycle 
+from fastapi.responses import StreamingResponse
+from contextlib import asynccontextmanager
+import asyncio
 import httpx
 import time
-from typing import Dict, Any, List, Optional
+import os
+import hashlib
+import math
+import random
+from typing import Dict, Any, List, Optional, Set, Union
 import json
-from collections import Counter
+from collections import deque, defaultdict
 import re
 
-app = FastAPI()
-
-#In-memory cache
-#Structure: {request_key: {"data": response_data, "timestamp": timestamp}}
+#In-memory cache of raw upstream responses, served as is on hits without re-encoding
+#Structure: {request_key: {"body": bytes, "headers": {name: value}, "etag": etag, "timestamp": timestamp, "tags": [surrogate_key, ...]}}
 cache = {}
 
-#Request counter for tracking load balancing
-request_counter = Counter()
+#Response header the backend uses to declare whether a route's response is the same for every caller
+#"public" responses are cached once for everyone, "user" responses once per Authorization header
+VARY_POLICY_HEADER = "X-Cache-Vary"
+
+#Policy used until a path has declared one, per-user so nothing leaks between users
+DEFAULT_VARY_POLICY = "user"
+
+#Vary policy last declared by the backend for each DB_READ_PATHS pattern, so all ids of a route share it
+#Structure: {path pattern: "public" | "user"}
+vary_policies: Dict[str, str] = {}
+
+#Hits and misses per vary policy, to see what sharing public entries does to the hit rate
+vary_counters = {
+    "public": {"hits": 0, "misses": 0},
+    "user": {"hits": 0, "misses": 0},
+}
+
+#Upstream response headers kept in cache entries and replayed on hits
+CACHED_RESPONSE_HEADERS = ("content-type", "cache-control", "vary", "content-language", "last-modified")
+
+#Hop-by-hop headers that are never copied from a backend response
+HOP_BY_HOP_HEADERS = {"connection", "keep-alive", "transfer-encoding", "te", "trailer", "upgrade", "proxy-connection"}
+
+#Headers dropped from buffered responses, httpx already decoded the body so content-encoding no longer applies
+EXCLUDED_RESPONSE_HEADERS = HOP_BY_HOP_HEADERS | {"content-length", "content-encoding"}
+
+#Surrogate key index, so a write only touches the entries it affects
+#Structure: {surrogate_key: {request_key, ...}}
+tag_index: Dict[str, Set[str]] = defaultdict(set)
+
+#Response header the backend uses to declare surrogate keys
+#On reads it lists the keys the response depends on, on writes the keys the write changed
+SURROGATE_KEY_HEADER = "Surrogate-Key"
 
 #Cache expiration time in seconds (1 minute)
 CACHE_EXPIRATION = 60
@@ -22,6 +57,14 @@ CACHE_EXPIRATION = 60
 #Maximum cache size (items)
 MAX_CACHE_SIZE = 1000
 
+#Largest response body in bytes that is buffered and stored, bigger ones are streamed through
+#Checked against Content-Length before reading the body, responses without one are streamed too
+MAX_CACHEABLE_BODY_BYTES = int(os.environ.get("MAX_CACHEABLE_BODY_BYTES", 1024 * 1024))
+
+#Cache keys whose last response was over MAX_CACHEABLE_BODY_BYTES or had no length, streamed until the expiry time
+#Structure: {request_key: expiry_timestamp}
+oversized_keys: Dict[str, float] = {}
+
 #Database read endpoints to cache
 DB_READ_PATHS = [
     r"^/users$",                  #Get all users
@@ -34,89 +77,450 @@ DB_READ_PATHS = [
     r"^/likes/\d+$",              #Get likes for a tweet
 ]
 
-#Mapping of write endpoints to related cached endpoints that should be invalidated
+#Grace periods in seconds past CACHE_EXPIRATION, per DB_READ_PATHS pattern
+#stale_while_revalidate: serve the stale entry immediately while a single background task refreshes it
+#stale_if_error: keep serving the stale entry this long when the backends are failing
+CACHE_STALE_POLICY = {
+    r"^/users$":          {"stale_while_revalidate": 30, "stale_if_error": 600},
+    r"^/users/\d+$":      {"stale_while_revalidate": 30, "stale_if_error": 600},
+    r"^/users/search":    {"stale_while_revalidate": 10, "stale_if_error": 300},
+    r"^/tweets$":         {"stale_while_revalidate": 30, "stale_if_error": 600},
+    r"^/tweets/\d+$":     {"stale_while_revalidate": 30, "stale_if_error": 600},
+    r"^/tweets/search":   {"stale_while_revalidate": 10, "stale_if_error": 300},
+    r"^/likes/\d+$":      {"stale_while_revalidate": 5, "stale_if_error": 120},
+}
+
+#Used for cached paths without an entry in CACHE_STALE_POLICY
+DEFAULT_STALE_POLICY = {"stale_while_revalidate": 0, "stale_if_error": 0}
+
+#Surrogate keys for cached paths, used when the backend response has no Surrogate-Key header
+#Named groups are substituted into the key templates
+CACHE_DEFAULT_TAGS = {
+    r"^/users$": ["users"],
+    r"^/users/(?P<id>\d+)$": ["user:{id}"],
+    r"^/users/search": ["users"],
+    r"^/tweets$": ["timeline"],
+    r"^/tweets/(?P<id>\d+)$": ["tweet:{id}"],
+    r"^/tweets/search": ["timeline"],
+    r"^/likes/(?P<id>\d+)$": ["likes:{id}"],
+}
+
+#Mapping of write endpoints to the surrogate keys they invalidate
+#Purged before forwarding, the keys in the backend's Surrogate-Key response header are purged after
 CACHE_INVALIDATION_MAP = {
-    r"^/tweets$": [r"^/tweets$", r"^/users/\d+/tweets$"],  
-    r"^/tweets/\d+$": [r"^/tweets$", r"^/tweets/\d+$", r"^/users/\d+/tweets$"],
-    r"^/likes$": [r"^/likes/\d+$", r"^/tweets/\d+$"],
+    r"^/users$": ["users"],
+    r"^/users/(?P<id>\d+)$": ["users", "user:{id}"],
+    r"^/tweets$": ["timeline"],
+    r"^/tweets/(?P<id>\d+)$": ["timeline", "tweet:{id}"],
+    r"^/likes/(?P<id>\d+)$": ["likes:{id}"],
 }
 
+#How long a coalesced request waits for the shared in-flight fetch before fetching on its own
+COALESCE_WAIT_TIMEOUT = float(os.environ.get("COALESCE_WAIT_TIMEOUT", 15.0))
+
+#In-flight upstream fetches for cache misses, so concurrent misses on one key share a single fetch
+#Structure: {cache_key: asyncio.Task}
+inflight_fetches: Dict[str, asyncio.Task] = {}
+
+#Closes of streamed upstream responses nobody took, referenced until they finish
+closing_upstreams: Set[asyncio.Task] = set()
+
+#Proxy cache statistics
+cache_counters = {
+    "hits": 0,
+    "misses": 0,
+    "stale_hits": 0,             #Served within the stale-while-revalidate window
+    "stale_if_error_hits": 0,    #Served stale because the backends failed
+    "revalidations": 0,          #Background refreshes started
+}
+
+#Request coalescing statistics
+coalescing_stats = {
+    "leader_fetches": 0,      #Misses that started an upstream fetch
+    "coalesced_requests": 0,  #Misses that joined an already running fetch
+    "leader_failures": 0,     #Joined fetches that failed, followers then retried
+    "follower_timeouts": 0,   #Followers that gave up waiting and fetched on their own
+}
+
+#Upstream connection pool defaults, can be overridden per backend in servers.json
+UPSTREAM_MAX_CONNECTIONS = int(os.environ.get("UPSTREAM_MAX_CONNECTIONS", 100))
+UPSTREAM_MAX_KEEPALIVE = int(os.environ.get("UPSTREAM_MAX_KEEPALIVE", 20))
+UPSTREAM_KEEPALIVE_EXPIRY = float(os.environ.get("UPSTREAM_KEEPALIVE_EXPIRY", 30.0))
+UPSTREAM_CONNECT_TIMEOUT = float(os.environ.get("UPSTREAM_CONNECT_TIMEOUT", 2.0))
+UPSTREAM_READ_TIMEOUT = float(os.environ.get("UPSTREAM_READ_TIMEOUT", 10.0))
+UPSTREAM_POOL_TIMEOUT = float(os.environ.get("UPSTREAM_POOL_TIMEOUT", 5.0))
+
+#Load balancing strategy: round_robin, weighted_round_robin, least_outstanding or p2c_ewma
+LB_STRATEGY = os.environ.get("LB_STRATEGY", "p2c_ewma")
+
+#Smoothing factor for the EWMA latency (higher reacts faster to changes)
+LB_EWMA_ALPHA = 0.3
+
+#Number of recent requests per backend used for percentiles and error rate
+LB_METRICS_WINDOW = 256
+
+#Passive outlier ejection: consecutive timeouts/5xx before a backend is taken out of rotation
+LB_EJECT_AFTER_FAILURES = int(os.environ.get("LB_EJECT_AFTER_FAILURES", 5))
+#Base ejection time in seconds, doubled on every repeated ejection up to the max
+LB_EJECT_BASE_SECONDS = float(os.environ.get("LB_EJECT_BASE_SECONDS", 10.0))
+LB_EJECT_MAX_SECONDS = float(os.environ.get("LB_EJECT_MAX_SECONDS", 300.0))
+#Time in seconds over which a returning backend ramps back up to its full weight
+LB_SLOW_START_SECONDS = float(os.environ.get("LB_SLOW_START_SECONDS", 30.0))
+
 with open("servers.json") as f:
     servers = json.load(f)
 
+class Backend:
+    """A single upstream server with its own long-lived, keep-alive HTTP client"""
+    def __init__(self, server: Dict[str, Any]):
+        self.url = server["url"]
+        self.max_connections = int(server.get("max_connections", UPSTREAM_MAX_CONNECTIONS))
+        self.max_keepalive = int(server.get("max_keepalive_connections", UPSTREAM_MAX_KEEPALIVE))
+        self.keepalive_expiry = float(server.get("keepalive_expiry", UPSTREAM_KEEPALIVE_EXPIRY))
+        self.timeout = httpx.Timeout(
+            float(server.get("read_timeout", UPSTREAM_READ_TIMEOUT)),
+            connect=float(server.get("connect_timeout", UPSTREAM_CONNECT_TIMEOUT)),
+            pool=float(server.get("pool_timeout", UPSTREAM_POOL_TIMEOUT)),
+        )
+        self.weight = float(server.get("weight", 1))
+        #Strategies divide by the weight, a backend that shouldn't get traffic belongs out of servers.json
+        if not math.isfinite(self.weight) or self.weight <= 0:
+            raise ValueError(f"Backend {self.url} in servers.json needs a weight greater than 0, got {server.get('weight')!r}")
+        self.client: Optional[httpx.AsyncClient] = None
+        self.requests_sent = 0
+
+        #Live metrics used by the balancing strategies
+        self.in_flight = 0
+        self.ewma_latency = 0.0
+        self.latencies = deque(maxlen=LB_METRICS_WINDOW)
+        self.outcomes = deque(maxlen=LB_METRICS_WINDOW)  #True for success, False for error
+
+        #Outlier ejection state
+        self.consecutive_failures = 0
+        self.ejection_count = 0
+        self.ejected_until = 0.0
+        self.returned_at = 0.0
+
+        #Running weight for smooth weighted round robin
+        self.current_weight = 0.0
+
+    def open(self):
+        """Create the pooled client, called once at startup"""
+        if self.client is None:
+            limits = httpx.Limits(
+                max_connections=self.max_connections,
+                max_keepalive_connections=self.max_keepalive,
+                keepalive_expiry=self.keepalive_expiry,
+            )
+            self.client = httpx.AsyncClient(base_url=self.url, limits=limits, timeout=self.timeout)
+
+    async def close(self):
+        """Close the pooled client and all of its connections, called once at shutdown"""
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    def is_ejected(self, now: float) -> bool:
+        return now < self.ejected_until
+
+    def effective_weight(self, now: float) -> float:
+        """Configured weight, scaled down while the backend ramps up after an ejection"""
+        if self.returned_at and LB_SLOW_START_SECONDS > 0:
+            ramp = (now - self.returned_at) / LB_SLOW_START_SECONDS
+            if ramp < 1:
+                return self.weight * max(ramp, 0.1)
+        return self.weight
+
+    def start_request(self):
+        self.in_flight += 1
+        self.requests_sent += 1
+
+    def finish_request(self, latency: float, ok: bool):
+        """Record the outcome of a forwarded request and eject the backend if it keeps failing"""
+        self.in_flight -= 1
+        self.latencies.append(latency)
+        self.outcomes.append(ok)
+        if self.ewma_latency == 0.0:
+            self.ewma_latency = latency
+        else:
+            self.ewma_latency = LB_EWMA_ALPHA * latency + (1 - LB_EWMA_ALPHA) * self.ewma_latency
+
+        now = time.time()
+        if ok:
+            self.consecutive_failures = 0
+            #Once a returning backend has served a full slow start window it counts as recovered
+            if self.returned_at and now - self.returned_at >= LB_SLOW_START_SECONDS:
+                self.returned_at = 0.0
+                self.ejection_count = 0
+            return
+
+        self.consecutive_failures += 1
+        if self.consecutive_failures >= LB_EJECT_AFTER_FAILURES and not self.is_ejected(now):
+            self.ejection_count += 1
+            duration = min(LB_EJECT_BASE_SECONDS * 2 ** (self.ejection_count - 1), LB_EJECT_MAX_SECONDS)
+            self.ejected_until = now + duration
+            self.returned_at = self.ejected_until
+            self.consecutive_failures = 0
+            print(f"Ejected backend {self.url} for {duration:.0f}s after repeated failures")
+
+    def metrics(self) -> Dict[str, Any]:
+        """Report live load and health metrics for this backend"""
+        now = time.time()
+        latencies = sorted(self.latencies)
+        errors = self.outcomes.count(False)
+
+        def percentile(p):
+            if not latencies:
+                return 0
+            return round(latencies[min(int(len(latencies) * p), len(latencies) - 1)] * 1000, 2)
+
+        return {
+            "url": self.url,
+            "weight": self.weight,
+            "effective_weight": round(self.effective_weight(now), 2),
+            "requests_sent": self.requests_sent,
+            "in_flight": self.in_flight,
+            "ewma_latency_ms": round(self.ewma_latency * 1000, 2),
+            "p50_latency_ms": percentile(0.50),
+            "p99_latency_ms": percentile(0.99),
+            "error_rate": round(errors / len(self.outcomes), 4) if self.outcomes else 0,
+            "ejected": self.is_ejected(now),
+            "ejected_for_seconds": round(max(self.ejected_until - now, 0), 1),
+            "ejection_count": self.ejection_count,
+        }
+
+    def pool_stats(self) -> Dict[str, Any]:
+        """Report connection pool usage for this backend"""
+        stats = {
+            "url": self.url,
+            "requests_sent": self.requests_sent,
+            "max_connections": self.max_connections,
+            "max_keepalive_connections": self.max_keepalive,
+            "keepalive_expiry": self.keepalive_expiry,
+            "open_connections": 0,
+            "idle_connections": 0,
+            "active_connections": 0,
+        }
+        if self.client is None:
+            stats["status"] = "closed"
+            return stats
+
+        stats["status"] = "open"
+        #httpx does not expose pool stats publicly, so read them from the httpcore pool
+        pool = getattr(self.client._transport, "_pool", None)
+        connections = list(getattr(pool, "connections", []))
+        stats["open_connections"] = len(connections)
+        stats["idle_connections"] = sum(1 for conn in connections if conn.is_idle())
+        stats["active_connections"] = stats["open_connections"] - stats["idle_connections"]
+        return stats
+
 class LoadBalancer:
-    def __init__(self, servers):
+    def __init__(self, servers, strategy: str = LB_STRATEGY):
         self.servers = servers
-        self.pool = cycle(server["url"] for server in servers)
+        self.backends = [Backend(server) for server in servers]
+        self.strategies = {
+            "round_robin": self.round_robin,
+            "weighted_round_robin": self.weighted_round_robin,
+            "least_outstanding": self.least_outstanding,
+            "p2c_ewma": self.p2c_ewma,
+        }
+        if strategy not in self.strategies:
+            raise ValueError(f"Unknown load balancing strategy: {strategy}")
+        self.strategy = strategy
+        self.rr_index = 0
+
+    def available_backends(self) -> List[Backend]:
+        """Backends that are not ejected, or all of them if every backend is ejected"""
+        now = time.time()
+        available = [backend for backend in self.backends if not backend.is_ejected(now)]
+        if available:
+            return available
+        #Panic mode: better to try a possibly broken backend than to fail every request
+        #A copy, so callers can reorder it without touching the round robin order
+        return list(self.backends)
+
+    def choose(self) -> Backend:
+        """Pick a backend using the configured strategy"""
+        return self.strategies[self.strategy]()
+
+    def round_robin(self) -> Backend:
+        backends = self.available_backends()
+        self.rr_index = (self.rr_index + 1) % len(backends)
+        return backends[self.rr_index]
+
+    def weighted_round_robin(self) -> Backend:
+        """Smooth weighted round robin (same algorithm as nginx)"""
+        now = time.time()
+        backends = self.available_backends()
+        total = 0.0
+        best = None
+        for backend in backends:
+            weight = backend.effective_weight(now)
+            backend.current_weight += weight
+            total += weight
+            if best is None or backend.current_weight > best.current_weight:
+                best = backend
+        best.current_weight -= total
+        return best
+
+    def least_outstanding(self) -> Backend:
+        """Backend with the fewest in-flight requests relative to its weight, ties broken randomly"""
+        now = time.time()
+        backends = list(self.available_backends())
+        random.shuffle(backends)
+        return min(backends, key=lambda b: b.in_flight / b.effective_weight(now))
+
+    def p2c_ewma(self) -> Backend:
+        """Power of two choices: sample two backends and take the one with the lower expected cost"""
+        now = time.time()
+        backends = self.available_backends()
+        if len(backends) == 1:
+            return backends[0]
+        first, second = random.sample(backends, 2)
+
+        def cost(backend):
+            #Unmeasured backends get a cost of zero so they receive traffic and get measured
+            return backend.ewma_latency * (backend.in_flight + 1) / backend.effective_weight(now)
+
+        return first if cost(first) <= cost(second) else second
+
+    def open(self):
+        for backend in self.backends:
+            backend.open()
+
+    async def close(self):
+        for backend in self.backends:
+            await backend.close()
 
-    def round_robin(self):
-        return next(self.pool)
+    def pool_stats(self) -> List[Dict[str, Any]]:
+        return [backend.pool_stats() for backend in self.backends]
+
+    def metrics(self) -> List[Dict[str, Any]]:
+        return [backend.metrics() for backend in self.backends]
 
 load_balancer = LoadBalancer(servers)
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    #One client per backend for the whole lifetime of the proxy
+    load_balancer.open()
+    yield
+    await load_balancer.close()
+
+app = FastAPI(lifespan=lifespan)
+
 def is_db_read_request(method: str, path: str) -> bool:
     """Determine if a request is a database read operation we want to cache"""
     if method != "GET":
         return False
     
     #Check if path matches any of our defined DB read patterns
-    for pattern in DB_READ_PATHS:
+    return route_pattern(path) is not None
+
+def get_stale_policy(path: str) -> Dict[str, float]:
+    """Get the stale-while-revalidate and stale-if-error grace periods for a cached path"""
+    for pattern, policy in CACHE_STALE_POLICY.items():
         if re.match(pattern, path):
-            return True
-    
-    return False
+            return policy
+    return DEFAULT_STALE_POLICY
 
 def is_write_request(method: str) -> bool:
     """Check if this is a write operation"""
     return method in ["POST", "PUT", "DELETE", "PATCH"]
 
-def get_paths_to_invalidate(method: str, path: str) -> List[str]:
-    """Get a list of cache path patterns that should be invalidated for this write request"""
-    if not is_write_request(method):
-        return []
-        
-    paths_to_invalidate = []
-    
-    #Check each pattern to see if it matches the current path
-    for pattern, invalidation_patterns in CACHE_INVALIDATION_MAP.items():
-        if re.match(pattern, path):
-            paths_to_invalidate.extend(invalidation_patterns)
-    
-    return paths_to_invalidate
+def tags_for_path(path: str, mapping: Dict[str, List[str]]) -> List[str]:
+    """Expand the surrogate key templates of every pattern in mapping that matches path"""
+    tags = []
+    for pattern, templates in mapping.items():
+        match = re.match(pattern, path)
+        if match:
+            tags.extend(template.format(**match.groupdict()) for template in templates)
+    return tags
 
-def invalidate_cache_entries(patterns: List[str]):
-    """Invalidate all cache entries matching the specified path patterns"""
-    if not patterns:
+def parse_surrogate_keys(headers) -> List[str]:
+    """Read the space separated surrogate keys from a backend response"""
+    return headers.get(SURROGATE_KEY_HEADER, "").split()
+
+def make_etag(body: bytes) -> str:
+    """Strong ETag for a response body"""
+    return f'"{hashlib.md5(body).hexdigest()}"'
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """Check an If-None-Match request header against an ETag (weak comparison)"""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    candidates = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return etag.removeprefix("W/") in candidates
+
+def store_cache_entry(cache_key: str, backend_response: httpx.Response, tags: List[str]):
+    """Add the raw upstream response to the cache and to the surrogate key index"""
+    if cache_key in cache:
+        remove_cache_entry(cache_key)
+    body = backend_response.content
+    cache[cache_key] = {
+        "body": body,
+        "headers": {name: backend_response.headers[name] for name in CACHED_RESPONSE_HEADERS if name in backend_response.headers},
+        "etag": backend_response.headers.get("etag") or make_etag(body),
+        "timestamp": time.time(),
+        "tags": tags,
+    }
+    for tag in tags:
+        tag_index[tag].add(cache_key)
+
+def remove_cache_entry(cache_key: str):
+    """Remove an entry from the cache and from the surrogate key index"""
+    entry = cache.pop(cache_key, None)
+    if entry is None:
         return
-        
-    keys_to_delete = []
-    
-    for cache_key in cache.keys():
-        #Extract path from cache key (format: "METHOD:path:query:auth")
-        parts = cache_key.split(":", 2)
-        if len(parts) >= 2:
-            cached_path = parts[1]
-            
-            #Check if this cached path matches any of our patterns to invalidate
-            for pattern in patterns:
-                if re.match(pattern, cached_path):
-                    keys_to_delete.append(cache_key)
-                    break
-    
-    #Delete the keys
-    for key in keys_to_delete:
-        del cache[key]
-        print(f"Invalidated cache for {key}")
-
-def generate_cache_key(request: Request, path: str) -> str:
-    """Generate a unique cache key based on the request method, path, and query parameters."""
-    query_string = request.url.query.decode() if request.url.query else ""
-    auth_header = request.headers.get("Authorization", "")
-    #Only use the token part, not the entire header
-    if auth_header.startswith("Bearer "):
-        auth_token = auth_header.split(" ")[1][:10]  #Just use first 10 chars as identifier
+    for tag in entry["tags"]:
+        keys = tag_index.get(tag)
+        if keys is not None:
+            keys.discard(cache_key)
+            if not keys:
+                del tag_index[tag]
+
+def invalidate_tags(tags: List[str]):
+    """Invalidate all cache entries indexed under any of the surrogate keys, cost scales with the number of matches"""
+    for tag in tags:
+        for key in list(tag_index.get(tag, ())):
+            remove_cache_entry(key)
+            print(f"Invalidated cache for {key} (tag {tag})")
+
+def route_pattern(path: str) -> Optional[str]:
+    """The DB_READ_PATHS pattern a path belongs to, None for paths that aren't cached"""
+    for pattern in DB_READ_PATHS:
+        if re.match(pattern, path):
+            return pattern
+    return None
+
+def get_vary_policy(path: str) -> str:
+    """Get the vary policy the backend declared for a path's route"""
+    return vary_policies.get(route_pattern(path), DEFAULT_VARY_POLICY)
+
+def remember_vary_policy(path: str, backend_response: httpx.Response) -> str:
+    """Record the vary policy declared in a backend response for the path's route and return it"""
+    policy = backend_response.headers.get(VARY_POLICY_HEADER, DEFAULT_VARY_POLICY)
+    if policy not in vary_counters:
+        policy = DEFAULT_VARY_POLICY
+    pattern = route_pattern(path)
+    if pattern is not None:
+        vary_policies[pattern] = policy
+    return policy
+
+def generate_cache_key(request: Request, path: str, vary_policy: str) -> str:
+    """Generate a unique cache key based on the request method, path, query parameters and, for per-user routes, the caller."""
+    query_string = request.url.query
+    if vary_policy == "public":
+        auth_token = "public"
     else:
-        auth_token = "noauth"
+        auth_header = request.headers.get("Authorization", "")
+        #Hash the whole token, JWTs from the same issuer share their first characters
+        if auth_header.startswith("Bearer "):
+            auth_token = hashlib.md5(auth_header.encode()).hexdigest()[:16]
+        else:
+            auth_token = "noauth"
         
     return f"{request.method}:{path}:{query_string}:{auth_token}"
 
@@ -127,110 +531,413 @@ def maintain_cache_size():
         sorted_keys = sorted(cache.keys(), key=lambda k: cache[k]["timestamp"])
         #Remove oldest entries to get back to 75% of max size
         to_remove = len(cache) - int(MAX_CACHE_SIZE * 0.75)
-        for _ in range(to_remove):
-            if sorted_keys:
-                del cache[sorted_keys.pop(0)]
+        for key in sorted_keys[:to_remove]:
+            remove_cache_entry(key)
+
+class UpstreamStreamingResponse(StreamingResponse):
+    """StreamingResponse that closes its upstream however it ends, its body generator never runs if the client leaves before the first chunk"""
+    def __init__(self, upstream: "StreamedUpstream", content, status_code: int, headers: Dict[str, str]):
+        super().__init__(content, status_code=status_code, headers=headers)
+        self.upstream = upstream
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            await self.upstream.close()
+
+class StreamedUpstream:
+    """A backend response whose body hasn't been read yet, passed through to one client chunk by chunk"""
+    def __init__(self, backend: Backend, response: httpx.Response, request_start: float):
+        self.backend = backend
+        self.response = response
+        self.request_start = request_start
+        #Set by the one request that passes the body through, see take()
+        self.taken = False
+        self.finished = False
+
+    def take(self) -> bool:
+        """Claim the body for one client, False if another request has it or it was closed"""
+        if self.taken or self.finished:
+            return False
+        self.taken = True
+        return True
+
+    async def close(self):
+        """Close the upstream response and record its outcome in the backend's metrics, once"""
+        if not self.finished:
+            self.finished = True
+            await self.response.aclose()
+            self.backend.finish_request(time.monotonic() - self.request_start, self.response.status_code < 500)
+
+    def to_response(self, cache_status: str) -> StreamingResponse:
+        async def body():
+            #Raw bytes, so the backend's content-encoding and content-length stay valid
+            try:
+                async for chunk in self.response.aiter_raw():
+                    yield chunk
+            finally:
+                await self.close()
+
+        response_headers = {
+            header_name: header_value
+            for header_name, header_value in self.response.headers.items()
+            if header_name.lower() not in HOP_BY_HOP_HEADERS
+        }
+        response_headers["X-Proxy-Cache-Status"] = cache_status
+        return UpstreamStreamingResponse(self, body(), self.response.status_code, response_headers)
+
+def has_cacheable_length(backend_response: httpx.Response) -> bool:
+    """Whether a response declares a Content-Length of at most MAX_CACHEABLE_BODY_BYTES"""
+    content_length = backend_response.headers.get("content-length", "")
+    return content_length.isdigit() and int(content_length) <= MAX_CACHEABLE_BODY_BYTES
+
+async def forward_request(backend: Backend, method: str, path: str, headers: Dict[str, str], body: bytes, params: Dict[str, str]) -> Union[httpx.Response, StreamedUpstream]:
+    """
+    Send a request to a backend over its pooled client and record the outcome in its metrics.
+    The response is buffered only if its Content-Length is within MAX_CACHEABLE_BODY_BYTES,
+    a bigger or unknown length comes back unread as a StreamedUpstream.
+    """
+    print(f"Forwarding request to: {backend.url}{path} for {method} {path}")
+    print(f"Current in-flight distribution: {dict((b.url, b.in_flight) for b in load_balancer.backends)}")
+
+    backend.start_request()
+    request_start = time.monotonic()
+    upstream_request = backend.client.build_request(method, path, headers=headers, content=body, params=params)
+    try:
+        backend_response = await backend.client.send(upstream_request, stream=True)
+    except Exception:
+        #Timeouts and connection errors count against the backend's health
+        backend.finish_request(time.monotonic() - request_start, False)
+        raise
+
+    if not has_cacheable_length(backend_response):
+        return StreamedUpstream(backend, backend_response, request_start)
+    try:
+        await backend_response.aread()
+    except Exception:
+        await backend_response.aclose()
+        backend.finish_request(time.monotonic() - request_start, False)
+        raise
+    backend.finish_request(time.monotonic() - request_start, backend_response.status_code < 500)
+    return backend_response
+
+def forwarded_headers(request: Request) -> Dict[str, str]:
+    """Request headers for the backend, with the client appended to X-Forwarded-For like nginx's $proxy_add_x_forwarded_for"""
+    headers = dict(request.headers.items())
+    if request.client is not None:
+        #The backends trust this container's forwarding headers, the client's own entries are only read left of ours
+        forwarded_for = headers.get("x-forwarded-for")
+        headers["x-forwarded-for"] = f"{forwarded_for}, {request.client.host}" if forwarded_for else request.client.host
+    return headers
+
+async def stream_request(request: Request, path: str, cache_status: str) -> Response:
+    """
+    Forward a non-cacheable request with the request and response bodies streamed end to end.
+    Nothing is buffered, so memory stays flat and the client gets the first byte as soon as the backend sends it.
+    """
+    backend = load_balancer.choose()
+    print(f"Streaming request to: {backend.url}{path} for {request.method} {path}")
+
+    #Only attach a body stream when the client sent one, so bodiless requests don't go out chunked
+    has_body = "content-length" in request.headers or "transfer-encoding" in request.headers
+    upstream_request = backend.client.build_request(
+        request.method,
+        path,
+        headers=forwarded_headers(request),
+        content=request.stream() if has_body else None,
+        params=dict(request.query_params),
+    )
+    backend.start_request()
+    request_start = time.monotonic()
+    try:
+        backend_response = await backend.client.send(upstream_request, stream=True)
+    except Exception:
+        #Timeouts and connection errors count against the backend's health
+        backend.finish_request(time.monotonic() - request_start, False)
+        raise
+
+    #Purge whatever the backend says this write changed
+    if is_write_request(request.method) and backend_response.status_code < 400:
+        invalidate_tags(parse_surrogate_keys(backend_response.headers))
+
+    return StreamedUpstream(backend, backend_response, request_start).to_response(cache_status)
+
+def _finish_fetch(cache_key: str, task: asyncio.Task):
+    """Drop a finished fetch from the in-flight table and mark its exception as retrieved"""
+    if inflight_fetches.get(cache_key) is task:
+        del inflight_fetches[cache_key]
+    if not task.cancelled() and task.exception() is not None:
+        print(f"Upstream fetch for {cache_key} failed: {str(task.exception())}")
+
+def _close_if_untaken(task: asyncio.Task):
+    """Close a finished fetch's streamed upstream response if no request took it, its connection is held until then"""
+    if task.cancelled() or task.exception() is not None:
+        return
+    upstream = task.result()
+    if isinstance(upstream, StreamedUpstream) and upstream.take():
+        closing = asyncio.ensure_future(upstream.close())
+        closing_upstreams.add(closing)
+        closing.add_done_callback(closing_upstreams.discard)
+
+def _start_fetch(cache_key: str, fetch) -> asyncio.Task:
+    """Start fetch() as a task registered in the in-flight table"""
+    task = asyncio.create_task(fetch())
+    inflight_fetches[cache_key] = task
+    task.add_done_callback(lambda t: _finish_fetch(cache_key, t))
+    return task
+
+def start_revalidation(cache_key: str, fetch):
+    """Refresh a stale entry in the background, unless a fetch for it is already running"""
+    if cache_key in inflight_fetches:
+        return
+    cache_counters["revalidations"] += 1
+    _start_fetch(cache_key, fetch)
+
+async def fetch_single_flight(cache_key: str, fetch, retry_on_failure: bool = True):
+    """
+    Run fetch() for a cache miss, sharing one in-flight upstream call between concurrent misses on the same key.
+    Returns a tuple: (backend_response, coalesced)
+    """
+    task = inflight_fetches.get(cache_key)
+    if task is None:
+        coalescing_stats["leader_fetches"] += 1
+        #The fetch runs as its own task so a leader whose client disconnects does not cancel it for the followers
+        task = _start_fetch(cache_key, fetch)
+        try:
+            return await asyncio.shield(task), False
+        except asyncio.CancelledError:
+            #A streamed result was the leader's to pass through, close it unless a follower takes it first
+            task.add_done_callback(_close_if_untaken)
+            raise
+
+    coalescing_stats["coalesced_requests"] += 1
+    try:
+        return await asyncio.wait_for(asyncio.shield(task), COALESCE_WAIT_TIMEOUT), True
+    except asyncio.TimeoutError:
+        #The shared fetch is stuck, don't pile onto it
+        coalescing_stats["follower_timeouts"] += 1
+        print(f"Coalesced request for {cache_key} timed out waiting, fetching on its own")
+        return await fetch(), False
+    except Exception as e:
+        coalescing_stats["leader_failures"] += 1
+        print(f"Shared fetch for {cache_key} failed: {str(e)}")
+        if not retry_on_failure:
+            raise
+        #The first follower to get here starts a new shared fetch, the others join it
+        return await fetch_single_flight(cache_key, fetch, retry_on_failure=False)
+
+def cached_response(request: Request, entry: Dict[str, Any], cache_status: str) -> Response:
+    """Serve a cache entry straight from its stored bytes, or a 304 if the client already has it"""
+    headers = dict(entry["headers"])
+    headers["ETag"] = entry["etag"]
+    headers["X-Cache-Status"] = cache_status
+    if etag_matches(request.headers.get("if-none-match", ""), entry["etag"]):
+        headers.pop("content-type", None)
+        return Response(status_code=304, headers=headers)
+    return Response(content=entry["body"], status_code=200, headers=headers)
+
+def hit_rate_percent(hits: int, misses: int) -> float:
+    total = hits + misses
+    return round(hits / total * 100, 2) if total else 0
+
+@app.get("/debug/proxy-cache-stats")
+async def proxy_cache_stats():
+    """Get proxy cache and request coalescing statistics for debugging"""
+    return {
+        "cache_size": len(cache),
+        "indexed_tags": len(tag_index),
+        "inflight_fetches": len(inflight_fetches),
+        "counters": cache_counters,
+        "by_vary_policy": {
+            policy: dict(counts, hit_rate_percent=hit_rate_percent(counts["hits"], counts["misses"]))
+            for policy, counts in vary_counters.items()
+        },
+        "coalescing": coalescing_stats,
+    }
+
+@app.get("/debug/proxy-pool-stats")
+async def proxy_pool_stats():
+    """Get upstream connection pool statistics for debugging"""
+    return {"backends": load_balancer.pool_stats()}
+
+@app.get("/debug/proxy-backend-stats")
+async def proxy_backend_stats():
+    """Get per-backend load, latency and health metrics for debugging"""
+    return {"strategy": load_balancer.strategy, "backends": load_balancer.metrics()}
 
 @app.api_route("/{path:path}", methods=["GET", "POST", "PUT", "DELETE", "PATCH", "OPTIONS"])
 async def proxy(request: Request, path: str, response: Response):
+    #The route parameter has no leading slash, but our path patterns do
+    request_path = f"/{path}"
+
     #Check if this is a cacheable database read request
-    is_db_read = is_db_read_request(request.method, path)
+    is_db_read = is_db_read_request(request.method, request_path)
     
     #Generate a cache key for this request
-    cache_key = generate_cache_key(request, path)
+    vary_policy = get_vary_policy(request_path)
+    cache_key = generate_cache_key(request, request_path, vary_policy)
     
     #Check if we have a valid cached response for db reads
     current_time = time.time()
     cache_status = "MISS"
+    #Expired entry kept around in case the backends fail
+    stale_entry = None
+
+    #Responses recently found too large to cache are streamed like any other non-cacheable request
+    if is_db_read and oversized_keys.get(cache_key, 0) > current_time:
+        is_db_read = False
+        cache_status = "BYPASS"
     
     #Check if this is a write operation that should invalidate cache entries
     if is_write_request(request.method):
-        paths_to_invalidate = get_paths_to_invalidate(request.method, path)
-        invalidate_cache_entries(paths_to_invalidate)
+        invalidate_tags(tags_for_path(request_path, CACHE_INVALIDATION_MAP))
         cache_status = "BYPASS"  #This request is bypassing cache
+
+    #Everything that won't be stored in the cache is streamed end to end
+    if not is_db_read:
+        try:
+            return await stream_request(request, request_path, cache_status)
+        except Exception as e:
+            print(f"Error forwarding request: {str(e)}")
+            response.status_code = 500
+            return {"error": str(e)}
+
+    headers = forwarded_headers(request)
+    params = dict(request.query_params)
+
+    def mark_oversized(store_key: str):
+        #Too big to keep in memory, stream this key for a while instead of buffering it
+        print(f"Response for {path} is too large to cache or has no Content-Length, streaming it for {CACHE_EXPIRATION}s")
+        if len(oversized_keys) >= MAX_CACHE_SIZE:
+            oversized_keys.clear()
+        oversized_keys[store_key] = time.time() + CACHE_EXPIRATION
+
+    async def fetch() -> Union[httpx.Response, StreamedUpstream]:
+        #Get the next server from the load balancer
+        backend = load_balancer.choose()
+        backend_response = await forward_request(backend, request.method, request_path, headers, b"", params)
+        upstream_response = backend_response.response if isinstance(backend_response, StreamedUpstream) else backend_response
+
+        #Only cache successful DB read requests with JSON responses
+        content_type = upstream_response.headers.get("content-type", "")
+        if (upstream_response.status_code == 200 and 
+            "application/json" in content_type):
+            #The backend may have declared a different vary policy than we assumed for the lookup
+            store_key = cache_key
+            response_policy = remember_vary_policy(request_path, upstream_response)
+            if response_policy != vary_policy:
+                store_key = generate_cache_key(request, request_path, response_policy)
+
+            #Content-Length counts the encoded body, it can still decode to more than the limit
+            if isinstance(backend_response, StreamedUpstream) or len(backend_response.content) > MAX_CACHEABLE_BODY_BYTES:
+                mark_oversized(store_key)
+                return backend_response
+
+            #Cache the response
+            tags = parse_surrogate_keys(backend_response.headers) or tags_for_path(request_path, CACHE_DEFAULT_TAGS)
+            store_cache_entry(store_key, backend_response, tags)
+            print(f"Cached response for {path}")
+            
+            #Maintain cache size
+            maintain_cache_size()
+        return backend_response
+
+    async def revalidate():
+        #Nobody reads a background refresh, so a response too big to store is dropped unread
+        backend_response = await fetch()
+        if isinstance(backend_response, StreamedUpstream):
+            await backend_response.close()
+        return backend_response
+
     #For GET requests, check cache
-    elif is_db_read and cache_key in cache:
+    if cache_key in cache:
         cached_data = cache[cache_key]
-        if current_time - cached_data["timestamp"] < CACHE_EXPIRATION:
+        age = current_time - cached_data["timestamp"]
+        stale_policy = get_stale_policy(request_path)
+        if age < CACHE_EXPIRATION:
             print(f"Cache hit for {path}")
             cache_status = "HIT"
-            #Set cache status header
-            response.headers["X-Cache-Status"] = cache_status
-            return cached_data["data"]
+            cache_counters["hits"] += 1
+            vary_counters[vary_policy]["hits"] += 1
+            return cached_response(request, cached_data, cache_status)
+        elif age < CACHE_EXPIRATION + stale_policy["stale_while_revalidate"]:
+            #Serve the stale entry right away and refresh it in the background
+            print(f"Cache stale for {path}, revalidating")
+            cache_status = "STALE"
+            cache_counters["stale_hits"] += 1
+            vary_counters[vary_policy]["hits"] += 1
+            start_revalidation(cache_key, revalidate)
+            return cached_response(request, cached_data, cache_status)
+        elif age < CACHE_EXPIRATION + stale_policy["stale_if_error"]:
+            #Too old to serve as is, but still usable if the backends fail
+            print(f"Cache expired for {path}")
+            cache_status = "EXPIRED"
+            stale_entry = cached_data
         else:
             #Cache expired, remove it
             print(f"Cache expired for {path}")
             cache_status = "EXPIRED"
-            del cache[cache_key]
-    
-    #Get the next server from the load balancer
-    backend_url = load_balancer.round_robin()
-    url = f"{backend_url}/{path}"
-    request_counter[backend_url] += 1
-    
-    #Print detailed request and balance information
-    print(f"Forwarding request to: {url} for {request.method} {path}")
-    print(f"Current load distribution: {dict(request_counter)}")
-    
+            remove_cache_entry(cache_key)
+
+    cache_counters["misses"] += 1
+    vary_counters[vary_policy]["misses"] += 1
+
     try:
-        async with httpx.AsyncClient() as client:
-            #Forward the request to the backend
-            backend_response = await client.request(
-                request.method, 
-                url, 
-                headers=dict(request.headers.items()),
-                content=await request.body(),
-                params=dict(request.query_params)
-            )
-            
-            #Get content type and check if it's JSON
-            content_type = backend_response.headers.get("content-type", "")            #Copy headers from backend response to our response
-            for header_name, header_value in backend_response.headers.items():
-                #Skip content-length as FastAPI will set it
-                if header_name.lower() != "content-length":
-                    response.headers[header_name] = header_value
-              #Never override the X-Cache-Status from Nginx
-            #Instead, we'll add our own status with a different name
-            response.headers["X-Proxy-Cache-Status"] = cache_status
-            
-            #If we don't see an Nginx cache status, explicitly note that
-            if "X-Cache-Status" not in backend_response.headers:
-                response.headers["X-Cache-Status-Note"] = "Not set by Nginx"
-            
-            #Add more detailed cache information for debugging
-            if is_db_read:
-                response.headers["X-Cache-Type"] = "DB_READ"
-                response.headers["X-Cache-Key"] = cache_key
-            
-            #Set status code from backend
-            response.status_code = backend_response.status_code
-            
-            #Only cache successful DB read requests with JSON responses
-            if (is_db_read and 
-                backend_response.status_code == 200 and 
-                "application/json" in content_type):
-                try:
-                    response_data = backend_response.json()
-                    
-                    #Cache the response
-                    cache[cache_key] = {
-                        "data": response_data,
-                        "timestamp": current_time
-                    }
-                    print(f"Cached response for {path}")
-                    
-                    #Maintain cache size
-                    maintain_cache_size()
-                    
-                    return response_data
-                except Exception as json_error:
-                    print(f"Error parsing JSON response: {str(json_error)}")
-                    return Response(content=backend_response.content, status_code=backend_response.status_code)
-            
-            #For non-JSON responses, return the raw content
-            return Response(content=backend_response.content, status_code=backend_response.status_code)
-            
+        #Concurrent misses on the same key share one upstream fetch
+        backend_response, coalesced = await fetch_single_flight(cache_key, fetch)
+        if coalesced:
+            cache_status = "COALESCED"
+
+        if isinstance(backend_response, StreamedUpstream):
+            #Only one request can read the shared upstream body, normally the leader, the others stream their own
+            if not backend_response.take():
+                return await stream_request(request, request_path, "BYPASS")
+            if stale_entry is not None and backend_response.response.status_code >= 500:
+                await backend_response.close()
+                print(f"Backend error {backend_response.response.status_code} for {path}, serving stale entry")
+                cache_counters["stale_if_error_hits"] += 1
+                return cached_response(request, stale_entry, "STALE_IF_ERROR")
+            return backend_response.to_response(cache_status)
+
+        if stale_entry is not None and backend_response.status_code >= 500:
+            print(f"Backend error {backend_response.status_code} for {path}, serving stale entry")
+            cache_counters["stale_if_error_hits"] += 1
+            return cached_response(request, stale_entry, "STALE_IF_ERROR")
+        
+        #Copy headers from backend response to our response
+        response_headers = {
+            header_name: header_value
+            for header_name, header_value in backend_response.headers.items()
+            if header_name.lower() not in EXCLUDED_RESPONSE_HEADERS
+        }
+        #Never override the X-Cache-Status from Nginx
+        #Instead, we'll add our own status with a different name
+        response_headers["X-Proxy-Cache-Status"] = cache_status
+        
+        #If we don't see an Nginx cache status, explicitly note that
+        if "X-Cache-Status" not in backend_response.headers:
+            response_headers["X-Cache-Status-Note"] = "Not set by Nginx"
+        
+        #Add more detailed cache information for debugging
+        response_headers["X-Cache-Type"] = "DB_READ"
+        response_headers["X-Cache-Key"] = cache_key
+
+        #Give the client an ETag so its next request can be answered with a 304
+        if backend_response.status_code == 200:
+            etag = backend_response.headers.get("etag") or make_etag(backend_response.content)
+            response_headers["ETag"] = etag
+            if etag_matches(request.headers.get("if-none-match", ""), etag):
+                response_headers.pop("content-type", None)
+                return Response(status_code=304, headers=response_headers)
+        
+        #Pass the upstream body through untouched
+        return Response(content=backend_response.content, status_code=backend_response.status_code, headers=response_headers)
+        
     except Exception as e:
         print(f"Error forwarding request: {str(e)}")
+        if stale_entry is not None:
+            cache_counters["stale_if_error_hits"] += 1
+            return cached_response(request, stale_entry, "STALE_IF_ERROR")
         response.status_code = 500
         return {"error": str(e)}
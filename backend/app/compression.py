@@ -0,0 +1,87 @@
+"""
+Response compression helpers for YAPPER2
+
+Bodies stored by the response cache are compressed once at store time with
+every available encoding, and each request is served the variant that best
+matches its Accept-Encoding header. gzip is always available, brotli and
+zstd are used when their packages are installed.
+"""
+
+import gzip
+import os
+from typing import Dict, List
+
+try:
+    import brotli
+except ImportError:  # Optional dependency
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:  # Optional dependency
+    zstandard = None
+
+# Bodies smaller than this are not worth compressing
+COMPRESSION_MIN_BYTES = int(os.environ.get("COMPRESSION_MIN_BYTES", 1024))
+
+# Compression levels, tuned for store-once/serve-many
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+ZSTD_LEVEL = 6
+
+def _compress_gzip(body: bytes) -> bytes:
+    return gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+
+def _compress_brotli(body: bytes) -> bytes:
+    return brotli.compress(body, quality=BROTLI_QUALITY)
+
+def _compress_zstd(body: bytes) -> bytes:
+    return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(body)
+
+# Available encodings, in order of server preference
+COMPRESSORS = {}
+if brotli is not None:
+    COMPRESSORS["br"] = _compress_brotli
+if zstandard is not None:
+    COMPRESSORS["zstd"] = _compress_zstd
+COMPRESSORS["gzip"] = _compress_gzip
+
+def compress_variants(body: bytes) -> Dict[str, bytes]:
+    """Compress a body with every available encoding, keeping only variants that are actually smaller"""
+    if len(body) < COMPRESSION_MIN_BYTES:
+        return {}
+    variants = {}
+    for encoding, compress in COMPRESSORS.items():
+        compressed = compress(body)
+        if len(compressed) < len(body):
+            variants[encoding] = compressed
+    return variants
+
+def parse_accept_encoding(header: str) -> Dict[str, float]:
+    """Parse an Accept-Encoding header into {encoding: qvalue}"""
+    accepted = {}
+    for part in header.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        encoding, _, params = part.partition(";")
+        qvalue = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                qvalue = float(params[2:])
+            except ValueError:
+                qvalue = 0.0
+        accepted[encoding.strip().lower()] = qvalue
+    return accepted
+
+def choose_encoding(accept_encoding: str, available: List[str]) -> str:
+    """Pick the preferred available encoding the client accepts, or "identity" """
+    if not accept_encoding or not available:
+        return "identity"
+    accepted = parse_accept_encoding(accept_encoding)
+    wildcard = accepted.get("*", 0.0)
+    for encoding in available:
+        if accepted.get(encoding, wildcard) > 0:
+            return encoding
+    return "identity"
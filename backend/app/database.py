@@ -1,72 +1,163 @@
 from sqlalchemy import create_engine, event
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import Session, sessionmaker
 from config import DATABASE_URL
 import os
 import time
 import sys
+from pool_metrics import InstrumentedQueuePool, InstrumentedAsyncAdaptedQueuePool, instrument_pool, request_db_timing, async_pool_metrics
 
 #Determine if DB caching should be enabled
 #Always enabled by default, can be disabled explicitly via environment variable
 ENABLE_DB_CACHE = os.environ.get("ENABLE_DB_CACHE", "True").lower() == "true"
 
+#Connection pool settings
+#Each engine opens up to DB_POOL_SIZE + DB_MAX_OVERFLOW (15) connections, so 3 replicas with a sync and an async
+#engine each stay under Postgres's default max_connections of 100. That is fewer than the 40 sync routes the FastAPI
+#threadpool runs at once, under load routes wait for a connection (db-wait in Server-Timing)
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 5))
+DB_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", 10))
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", 30))          #Seconds to wait for a free connection
+DB_POOL_RECYCLE = int(os.environ.get("DB_POOL_RECYCLE", 1800))          #Reopen connections older than this, -1 to never
+DB_POOL_PRE_PING = os.environ.get("DB_POOL_PRE_PING", "True").lower() == "true"
+DB_STATEMENT_TIMEOUT_MS = int(os.environ.get("DB_STATEMENT_TIMEOUT_MS", 0))  #Postgres statement_timeout, 0 for none
+
+#Async drivers for the async engine, by the dialect of DATABASE_URL
+ASYNC_DRIVERS = {
+    "postgresql": "postgresql+asyncpg",
+    "postgres": "postgresql+asyncpg",
+    "sqlite": "sqlite+aiosqlite",
+}
+
+def async_database_url(url: str) -> str:
+    """DATABASE_URL with its driver swapped for the async one, e.g. postgresql:// -> postgresql+asyncpg://"""
+    scheme, separator, rest = url.partition("://")
+    dialect = scheme.split("+")[0]
+    if dialect not in ASYNC_DRIVERS:
+        return url
+    return ASYNC_DRIVERS[dialect] + separator + rest
+
+#Can be set explicitly when the async driver needs a different URL, e.g. for connection parameters asyncpg doesn't take
+ASYNC_DATABASE_URL = os.environ.get("ASYNC_DATABASE_URL") or async_database_url(DATABASE_URL)
+
+def engine_options(url: str, asynchronous: bool = False) -> dict:
+    """Pool and connection options for create_engine, or create_async_engine if asynchronous"""
+    if url.startswith("sqlite"):
+        #SQLite (local testing) keeps SQLAlchemy's default pool for its file or memory database
+        return {}
+    options = {
+        "poolclass": InstrumentedAsyncAdaptedQueuePool if asynchronous else InstrumentedQueuePool,
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_recycle": DB_POOL_RECYCLE,
+        "pool_pre_ping": DB_POOL_PRE_PING,
+    }
+    if DB_STATEMENT_TIMEOUT_MS and url.startswith("postgres"):
+        if asynchronous:
+            #asyncpg takes server settings instead of a libpq options string
+            options["connect_args"] = {"server_settings": {"statement_timeout": str(DB_STATEMENT_TIMEOUT_MS)}}
+        else:
+            options["connect_args"] = {"options": f"-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}"}
+    return options
+
 #Creating SQLAlchemy engine using the config.py URL
 #SQLAlchemy needs it to execute SQL queries and interact with the DB
-engine = create_engine(DATABASE_URL)
+engine = create_engine(DATABASE_URL, **engine_options(DATABASE_URL))
+instrument_pool(engine)
 
 #Creating a session factory s
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+#Async engine for the read routes, they wait for the database on the event loop instead of holding a threadpool slot
+#It has its own pool, sized with the same settings
+async_engine = create_async_engine(ASYNC_DATABASE_URL, **engine_options(ASYNC_DATABASE_URL, asynchronous=True))
+instrument_pool(async_engine.sync_engine, async_pool_metrics)
+
+#Session class behind each AsyncSession, so the cache events below also see writes made through it
+class AsyncBackingSession(Session):
+    pass
+
+#Objects stay loaded after commit, AsyncSession can't lazy load expired attributes
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False, sync_session_class=AsyncBackingSession)
+
 #Creating a base class for declarative class definitions
 Base = declarative_base()
 
 #Import routes.logs 
 from routes.logs import log_db_access, increment_db_access_count
+from query_profiler import profiler as query_profiler
+from slow_query_log import slow_query_log
 
-#SQLAlchemy event listener to log database access
+#SQLAlchemy event listeners to time and log database access, on both engines
+#The start time lives on the execution context, so it is dropped with the statement
 @event.listens_for(engine, "before_cursor_execute")
+@event.listens_for(async_engine.sync_engine, "before_cursor_execute")
 def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
     """
-    Log db access
+    Start timing a statement
     """
-    conn.info.setdefault("query_start_time", []).append(time.time())
-
-    #Log db operation
-    statement_lower = statement.lower()
-    operation = "UNKNOWN"
-    table = "UNKNOWN"
-
-    if "select" in statement_lower: 
-        operation = "SELECT"
-    elif "insert" in statement_lower: 
-        operation = "INSERT"
-    elif "update" in statement_lower:
-        operation = "UPDATE"
-    elif "delete" in statement_lower:
-        operation = "DELETE"
-
-    #Basic table extraction
-    table_keywords = ["from", "into", "update", "join"]
-    for keyword in table_keywords:
-        if f" {keyword} " in statement_lower:
-            parts = statement_lower.split(f" {keyword} ")[1].strip().split(" ")
-            if parts:
-                table = parts[0].strip()
-                break
+    context._query_start_time = time.perf_counter()
+
+@event.listens_for(engine, "after_cursor_execute")
+@event.listens_for(async_engine.sync_engine, "after_cursor_execute")
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    """
+    Record the statement's latency under its fingerprint, keep it if it was slow and log db access
+    """
+    duration = time.perf_counter() - context._query_start_time
+    info = query_profiler.record(statement, duration)
+    timing = request_db_timing.get()
+    if timing is not None:
+        timing.query_time += duration
+        timing.queries += 1
+    #Plans are captured on the engine that ran the statement, the SQL and parameters are in its driver's format
+    slow_query_log.maybe_record(conn.engine, statement, parameters, duration, info.fingerprint, info.operation, executemany)
 
     query_details = f"{statement[:100]}..." if len(statement) > 100 else statement
-    log_db_access(operation, table, query_details)
+    log_db_access(info.operation, info.table, query_details)
     increment_db_access_count()
 
 #Database query caching integration
 if ENABLE_DB_CACHE:
     from db_cache import (
-        hash_query, 
-        is_cacheable_query, 
+        query_cache_key_info, 
+        statement_cache_key_info, 
+        query_dependencies, 
         get_from_cache, 
-        store_in_cache
+        store_in_cache,
+        record_flush_changes,
+        record_bulk_change,
+        invalidate_pending_changes,
+        discard_pending_changes
     )
     
+    #Invalidate cached queries when the tables or rows they read are written
+    #Writes are collected on flush and applied on commit, so rolled back writes keep the cache
+    @event.listens_for(SessionLocal, "after_flush")
+    @event.listens_for(AsyncBackingSession, "after_flush")
+    def collect_cache_changes(session, flush_context):
+        record_flush_changes(session)
+    
+    @event.listens_for(SessionLocal, "do_orm_execute")
+    @event.listens_for(AsyncBackingSession, "do_orm_execute")
+    def collect_bulk_cache_changes(orm_execute_state):
+        if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+            table = getattr(orm_execute_state.statement, "table", None)
+            if table is not None:
+                record_bulk_change(orm_execute_state.session, table.name)
+    
+    @event.listens_for(SessionLocal, "after_commit")
+    @event.listens_for(AsyncBackingSession, "after_commit")
+    def invalidate_cache_changes(session):
+        invalidate_pending_changes(session)
+    
+    @event.listens_for(SessionLocal, "after_rollback")
+    @event.listens_for(AsyncBackingSession, "after_rollback")
+    def discard_cache_changes(session):
+        discard_pending_changes(session)
+    
     def cached_query(query):
         """
         Wrapper function to add caching to SQLAlchemy queries
@@ -84,45 +175,41 @@ if ENABLE_DB_CACHE:
         original_one = query.one
         original_one_or_none = query.one_or_none
         
-        #Check if query is cacheable
-        if not is_cacheable_query(query):
+        #Build the cache key for this query, None if the query is not cacheable
+        key_info = query_cache_key_info(query)
+        if key_info is None:
             return query
+        query_key, info = key_info
         
-        #Generate hash for this query
-        query_hash = hash_query(query)
+        #Tables or row the results depend on, for invalidation
+        tables, row = query_dependencies(query_key, info)
         
         #Replace the execute methods with cached versions
+        #Results are read-only snapshots of the rows, on hits and misses alike
         def cached_all():
-            found, result = get_from_cache(query_hash + "_all")
+            found, result = get_from_cache((query_key, "all"))
             if found:
-                return result
-            result = original_all()
-            store_in_cache(query_hash + "_all", result)
-            return result
+                return list(result)
+            result = store_in_cache((query_key, "all"), original_all(), tables, row)
+            return list(result)
             
         def cached_first():
-            found, result = get_from_cache(query_hash + "_first")
+            found, result = get_from_cache((query_key, "first"))
             if found:
                 return result
-            result = original_first()
-            store_in_cache(query_hash + "_first", result)
-            return result
+            return store_in_cache((query_key, "first"), original_first(), tables, row)
             
         def cached_one():
-            found, result = get_from_cache(query_hash + "_one")
+            found, result = get_from_cache((query_key, "one"))
             if found:
                 return result
-            result = original_one()
-            store_in_cache(query_hash + "_one", result)
-            return result
+            return store_in_cache((query_key, "one"), original_one(), tables, row)
             
         def cached_one_or_none():
-            found, result = get_from_cache(query_hash + "_one_or_none")
+            found, result = get_from_cache((query_key, "one_or_none"))
             if found:
                 return result
-            result = original_one_or_none()
-            store_in_cache(query_hash + "_one_or_none", result)
-            return result
+            return store_in_cache((query_key, "one_or_none"), original_one_or_none(), tables, row)
         
         #Replace methods with cached versions
         query.all = cached_all
@@ -131,6 +218,48 @@ if ENABLE_DB_CACHE:
         query.one_or_none = cached_one_or_none
         
         return query
+    
+    async def cached_execute(db: AsyncSession, statement, result: str = "all"):
+        """
+        Execute a select() on an AsyncSession through the query cache
+        
+        result is "all" for a list of the first column (like Query.all() for one model),
+        "first" for the first of those or None, and "rows" for a list of whole rows
+        
+        Usage example:
+            #users = await cached_execute(db, select(UserModel))
+        """
+        key_info = statement_cache_key_info(statement)
+        if key_info is None:
+            return await _execute(db, statement, result)
+        statement_key, info = key_info
+        
+        key = (statement_key, result)
+        found, cached = get_from_cache(key)
+        if found:
+            return cached if result == "first" else list(cached)
+        
+        tables, row = query_dependencies(statement_key, info)
+        stored = store_in_cache(key, await _execute(db, statement, result), tables, row)
+        return stored if result == "first" else list(stored)
+
+async def _execute(db: AsyncSession, statement, result: str):
+    """Run a select() and shape its result like cached_execute"""
+    if result == "rows":
+        return list((await db.execute(statement)).all())
+    scalars = await db.scalars(statement)
+    if result == "first":
+        return scalars.first()
+    return list(scalars.all())
+
+def create_missing_indexes(bind):
+    """
+    Create indexes added to the models after their tables were created
+    create_all skips tables that already exist, indexes included
+    """
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=bind, checkfirst=True)
 
 def get_db():
     db = SessionLocal()
@@ -138,6 +267,10 @@ def get_db():
         yield db
     finally:
         db.close()
+
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
         
 def get_cached_query(query):
     """Utility function to apply caching if enabled"""
@@ -145,6 +278,12 @@ def get_cached_query(query):
         return cached_query(query)
     return query
 
+async def get_cached_result(db: AsyncSession, statement, result: str = "all"):
+    """Async counterpart of get_cached_query, executes the statement through the cache if enabled"""
+    if ENABLE_DB_CACHE:
+        return await cached_execute(db, statement, result)
+    return await _execute(db, statement, result)
+
 def get_db_cache_stats():
     """Get database cache statistics for monitoring"""
     if ENABLE_DB_CACHE:
@@ -152,9 +291,7 @@ def get_db_cache_stats():
         from db_cache import get_cache_stats
         stats = get_cache_stats()
         return {
-            "hits": stats["hits"],
-            "misses": stats["misses"],
-            "size": stats["size"],
+            **stats,
             "status": "enabled"
         }
     return {"status": "disabled"}
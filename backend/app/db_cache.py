@@ -3,171 +3,499 @@ Database query caching module for YAPPER2
 
 This module provides a caching layer for database queries
 to reduce the load on the database server.
+
+Each cached query records the tables it reads, and queries that select a single
+row by primary key also record that row. Writes are collected from session flushes
+and invalidate only the entries that depend on the changed tables or rows once
+they are committed (see the session events in database.py).
+
+Sync routes run in FastAPI's threadpool, so the cache is split into shards, each
+with its own lock, LRU order, limits and stats. Results are stored as immutable
+column snapshots rather than ORM instances, which would stay tied to a closed
+session and could lazy load from it.
 """
 
-import time
-import hashlib
-import json
+import os
 import sys
-from typing import Dict, Any, Optional, Tuple, List
-from sqlalchemy.orm import Query
-
-# Global query cache
-# Structure: {query_hash: {"result": result_data, "timestamp": timestamp}}
-query_cache = {}
+import threading
+import time
+from collections import OrderedDict
+from itertools import chain
+from typing import Dict, Any, Optional, Tuple, List, Hashable, Set
+from sqlalchemy import Row, Table, inspect
+from sqlalchemy.orm import Query, Session
+from sqlalchemy.sql import operators, visitors
+from sqlalchemy.sql.elements import BinaryExpression, BindParameter
 
 # Cache settings
 CACHE_EXPIRATION = 60  # Cache expiration time in seconds
-MAX_CACHE_SIZE = 100   # Maximum number of queries to cache
-
-# Track cache statistics
-cache_stats = {
-    "hits": 0,
-    "misses": 0,
-    "size": 0
-}
-
-def hash_query_str(query_str: str) -> str:
-    """Generate a unique hash for a query string."""
-    return hashlib.md5(query_str.encode()).hexdigest()
-
-def hash_query(query: Query) -> str:
-    """Generate a unique hash for a SQLAlchemy query."""
-    if hasattr(query, 'statement'):
-        query_str = str(query.statement.compile(compile_kwargs={"literal_binds": True}))
-        return hash_query_str(query_str)
-    return hash_query_str(str(query))
+MAX_CACHE_SIZE = int(os.environ.get("DB_CACHE_MAX_ENTRIES", 100))                 # Maximum number of queries to cache
+MAX_CACHE_BYTES = int(os.environ.get("DB_CACHE_MAX_BYTES", 16 * 1024 * 1024))     # Maximum estimated size of cached results
+NUM_SHARDS = int(os.environ.get("DB_CACHE_SHARDS", 8))
+# Print every lookup, off by default since a print per hit costs more than the hit
+DB_CACHE_VERBOSE = os.environ.get("DB_CACHE_VERBOSE", "False").lower() == "true"
 
-def is_cacheable_query(query: Query) -> bool:
-    """Determine if a query should be cached."""
+# What each statement shape (SQLAlchemy cache key without parameter values) depends on
+# Structure: {statement_shape: StatementInfo, or None if the shape may not be cached}
+statement_shapes = {}
+MAX_STATEMENT_SHAPES = 1000
+
+# Session.info key for the writes of the current transaction, invalidated on commit
+# Structure: {table: set(pks), or None when unknown rows changed}
+PENDING_CHANGES_KEY = "db_cache_changes"
+
+class StatementInfo:
+    """Tables a statement shape reads and, for single-row lookups, where its primary key parameter is"""
+    __slots__ = ("tables", "row_table", "row_param")
+
+    def __init__(self, tables: frozenset, row_table: Optional[str] = None, row_param: Optional[int] = None):
+        self.tables = tables
+        self.row_table = row_table
+        self.row_param = row_param
+
+def _hashable(value: Any) -> Hashable:
+    """Make a bound parameter value usable in a dict key (lists from IN clauses become tuples)"""
+    if isinstance(value, (list, tuple)):
+        return tuple(_hashable(item) for item in value)
+    if isinstance(value, dict):
+        return tuple(sorted((key, _hashable(item)) for key, item in value.items()))
+    if isinstance(value, set):
+        return frozenset(_hashable(item) for item in value)
+    return value
+
+def _is_cacheable_statement(statement) -> bool:
+    """Check a statement shape once, the result is memoized per shape."""
+    # Only cache plain SELECT queries
+    if not getattr(statement, "is_select", False):
+        return False
+    
+    # Don't cache locking reads or queries with options that might affect results
+    if getattr(statement, "_for_update_arg", None) is not None:
+        return False
+    if getattr(statement, "_with_options", None):
+        return False
+    
+    return True
+
+def _analyze_statement(statement, statement_key) -> Optional[StatementInfo]:
+    """Find what a cacheable statement depends on, None if it may not be cached."""
+    if not _is_cacheable_statement(statement):
+        return None
+    
+    tables = frozenset(element.name for element in visitors.iterate(statement) if isinstance(element, Table))
+    
+    # A lookup of one table by its single-column primary key only depends on that row
+    where = statement.whereclause
+    if len(tables) == 1 and isinstance(where, BinaryExpression) and where.operator is operators.eq:
+        column, value = where.left, where.right
+        if isinstance(column, BindParameter):
+            column, value = value, column
+        table = getattr(column, "table", None)
+        if isinstance(value, BindParameter) and isinstance(table, Table):
+            primary_key = list(table.primary_key.columns)
+            if len(primary_key) == 1 and column._deannotate() is primary_key[0]:
+                for index, bind in enumerate(statement_key.bindparams):
+                    if bind is value:
+                        return StatementInfo(tables, table.name, index)
+    
+    return StatementInfo(tables)
+
+def query_cache_key(query: Query) -> Optional[Tuple[Hashable, Tuple]]:
+    """
+    Build the cache key for a SQLAlchemy query, or None if it should not be cached.
+    The key is SQLAlchemy's own statement cache key (the statement's structure, which the
+    compiled SQL cache already uses) plus the bound parameter values, so nothing is
+    compiled to a string and nothing is hashed beyond the dict lookup itself.
+    """
+    key_info = query_cache_key_info(query)
+    return None if key_info is None else key_info[0]
+
+def statement_cache_key(statement) -> Optional[Tuple[Hashable, Tuple]]:
+    """Same as query_cache_key, for a 2.0 style select() as used with AsyncSession."""
+    key_info = statement_cache_key_info(statement)
+    return None if key_info is None else key_info[0]
+
+def query_cache_key_info(query: Query) -> Optional[Tuple[Tuple[Hashable, Tuple], StatementInfo]]:
+    """The query's cache key and what its shape depends on, for query_dependencies, or None if it should not be cached."""
+    # Execution options are not part of the statement cache key, check them directly
+    if getattr(query, "_execution_options", None):
+        return None
     try:
-        # Only cache SELECT queries (using statement.is_select if available)
-        if hasattr(query, 'statement') and hasattr(query.statement, 'is_select'):
-            if not query.statement.is_select:
-                return False
+        statement = query.statement
+    except Exception:
+        return None
+    return statement_cache_key_info(statement)
+
+def statement_cache_key_info(statement) -> Optional[Tuple[Tuple[Hashable, Tuple], StatementInfo]]:
+    """
+    Same as query_cache_key_info, for a 2.0 style select().
+    The StatementInfo is returned with the key, the shape memo may be reset before it is looked up again.
+    """
+    try:
+        if getattr(statement, "_execution_options", None):
+            return None
         
-        # Alternative approach for older SQLAlchemy versions
-        # Check if the query is for a SELECT operation based on its string representation
-        stmt_str = str(query.statement).strip().lower()
-        if not stmt_str.startswith('select'):
-            return False
-            
-        # Don't cache queries with specific options that might affect results
-        if hasattr(query, '_with_options') and query._with_options:
-            return False
-            
-        if hasattr(query, '_execution_options') and query._execution_options:
-            return False
+        statement_key = statement._generate_cache_key()
+        if statement_key is None:
+            # Statement contains elements SQLAlchemy can't cache either
+            return None
         
-        return True
+        shape = statement_key.key
+        if shape in statement_shapes:
+            info = statement_shapes[shape]
+        else:
+            info = _analyze_statement(statement, statement_key)
+            if len(statement_shapes) >= MAX_STATEMENT_SHAPES:
+                statement_shapes.clear()
+            statement_shapes[shape] = info
+        if info is None:
+            return None
+        
+        params = tuple(_hashable(bind.effective_value) for bind in statement_key.bindparams)
+        return (shape, params), info
     except Exception:
         # If any error occurs during check, default to not caching
-        return False
+        return None
+
+def is_cacheable_query(query: Query) -> bool:
+    """Determine if a query should be cached."""
+    return query_cache_key(query) is not None
+
+def query_dependencies(query_key: Tuple[Hashable, Tuple], info: StatementInfo) -> Tuple[frozenset, Optional[Tuple[str, Any]]]:
+    """
+    Return (tables, row) for a key and StatementInfo from query_cache_key_info. row is
+    (table, pk) when the query only reads that row, otherwise the query depends on whole tables.
+    """
+    _, params = query_key
+    if info.row_table is not None:
+        return info.tables, (info.row_table, params[info.row_param])
+    return info.tables, None
+
+def _log(message: str) -> None:
+    if DB_CACHE_VERBOSE:
+        print(message)
+
+def _short_key(query_key: Hashable) -> str:
+    """Short printable id for a cache key"""
+    return f"{hash(query_key) & 0xffffffff:08x}"
+
+class RowSnapshot:
+    """Read-only copy of an ORM instance's column values"""
+    __slots__ = ()
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{type(self).__name__} is a read-only cached row")
+
+    def __delattr__(self, name):
+        raise AttributeError(f"{type(self).__name__} is a read-only cached row")
+
+    def __repr__(self) -> str:
+        values = ", ".join(f"{name}={getattr(self, name)!r}" for name in self.__slots__)
+        return f"{type(self).__name__}({values})"
+
+    def __eq__(self, other) -> bool:
+        return type(self) is type(other) and all(getattr(self, name) == getattr(other, name) for name in self.__slots__)
+
+    def __hash__(self) -> int:
+        return hash(tuple(getattr(self, name) for name in self.__slots__))
+
+# Snapshot class per mapped class
+# Structure: {mapped_class: (snapshot_class, column attribute names)}
+snapshot_classes = {}
+snapshot_classes_lock = threading.Lock()
+
+def _snapshot_class(obj) -> Optional[Tuple[type, Tuple[str, ...]]]:
+    """Snapshot class for a mapped instance, None for anything else (remembered per type too)"""
+    cls = type(obj)
+    if cls in snapshot_classes:
+        return snapshot_classes[cls]
+    with snapshot_classes_lock:
+        if cls not in snapshot_classes:
+            mapper = inspect(cls, raiseerr=False)
+            if mapper is None or not hasattr(mapper, "column_attrs"):
+                snapshot_classes[cls] = None
+            else:
+                names = tuple(attr.key for attr in mapper.column_attrs)
+                snapshot = type(f"{cls.__name__}Snapshot", (RowSnapshot,), {"__slots__": names})
+                snapshot_classes[cls] = (snapshot, names)
+        return snapshot_classes[cls]
+
+class PartiallyLoaded(Exception):
+    """An instance has deferred, expired or otherwise unloaded columns, its snapshot would hold None for them"""
 
-def get_from_cache(query_hash: str) -> Tuple[bool, Any]:
+def snapshot(obj: Any) -> Any:
+    """Copy an ORM instance's column values into an immutable snapshot, other values are kept as they are"""
+    if isinstance(obj, Row):
+        # Rows are immutable but may hold ORM instances, e.g. select(TweetsModel, UserModel.username)
+        return tuple(snapshot(value) for value in obj)
+    entry = _snapshot_class(obj)
+    if entry is None:
+        # Scalars and None are already immutable
+        return obj
+    snapshot_class, names = entry
+    unloaded = inspect(obj).unloaded
+    if unloaded and not unloaded.isdisjoint(names):
+        raise PartiallyLoaded(f"{type(obj).__name__} columns not loaded: {', '.join(sorted(unloaded.intersection(names)))}")
+    copy = object.__new__(snapshot_class)
+    state = obj.__dict__
+    for name in names:
+        object.__setattr__(copy, name, state.get(name))
+    return copy
+
+def snapshot_result(result: Any) -> Any:
+    """Snapshot a query result, lists become tuples"""
+    if isinstance(result, list):
+        return tuple(snapshot(obj) for obj in result)
+    return snapshot(result)
+
+def _estimate_size(value: Any) -> int:
+    """Rough size in bytes of a snapshot result"""
+    if isinstance(value, tuple):
+        return sys.getsizeof(value) + sum(_estimate_size(item) for item in value)
+    if isinstance(value, RowSnapshot):
+        return sys.getsizeof(value) + sum(sys.getsizeof(getattr(value, name)) for name in value.__slots__)
+    return sys.getsizeof(value)
+
+class CacheEntry:
+    __slots__ = ("result", "timestamp", "tables", "row", "size")
+
+    def __init__(self, result: Any, tables: frozenset, row: Optional[Tuple[str, Any]], size: int):
+        self.result = result
+        self.timestamp = time.time()
+        self.tables = tables
+        self.row = row
+        self.size = size
+
+class CacheShard:
+    """One lock-protected slice of the cache, entries are kept in least recently used order"""
+
+    def __init__(self, max_entries: int, max_bytes: int):
+        self.lock = threading.Lock()
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries: "OrderedDict[Hashable, CacheEntry]" = OrderedDict()
+        self.bytes = 0
+        # Entries that depend on a whole table, and entries that only depend on one row of a table
+        # Structure: {table: set(query_keys)} and {table: {pk: set(query_keys)}}
+        self.table_index: Dict[str, Set[Hashable]] = {}
+        self.row_index: Dict[str, Dict[Any, Set[Hashable]]] = {}
+        self.stats = self._empty_stats()
+
+    @staticmethod
+    def _empty_stats() -> Dict[str, int]:
+        return {
+            "hits": 0,
+            "misses": 0,
+            "evictions": 0,
+            "expirations": 0,
+            "invalidated": 0,
+        }
+
+    def get(self, query_key: Hashable) -> Tuple[bool, Any]:
+        with self.lock:
+            entry = self.entries.get(query_key)
+            if entry is not None:
+                if time.time() - entry.timestamp < CACHE_EXPIRATION:
+                    self.entries.move_to_end(query_key)
+                    self.stats["hits"] += 1
+                    return True, entry.result
+                self._remove(query_key)
+                self.stats["expirations"] += 1
+            self.stats["misses"] += 1
+            return False, None
+
+    def set(self, query_key: Hashable, entry: CacheEntry) -> None:
+        with self.lock:
+            if query_key in self.entries:
+                self._remove(query_key)
+            self.entries[query_key] = entry
+            self.bytes += entry.size
+            if entry.row is not None:
+                table, pk = entry.row
+                self.row_index.setdefault(table, {}).setdefault(pk, set()).add(query_key)
+            else:
+                for table in entry.tables:
+                    self.table_index.setdefault(table, set()).add(query_key)
+            
+            # Evict least recently used entries to stay within both limits
+            while len(self.entries) > self.max_entries or self.bytes > self.max_bytes:
+                oldest_key = next(iter(self.entries))
+                self._remove(oldest_key)
+                self.stats["evictions"] += 1
+
+    def remove(self, query_key: Hashable) -> None:
+        with self.lock:
+            self._remove(query_key)
+
+    def expire(self) -> int:
+        with self.lock:
+            cutoff = time.time() - CACHE_EXPIRATION
+            expired = [key for key, entry in self.entries.items() if entry.timestamp <= cutoff]
+            for key in expired:
+                self._remove(key)
+            self.stats["expirations"] += len(expired)
+            return len(expired)
+
+    def invalidate(self, changes: Dict[str, Optional[Set[Any]]]) -> int:
+        with self.lock:
+            stale = set()
+            for table, pks in changes.items():
+                stale.update(self.table_index.get(table, ()))
+                rows = self.row_index.get(table, {})
+                if pks is None:
+                    for keys in rows.values():
+                        stale.update(keys)
+                else:
+                    for pk in pks:
+                        stale.update(rows.get(pk, ()))
+            for key in stale:
+                self._remove(key)
+            self.stats["invalidated"] += len(stale)
+            return len(stale)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+            self.table_index.clear()
+            self.row_index.clear()
+            self.bytes = 0
+            self.stats = self._empty_stats()
+
+    def get_stats(self) -> Dict[str, int]:
+        with self.lock:
+            return {"size": len(self.entries), "bytes": self.bytes, **self.stats}
+
+    def _remove(self, query_key: Hashable) -> None:
+        """Remove one entry and its index references, the caller holds the lock"""
+        entry = self.entries.pop(query_key, None)
+        if entry is None:
+            return
+        self.bytes -= entry.size
+        if entry.row is not None:
+            table, pk = entry.row
+            keys = self.row_index.get(table, {}).get(pk)
+            if keys is not None:
+                keys.discard(query_key)
+                if not keys:
+                    del self.row_index[table][pk]
+        else:
+            for table in entry.tables:
+                keys = self.table_index.get(table)
+                if keys is not None:
+                    keys.discard(query_key)
+                    if not keys:
+                        del self.table_index[table]
+
+# Global query cache, each key always maps to the same shard
+shards = [
+    CacheShard(max(1, -(-MAX_CACHE_SIZE // NUM_SHARDS)), max(1, MAX_CACHE_BYTES // NUM_SHARDS))
+    for _ in range(NUM_SHARDS)
+]
+
+def _shard_for(query_key: Hashable) -> CacheShard:
+    return shards[hash(query_key) % NUM_SHARDS]
+
+def get_from_cache(query_key: Hashable) -> Tuple[bool, Any]:
     """
     Try to get results from cache.
     Returns a tuple: (found, result)
     """
-    global cache_stats
-    
-    # Log cache access attempt
-    print(f"Cache access for hash: {query_hash[:8]}...")
-    
-    if query_hash in query_cache:
-        cache_entry = query_cache[query_hash]
-        current_time = time.time()
-        
-        # Check if cache is still valid
-        if current_time - cache_entry["timestamp"] < CACHE_EXPIRATION:
-            cache_stats["hits"] += 1
-            print(f"Cache HIT! Hits now: {cache_stats['hits']}")
-            return True, cache_entry["result"]
-        else:
-            print("Cache entry expired")
+    found, result = _shard_for(query_key).get(query_key)
+    _log(f"DB cache {'HIT' if found else 'MISS'} for key: {_short_key(query_key)}")
+    return found, result
+
+def store_in_cache(query_key: Hashable, result: Any, tables: frozenset = frozenset(), row: Optional[Tuple[str, Any]] = None) -> Any:
+    """
+    Store a snapshot of query results in cache, indexed by the tables or row they were read from.
+    Returns the snapshot so callers hand out the same kind of result on hits and misses.
+    Results with partially loaded instances aren't cached and are returned as they are.
+    """
+    try:
+        result = snapshot_result(result)
+    except PartiallyLoaded as e:
+        _log(f"Not caching key {_short_key(query_key)}: {e}")
+        return result
+    entry = CacheEntry(result, tables, row, _estimate_size(result))
+    _shard_for(query_key).set(query_key, entry)
+    _log(f"Storing in DB cache, key: {_short_key(query_key)}")
+    return result
+
+def remove_from_cache(query_key: Hashable) -> None:
+    """Remove one entry and its index references."""
+    _shard_for(query_key).remove(query_key)
+
+def clean_cache() -> int:
+    """Remove expired items from every shard, returns how many were removed."""
+    return sum(shard.expire() for shard in shards)
+
+def invalidate_tables(changes: Dict[str, Optional[Set[Any]]]) -> int:
+    """
+    Drop the entries that depend on changed data.
+    changes maps a table to the primary keys that changed, or None when unknown rows changed.
+    Returns the number of entries removed.
+    """
+    removed = sum(shard.invalidate(changes) for shard in shards)
+    if removed:
+        print(f"DB cache invalidated {removed} entries for tables: {', '.join(sorted(changes))}")
+    return removed
+
+def _add_change(changes: Dict[str, Optional[Set[Any]]], table: str, pk: Any) -> None:
+    if table in changes and changes[table] is None:
+        return
+    if pk is None:
+        changes[table] = None
     else:
-        print("Cache entry not found")
-    
-    cache_stats["misses"] += 1
-    print(f"Cache MISS! Misses now: {cache_stats['misses']}")
-    return False, None
+        changes.setdefault(table, set()).add(pk)
 
-def store_in_cache(query_hash: str, result: Any) -> None:
-    """Store query results in cache."""
-    global cache_stats
-    
-    print(f"Storing in cache, hash: {query_hash[:8]}")
-    
-    # Store the result
-    query_cache[query_hash] = {
-        "result": result,
-        "timestamp": time.time()
-    }
-    
-    cache_stats["size"] = len(query_cache)
-    print(f"Cache size now: {cache_stats['size']}")
-    
-    # Clean up if cache exceeds max size
-    if len(query_cache) > MAX_CACHE_SIZE:
-        print("Cache size exceeds limit, cleaning...")
-        clean_cache()
-
-def clean_cache() -> None:
-    """Remove expired or oldest items from cache."""
-    current_time = time.time()
-    
-    # First, remove expired entries
-    expired_keys = [
-        key for key, value in query_cache.items() 
-        if current_time - value["timestamp"] > CACHE_EXPIRATION
-    ]
-    
-    for key in expired_keys:
-        del query_cache[key]
-    
-    # If still too large, remove oldest entries
-    if len(query_cache) > MAX_CACHE_SIZE:
-        sorted_keys = sorted(
-            query_cache.keys(), 
-            key=lambda k: query_cache[k]["timestamp"]
-        )
-        
-        # Remove oldest entries to get back to 80% of max size
-        to_remove = len(query_cache) - int(MAX_CACHE_SIZE * 0.8)
-        for i in range(to_remove):
-            if i < len(sorted_keys):
-                del query_cache[sorted_keys[i]]
-    
-    cache_stats["size"] = len(query_cache)
+def record_flush_changes(session: Session) -> None:
+    """Remember the rows a flush wrote, they are invalidated when the transaction commits."""
+    changes = session.info.setdefault(PENDING_CHANGES_KEY, {})
+    for obj in chain(session.new, session.dirty, session.deleted):
+        if obj in session.dirty and not session.is_modified(obj, include_collections=False):
+            continue
+        mapper = inspect(obj).mapper
+        primary_key = mapper.primary_key_from_instance(obj)
+        pk = primary_key[0] if len(primary_key) == 1 else None
+        for table in mapper.tables:
+            _add_change(changes, table.name, pk)
+
+def record_bulk_change(session: Session, table: str) -> None:
+    """Remember a bulk INSERT, UPDATE or DELETE, which may touch any row of the table."""
+    _add_change(session.info.setdefault(PENDING_CHANGES_KEY, {}), table, None)
+
+def invalidate_pending_changes(session: Session) -> None:
+    """Invalidate everything the committed transaction wrote."""
+    changes = session.info.pop(PENDING_CHANGES_KEY, None)
+    if changes:
+        invalidate_tables(changes)
+
+def discard_pending_changes(session: Session) -> None:
+    """Forget the writes of a rolled back transaction."""
+    session.info.pop(PENDING_CHANGES_KEY, None)
 
 def get_cache_stats() -> Dict[str, Any]:
-    """Return cache statistics."""
-    global cache_stats
+    """Return cache statistics, in total and per shard."""
+    shard_stats = [shard.get_stats() for shard in shards]
+    totals = {
+        key: sum(stats[key] for stats in shard_stats)
+        for key in ("size", "bytes", "hits", "misses", "evictions", "expirations", "invalidated")
+    }
     
     hit_rate = 0
-    total_requests = cache_stats["hits"] + cache_stats["misses"]
+    total_requests = totals["hits"] + totals["misses"]
     if total_requests > 0:
-        hit_rate = cache_stats["hits"] / total_requests * 100
+        hit_rate = totals["hits"] / total_requests * 100
     
     return {
-        "hits": cache_stats["hits"],
-        "misses": cache_stats["misses"],
-        "size": cache_stats["size"],
-        "hit_rate_percent": round(hit_rate, 2)
+        **totals,
+        "max_size": MAX_CACHE_SIZE,
+        "max_bytes": MAX_CACHE_BYTES,
+        "hit_rate_percent": round(hit_rate, 2),
+        "shards": shard_stats
     }
 
 def clear_cache() -> None:
     """Clear the entire query cache and reset the statistics."""
-    global query_cache, cache_stats
-    
-    print(f"Clearing DB cache. Before clear - Hits: {cache_stats['hits']}, Misses: {cache_stats['misses']}")
-    
-    # Clear the cache
-    query_cache = {}
-    
-    # Reset all cache statistics to 0
-    cache_stats["hits"] = 0
-    cache_stats["misses"] = 0 
-    cache_stats["size"] = 0
-    
-    print(f"DB cache cleared. After clear - Hits: {cache_stats['hits']}, Misses: {cache_stats['misses']}")
+    print("Clearing DB cache")
+    for shard in shards:
+        shard.clear()
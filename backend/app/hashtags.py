@@ -0,0 +1,98 @@
+"""
+Hashtags for YAPPER2
+
+Hashtags are kept twice: as the space-separated tags string on the tweet,
+which the API returns, and as one tweet_tags row per distinct lowercase tag,
+which tag lookups use. The (tag, tweet_id) primary key makes a lookup an
+indexed exact match, and paging by tweet id keeps each page as cheap as the
+first. Tweets created before tweet_tags existed are backfilled at startup,
+once per database: the first replica to finish records it in startup_tasks.
+"""
+
+import re
+from typing import Any, Dict, List
+from sqlalchemy import exists, insert, text
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+from models import TweetsModel, TweetTagModel, StartupTaskModel
+
+HASHTAG = re.compile(r'#(\w+)')
+BACKFILL_BATCH_SIZE = 1000
+BACKFILL_TASK = "backfill_tweet_tags"
+#Postgres advisory lock key, replicas starting together wait for the one backfilling
+BACKFILL_LOCK_KEY = 724001
+
+def extract_hashtags(content: str) -> List[str]:
+    """Hashtags in a tweet's text, without the #, as written"""
+    return HASHTAG.findall(content or "")
+
+def tags_string(hashtags: List[str]) -> str:
+    """The tags column value, e.g. "#python #fastapi" """
+    return " ".join([f"#{tag}" for tag in hashtags])
+
+def normalize_tag(tag: str) -> str:
+    """Lookup form of a tag, "#Python" and "python" are the same tag"""
+    return tag.strip().lstrip("#").lower()
+
+def distinct_tags(hashtags: List[str]) -> List[str]:
+    """A tweet's distinct tags in lookup form, in the order they were written"""
+    return list(dict.fromkeys(normalize_tag(tag) for tag in hashtags))
+
+def tag_rows(hashtags: List[str]) -> List[TweetTagModel]:
+    """tweet_tags rows for a tweet's hashtags, one per distinct tag"""
+    return [TweetTagModel(tag=tag) for tag in distinct_tags(hashtags)]
+
+def _insert_ignoring_duplicates(db: Session, model, rows: List[Dict[str, Any]]) -> None:
+    """INSERT rows, skipping the ones another replica inserted first"""
+    dialect = db.get_bind().dialect.name
+    if dialect == "postgresql":
+        statement = postgresql.insert(model).on_conflict_do_nothing()
+    elif dialect == "sqlite":
+        statement = sqlite.insert(model).on_conflict_do_nothing()
+    else:
+        statement = insert(model)
+    db.execute(statement, rows)
+
+def _backfill_done(db: Session) -> bool:
+    return db.get(StartupTaskModel, BACKFILL_TASK) is not None
+
+def backfill_tweet_tags(db: Session) -> int:
+    """
+    Add tweet_tags rows for tweets with hashtags but none yet. Returns how many tweets were filled in
+    Runs in one transaction, skipped once it has completed on any replica
+    """
+    if _backfill_done(db):
+        return 0
+    if db.get_bind().dialect.name == "postgresql":
+        #Held until the commit, a replica that waited for it finds the task done
+        db.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": BACKFILL_LOCK_KEY})
+        if _backfill_done(db):
+            db.rollback()
+            return 0
+
+    filled = 0
+    after_id = 0
+    while True:
+        batch = db.query(TweetsModel.id, TweetsModel.content)\
+            .filter(TweetsModel.id > after_id)\
+            .filter(TweetsModel.content.contains("#"))\
+            .filter(~exists().where(TweetTagModel.tweet_id == TweetsModel.id))\
+            .order_by(TweetsModel.id)\
+            .limit(BACKFILL_BATCH_SIZE)\
+            .all()
+        rows = [
+            {"tag": tag, "tweet_id": tweet_id}
+            for tweet_id, content in batch
+            for tag in distinct_tags(extract_hashtags(content))
+        ]
+        if rows:
+            _insert_ignoring_duplicates(db, TweetTagModel, rows)
+        filled += len({row["tweet_id"] for row in rows})
+        if len(batch) < BACKFILL_BATCH_SIZE:
+            break
+        after_id = batch[-1][0]
+    _insert_ignoring_duplicates(db, StartupTaskModel, [{"name": BACKFILL_TASK}])
+    db.commit()
+    if filled:
+        print(f"Backfilled tweet_tags for {filled} tweets")
+    return filled
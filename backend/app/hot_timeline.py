@@ -0,0 +1,167 @@
+"""
+Hot timeline for YAPPER2
+
+Keeps the newest HOT_TIMELINE_SIZE tweets in memory, with their usernames
+already resolved, in (created_at, id) order. The first pages of GET /tweets
+are served from it without touching the database, older pages still go to
+the database. It is loaded at startup and kept up to date by the tweet
+write paths. Each backend replica has its own copy, so it is also reloaded
+every HOT_TIMELINE_REFRESH_SECONDS to pick up writes made on other replicas.
+
+The window always holds every tweet newer than its oldest one, so a page
+can be served from memory whenever it ends inside the window.
+"""
+
+import os
+import threading
+import time
+from bisect import bisect_left
+from datetime import datetime
+from typing import Dict, Any, List, Optional, Tuple
+from sqlalchemy.orm import Session
+from models import TweetsModel, UserModel
+
+HOT_TIMELINE_SIZE = int(os.environ.get("HOT_TIMELINE_SIZE", 1000))
+HOT_TIMELINE_REFRESH_SECONDS = float(os.environ.get("HOT_TIMELINE_REFRESH_SECONDS", 10))  # 0 to never reload
+
+def timeline_entry(tweet: TweetsModel, username: str) -> Dict[str, Any]:
+    """A tweet as the timeline returns it"""
+    return {
+        "id": tweet.id,
+        "content": tweet.content,
+        "owner_id": tweet.owner_id,
+        "created_at": tweet.created_at,
+        "tags": tweet.tags,
+        "username": username
+    }
+
+class HotTimeline:
+    def __init__(self, size: int = HOT_TIMELINE_SIZE):
+        self.size = size
+        self.lock = threading.Lock()
+        # (created_at, id) of each entry, oldest first so new tweets are appended
+        self.keys: List[Tuple[datetime, int]] = []
+        self.entries: List[Dict[str, Any]] = []
+        self.loaded = False
+        # True while the window holds every tweet in the database, so it can serve the last page too
+        self.complete = False
+        # Bumped by every write, a reload that overlapped a write is thrown away
+        self.version = 0
+        self.stats = {"hits": 0, "misses": 0, "loads": 0, "skipped_loads": 0}
+
+    def load(self, db: Session) -> None:
+        """Replace the window with the newest tweets from the database"""
+        with self.lock:
+            version = self.version
+        rows = db.query(TweetsModel, UserModel.username)\
+            .join(UserModel, TweetsModel.owner_id == UserModel.id)\
+            .order_by(TweetsModel.created_at.desc(), TweetsModel.id.desc())\
+            .limit(self.size + 1)\
+            .all()
+        complete = len(rows) <= self.size
+        rows = rows[:self.size]
+        rows.reverse()
+        with self.lock:
+            if self.version != version:
+                self.stats["skipped_loads"] += 1
+                return
+            self.keys = [(tweet.created_at, tweet.id) for tweet, _ in rows]
+            self.entries = [timeline_entry(tweet, username) for tweet, username in rows]
+            self.complete = complete
+            self.loaded = True
+            self.stats["loads"] += 1
+
+    def page(self, before: Optional[Tuple[datetime, int]], limit: int) -> Optional[Tuple[List[Dict[str, Any]], bool]]:
+        """
+        Up to `limit` tweets older than `before` (or the newest ones), newest first, and whether there are more
+        None if the page doesn't end inside the window and has to be read from the database
+        """
+        with self.lock:
+            if not self.loaded:
+                self.stats["misses"] += 1
+                return None
+            end = len(self.keys) if before is None else bisect_left(self.keys, before)
+            if end < limit and not self.complete:
+                # Part of the page is older than the window
+                self.stats["misses"] += 1
+                return None
+            self.stats["hits"] += 1
+            page = self.entries[max(end - limit, 0):end]
+            # Tweets older than the window exist unless it is complete
+            has_more = end > limit or not self.complete
+        page.reverse()
+        return page, has_more
+
+    def add(self, tweet: TweetsModel, username: str) -> None:
+        """A tweet was created"""
+        key = (tweet.created_at, tweet.id)
+        with self.lock:
+            self.version += 1
+            if (not self.keys or key < self.keys[0]) and not self.complete:
+                # Tweets between it and the window may be missing, the next reload picks it up
+                return
+            if len(self.keys) >= self.size and key < self.keys[0]:
+                # Older than the whole window, not one of the newest
+                self.complete = False
+                return
+            index = bisect_left(self.keys, key)
+            self.keys.insert(index, key)
+            self.entries.insert(index, timeline_entry(tweet, username))
+            if len(self.keys) > self.size:
+                del self.keys[0]
+                del self.entries[0]
+                self.complete = False
+
+    def update(self, tweet: TweetsModel, username: str) -> None:
+        """A tweet's content or owner changed, its position doesn't"""
+        key = (tweet.created_at, tweet.id)
+        with self.lock:
+            self.version += 1
+            index = bisect_left(self.keys, key)
+            if index < len(self.keys) and self.keys[index] == key:
+                self.entries[index] = timeline_entry(tweet, username)
+
+    def remove(self, tweet: TweetsModel) -> None:
+        """A tweet was deleted, the window shrinks until the next reload"""
+        key = (tweet.created_at, tweet.id)
+        with self.lock:
+            self.version += 1
+            index = bisect_left(self.keys, key)
+            if index < len(self.keys) and self.keys[index] == key:
+                del self.keys[index]
+                del self.entries[index]
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                **self.stats,
+                "size": len(self.keys),
+                "max_size": self.size,
+                "complete": self.complete,
+                "oldest": self.keys[0][0].isoformat() if self.keys else None,
+                "refresh_seconds": HOT_TIMELINE_REFRESH_SECONDS,
+            }
+
+# Global hot timeline, read by GET /tweets and written by the tweet write routes
+hot_timeline = HotTimeline()
+
+def start_hot_timeline(session_factory) -> None:
+    """Load the hot timeline and keep reloading it in the background"""
+    db = session_factory()
+    try:
+        hot_timeline.load(db)
+    finally:
+        db.close()
+    if HOT_TIMELINE_REFRESH_SECONDS > 0:
+        threading.Thread(target=_refresh_hot_timeline, args=(session_factory,), daemon=True).start()
+
+def _refresh_hot_timeline(session_factory) -> None:
+    while True:
+        time.sleep(HOT_TIMELINE_REFRESH_SECONDS)
+        db = session_factory()
+        try:
+            hot_timeline.load(db)
+        except Exception as e:
+            print(f"Error reloading the hot timeline: {str(e)}")
+        finally:
+            db.close()
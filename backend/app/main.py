@@ -1,15 +1,23 @@
-from fastapi import FastAPI, Request, Response
+from fastapi import FastAPI
 import uvicorn
 import os
-import time
 import sys
 from pathlib import Path
-from database import engine, Base
+from database import engine, Base, SessionLocal, create_missing_indexes
 from routes import users, tweets, auth, logs, likes
-from middleware import RateLimitMiddleware, RequestCacheMiddleware
-from middleware import cache
-from routes.logs import log_api_call
+from middleware import RateLimitMiddleware, RequestCacheMiddleware, RequestLogMiddleware
+from middleware import cache, vary_counters, rate_limiter
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+from compression import COMPRESSION_MIN_BYTES
+from query_profiler import profiler as query_profiler
+from slow_query_log import slow_query_log
+from pool_metrics import pool_metrics, async_pool_metrics
+from hot_timeline import hot_timeline, start_hot_timeline
+from search_index import search_index, start_search_index, SEARCH_INDEX_PATH
+from hashtags import backfill_tweet_tags
+from trending import trending, start_trending
+from tweet_changes import start_change_pruning
 
 #Add the parent directory to sys.path to make local imports work
 current_dir = Path(__file__).parent
@@ -18,6 +26,14 @@ if str(current_dir) not in sys.path:
 
 
 Base.metadata.create_all(bind=engine)
+create_missing_indexes(engine)
+#Fill in tweet_tags for tweets created before it existed, once per database
+with SessionLocal() as db:
+    backfill_tweet_tags(db)
+start_hot_timeline(SessionLocal)
+start_search_index(SessionLocal)
+start_trending(SessionLocal)
+start_change_pruning(SessionLocal)
 
 debug = os.environ.get("DEBUG", "True").lower() == "true"
 app = FastAPI(debug=debug)
@@ -38,29 +54,16 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["GET", "POST", "PUT", "DELETE"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "Link"], # Timeline pagination
 )
 
-# Log middleware
-@app.middleware("http")
-async def log_requests(request: Request, call_next):
-    # Log the request details
-    start_time = time.time()
-    response = await call_next(request)
-    end_time = time.time()
-    
-    # Log the API call
-    log_api_call(
-        method=request.method,
-        endpoint=request.url.path,
-        status_code=response.status_code,
-        execution_time=end_time - start_time
-    )
-    
-    return response
-
 # add middleware
+app.add_middleware(RequestLogMiddleware)
 app.add_middleware(RateLimitMiddleware)
 app.add_middleware(RequestCacheMiddleware)
+# Compress uncached responses on the fly above the size threshold
+# Cached hits are already compressed by RequestCacheMiddleware and pass through untouched
+app.add_middleware(GZipMiddleware, minimum_size=COMPRESSION_MIN_BYTES)
 
 # include routers
 app.include_router(users.router)
@@ -77,14 +80,76 @@ def read_root():
 @app.get("/debug/cache-stats")
 async def cache_stats():
     """Get current cache statistics for debugging"""
-    stats = {
-        "cache_size": len(cache),
-        "cached_paths": list(set(k.split(':')[1] for k in cache.keys())),
-        "oldest_cache_entry_age": min([time.time() - v["timestamp"] for v in cache.values()]) if cache else 0,
-        "newest_cache_entry_age": max([time.time() - v["timestamp"] for v in cache.values()]) if cache else 0
+    stats = cache.get_stats()
+    stats["cache_size"] = stats["entries"]
+    stats["by_vary_policy"] = {
+        policy: {
+            **counts,
+            "hit_rate_percent": round(counts["hits"] / (counts["hits"] + counts["misses"]) * 100, 2) if counts["hits"] + counts["misses"] else 0
+        }
+        for policy, counts in vary_counters.items()
     }
     return stats
 
+@app.get("/debug/rate-limit-stats")
+async def rate_limit_stats():
+    """Get rate limiter rules, tracked clients and counters"""
+    return rate_limiter.get_stats()
+
+@app.get("/debug/query-stats")
+async def query_stats(sort_by: str = "total_ms", limit: int = 50):
+    """Get per-fingerprint query counts and latency histograms"""
+    return query_profiler.get_stats(sort_by=sort_by, limit=limit)
+
+@app.delete("/debug/query-stats")
+async def reset_query_stats():
+    """Reset the query latency histograms"""
+    query_profiler.reset()
+    return {"status": "query stats reset"}
+
+@app.get("/debug/slow-queries")
+async def slow_queries():
+    """Get the most recent slow queries with their route, parameters and captured plan"""
+    return slow_query_log.get_entries()
+
+@app.delete("/debug/slow-queries")
+async def clear_slow_queries():
+    """Clear the slow query log"""
+    slow_query_log.clear()
+    return {"status": "slow query log cleared"}
+
+@app.get("/debug/db-pool-stats")
+async def db_pool_stats():
+    """Get connection pool usage, checkout wait times and pool events, for the sync and async engines"""
+    return {**pool_metrics.get_stats(), "async": async_pool_metrics.get_stats()}
+
+@app.get("/debug/hot-timeline-stats")
+async def hot_timeline_stats():
+    """Get the in-memory timeline's size, hits and misses and reloads"""
+    return hot_timeline.get_stats()
+
+@app.get("/debug/search-index-stats")
+async def search_index_stats():
+    """Get the search index's size, readiness and rebuild/catch-up counts"""
+    return search_index.get_stats()
+
+@app.get("/debug/trending-stats")
+async def trending_stats():
+    """Get the trending counts' buckets, candidates, sketch memory and catch-up progress"""
+    return trending.get_stats()
+
+@app.post("/debug/rebuild-search-index")
+def rebuild_search_index():
+    """Rebuild the search index from the database, and save it if SEARCH_INDEX_PATH is set"""
+    db = SessionLocal()
+    try:
+        search_index.rebuild(db)
+    finally:
+        db.close()
+    if SEARCH_INDEX_PATH:
+        search_index.save(SEARCH_INDEX_PATH)
+    return search_index.get_stats()
+
 # Add endpoints to monitor database cache
 from database import get_db_cache_stats, clear_db_cache
 
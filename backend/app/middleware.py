@@ -1,126 +1,275 @@
-from fastapi import Request, HTTPException, status
-from starlette.middleware.base import BaseHTTPMiddleware
+from fastapi import status
+from starlette.datastructures import Headers, MutableHeaders
 from starlette.responses import Response
+from starlette.routing import Match
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+import os
 import time
-from collections import defaultdict
+from typing import Optional, Union
+from response_cache import ResponseCache
+from compression import compress_variants, choose_encoding
+from rate_limit import RateLimiter, SharedRateLimiter, create_rate_limiter, client_address
+from routes.logs import log_api_call
+from slow_query_log import current_route
+from pool_metrics import RequestDbTiming, request_db_timing
 
-# Global cache dictionary for storing responses
-# Structure: {request_key: {"response": response_data, "timestamp": timestamp}}
-cache = {}
+# Request cache settings
+REQUEST_CACHE_TTL = 60  # Cache expiration time in seconds
+REQUEST_CACHE_MAX_BYTES = int(os.environ.get("REQUEST_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+
+# Global response cache, a byte-bounded LRU so a crawl over many URLs can't exhaust memory
+cache = ResponseCache(max_bytes=REQUEST_CACHE_MAX_BYTES, ttl=REQUEST_CACHE_TTL)
+
+# Vary policy declared by each route through the X-Cache-Vary response header (see utils.cache_vary)
+# "public" responses are cached once for everyone, "user" responses once per Authorization header
+# Learned once per route template, e.g. /tweets/{tweet_id}, so every id shares it and the map stays as small as the app
+# Structure: {route template: "public" | "user"}
+vary_policies = {}
+DEFAULT_VARY_POLICY = "user"
+
+# Response headers that describe the request that produced a response, not the response itself:
+# the origin's db timings, the surrogate keys the cache server indexes fetches by (it falls back to
+# its per-path keys), cookies and the caller's rate limit state. They are dropped before storing,
+# so a hit doesn't replay another request's values
+PER_REQUEST_HEADERS = {
+    "server-timing", "surrogate-key", "set-cookie",
+    "x-ratelimit-limit", "x-ratelimit-remaining", "x-ratelimit-reset", "retry-after",
+}
+
+def route_template(scope: Scope) -> Optional[str]:
+    """Path template of the route the router will pick for a request, None if no route matches"""
+    for route in scope["app"].router.routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return getattr(route, "path", None)
+    return None
+
+# Hits and misses per vary policy, to see what sharing public entries does to the hit rate
+vary_counters = {
+    "public": {"hits": 0, "misses": 0},
+    "user": {"hits": 0, "misses": 0},
+}
+
+# Global rate limiter, shared so its stats can be read from /debug/rate-limit-stats
+# Cluster-wide when RATE_LIMIT_REDIS_URL points at a shared store
+rate_limiter = create_rate_limiter()
+
+# All middleware here is pure ASGI: it wraps receive/send directly instead of going through
+# BaseHTTPMiddleware, which adds a task and a body stream per request per layer
 
 # Rate limiting middleware to limit the number of requests from a client withing specified time window
-class RateLimitMiddleware(BaseHTTPMiddleware):
-    def __init__(self, app, max_requests: int = 10, window_seconds: int = 60):
-        super().__init__(app)
-        self.max_requests = max_requests
-        self.window_seconds = window_seconds
-        self.request_records = defaultdict(list)
+# Limits are configured per route and method in rate_limit.RATE_LIMIT_RULES
+class RateLimitMiddleware:
+    def __init__(self, app: ASGIApp, limiter: Optional[Union[RateLimiter, SharedRateLimiter]] = None):
+        self.app = app
+        self.limiter = limiter if limiter is not None else rate_limiter
     
-    async def dispatch(self, request: Request, call_next):
-        # Get client IP as identifier
-        client_id = request.client.host
-        
-        # Only rate limit POST/PUT/DELETE requests to tweets
-        if request.url.path.startswith("/tweets") and request.method in ["POST", "PUT", "DELETE"]:
-            current_time = time.time()
-            
-            # Clean up old records
-            self.request_records[client_id] = [
-                timestamp for timestamp in self.request_records[client_id]
-                if current_time - timestamp < self.window_seconds
-            ]
-            
-            # Check if rate limit exceeded
-            if len(self.request_records[client_id]) >= self.max_requests:
-                return Response(
-                    status_code=status.HTTP_429_TOO_MANY_REQUESTS,
-                    content=f"Rate limit exceeded. Try again in {self.window_seconds} seconds."
-                )
-                
-            # Add current request
-            self.request_records[client_id].append(current_time)
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        rule = self.limiter.match(scope["path"], scope["method"])
+        if rule is None:
+            await self.app(scope, receive, send)
+            return
+
+        # Get client IP as identifier, from the forwarding headers when nginx sent the request
+        request_headers = Headers(scope=scope)
+        client_id = client_address(
+            scope["client"][0] if scope.get("client") else None,
+            request_headers.get("x-forwarded-for"),
+            request_headers.get("x-real-ip"),
+        )
+        result = await self.limiter.acquire(client_id, rule)
+        rate_limit_headers = result.headers()
+
+        # Check if rate limit exceeded
+        if not result.allowed:
+            response = Response(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                content=f"Rate limit exceeded. Try again in {rate_limit_headers['Retry-After']} seconds.",
+                headers=rate_limit_headers
+            )
+            await response(scope, receive, send)
+            return
+
+        # Tell clients how much allowance they have left so they can back off before hitting 429s
+        async def send_wrapper(message: Message):
+            if message["type"] == "http.response.start":
+                headers = MutableHeaders(scope=message)
+                for name, value in rate_limit_headers.items():
+                    headers[name] = value
+            await send(message)
         
         # Process the request
-        response = await call_next(request)
-        return response
+        await self.app(scope, receive, send_wrapper)
 
 # Request caching middleware 
 # This middleware will cache GET requests to reduce unnecessary API calls
-class RequestCacheMiddleware(BaseHTTPMiddleware):
-    def __init__(self, app):
-        super().__init__(app)
-        # Initialize the cache dictionary for storing responses
-        global cache
-        self.cache_expiration = 60
+class RequestCacheMiddleware:
+    def __init__(self, app: ASGIApp):
+        self.app = app
     
-    async def dispatch(self, request: Request, call_next):
-        if request.method != "GET":
-            return await call_next(request)
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http" or scope["method"] != "GET":
+            await self.app(scope, receive, send)
+            return
+
+        request_headers = Headers(scope=scope)
+        path = scope["path"]
             
-        # Generate a cache key for this request
-        cache_key = self._generate_cache_key(request)
-        
-        # Check if we have a valid cached response
-        if cache_key in cache:
-            cached_item = cache[cache_key]
-            current_time = time.time()
-              # Check if the cached response is still valid
-            if current_time - cached_item["timestamp"] < self.cache_expiration:
-                print(f"Cache hit for {request.url.path}")
-                # Return the cached response
-                response = Response(
-                    content=cached_item["content"],
-                    status_code=cached_item["status_code"],
-                    headers=cached_item["headers"],
-                    media_type=cached_item["media_type"]
-                )
-                
-                # Ensure the cache header is present even when returning cached response
-                response.headers["X-RequestCache-Status"] = "HIT"
-                print(f"Request cache: Serving {cache_key} from cache")
-                print(f"Response headers include X-RequestCache-Status: HIT")
-                
-                return response
+        # Generate a cache key for this request, using the vary policy the route declared last time
+        route = route_template(scope)
+        vary_policy = vary_policies.get(route, DEFAULT_VARY_POLICY)
+        cache_key = self._generate_cache_key(scope, request_headers, vary_policy)
         
-        response = await call_next(request)
-        
-        # Only cache successful responses
-        if 200 <= response.status_code < 300:
-            content = b""
-            async for chunk in response.body_iterator:
-                content += chunk
-            
-            new_response = Response(
-                content=content,
-                status_code=response.status_code,
-                headers=dict(response.headers),
-                media_type=response.media_type
-            )
-            cache[cache_key] = {
-                "content": content,
-                "status_code": response.status_code,
-                "headers": dict(response.headers),
-                "media_type": response.media_type,
-                "timestamp": time.time()
-            }
-            
-            # Add cache header to indicate this response was cached
-            new_response.headers["X-RequestCache-Status"] = "CACHED"
+        # Check if we have a valid cached response, expired entries are dropped by the lookup
+        lookup_start = time.perf_counter()
+        cached_item = cache.get(cache_key)
+        if cached_item is not None:
+            print(f"Cache hit for {path}")
+            vary_counters[vary_policy]["hits"] += 1
+            # Return the cached response, pre-compressed if the client accepts one of our variants
+            response = self._build_response(request_headers, cached_item.content, cached_item.variants, cached_item.status_code, cached_item.headers, cached_item.media_type)
             
-            # Debug print
-            print(f"Request cache: Added {cache_key} to cache")
-            print(f"Response headers will include X-RequestCache-Status: CACHED")
+            # Ensure the cache header is present even when returning cached response
+            response.headers["X-RequestCache-Status"] = "HIT"
+            # The stored entry has no Server-Timing of its own, this one times the hit
+            response.headers.append("Server-Timing", f"request-cache;desc=hit;dur={(time.perf_counter() - lookup_start) * 1000:.2f}")
+            print(f"Request cache: Serving {cache_key} from cache")
+            print(f"Response headers include X-RequestCache-Status: HIT")
             
-            return new_response
+            await response(scope, receive, send)
+            return
         
-        return response
+        vary_counters[vary_policy]["misses"] += 1
+
+        # Successful responses are held back and buffered so they can be stored,
+        # everything else is passed straight through
+        response_start = None
+        chunks = []
+
+        async def send_wrapper(message: Message):
+            nonlocal response_start
+            if message["type"] == "http.response.start":
+                if 200 <= message["status"] < 300:
+                    response_start = message
+                    return
+            elif message["type"] == "http.response.body" and response_start is not None:
+                chunks.append(message.get("body", b""))
+                if not message.get("more_body", False):
+                    await self._store_and_send(scope, receive, send, request_headers, route, cache_key, vary_policy, response_start, b"".join(chunks))
+                return
+            await send(message)
+
+        await self.app(scope, receive, send_wrapper)
+
+    async def _store_and_send(self, scope: Scope, receive: Receive, send: Send, request_headers: Headers, route: Optional[str], cache_key: str, vary_policy: str, response_start: Message, content: bytes):
+        """Cache a complete successful response and send it to the client"""
+        response_headers = Headers(raw=response_start["headers"])
+
+        # The route may declare a different vary policy than we assumed for the lookup
+        response_policy = response_headers.get("X-Cache-Vary", DEFAULT_VARY_POLICY)
+        if response_policy not in vary_counters:
+            response_policy = DEFAULT_VARY_POLICY
+        if route is not None:
+            vary_policies[route] = response_policy
+        if response_policy != vary_policy:
+            cache_key = self._generate_cache_key(scope, request_headers, response_policy)
+
+        # Compress once here so hits never compress per request
+        # Length and encoding are set per variant when the response is built
+        headers = {
+            name: value for name, value in response_headers.items()
+            if name not in ("content-length", "content-encoding")
+        }
+        stored_headers = {name: value for name, value in headers.items() if name not in PER_REQUEST_HEADERS}
+        variants = {} if "content-encoding" in response_headers else compress_variants(content)
+        status_code = response_start["status"]
+        
+        # This response keeps its own per-request headers, only the stored copy drops them
+        new_response = self._build_response(request_headers, content, variants, status_code, headers, None)
+        cache.set(cache_key, content, status_code, stored_headers, None, variants)
+        
+        # Add cache header to indicate this response was cached
+        new_response.headers["X-RequestCache-Status"] = "CACHED"
+        
+        # Debug print
+        print(f"Request cache: Added {cache_key} to cache")
+        print(f"Response headers will include X-RequestCache-Status: CACHED")
+        
+        await new_response(scope, receive, send)
     
-    def _generate_cache_key(self, request: Request) -> str:
-        """Generate a unique cache key based on method, path, and query params."""
-        path = request.url.path
-        query = request.url.query.decode() if request.url.query else ""
+    def _build_response(self, request_headers: Headers, content: bytes, variants: dict, status_code: int, headers: dict, media_type) -> Response:
+        """Build a response with the stored variant that matches the request's Accept-Encoding"""
+        encoding = choose_encoding(request_headers.get("accept-encoding", ""), list(variants))
+        response = Response(
+            content=variants.get(encoding, content),
+            status_code=status_code,
+            headers=headers,
+            media_type=media_type
+        )
+        # Identity bodies with variants are above the compression threshold, so GZipMiddleware adds Vary to those itself
+        if encoding != "identity":
+            response.headers["Content-Encoding"] = encoding
+            response.headers.add_vary_header("Accept-Encoding")
+        return response
+
+    def _generate_cache_key(self, scope: Scope, request_headers: Headers, vary_policy: str) -> str:
+        """Generate a unique cache key based on method, path, query params and, for per-user routes, the caller."""
+        path = scope["path"]
+        query = scope["query_string"].decode("latin-1")
+        
+        # Include authorization in key to prevent data leakage between users,
+        # unless the route declared that its response is the same for everyone
+        if vary_policy == "public":
+            auth = "public"
+        else:
+            auth = request_headers.get("Authorization", "noauth")
         
-        # Include authorization in key to prevent data leakage between users
-        auth = request.headers.get("Authorization", "noauth")
+        return f"{scope['method']}:{path}:{query}:{auth}"
+
+# Log middleware, records every API call with its status code and execution time
+class RequestLogMiddleware:
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start_time = time.time()
+        status_code = None
+        # Lets the slow query log attribute statements to this request
+        route_token = current_route.set(f"{scope['method']} {scope['path']}")
+        # Time spent waiting for a pool connection and running queries, added up by database.py
+        db_timing = RequestDbTiming()
+        timing_token = request_db_timing.set(db_timing)
+
+        async def send_wrapper(message: Message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                MutableHeaders(scope=message).append(
+                    "Server-Timing",
+                    f"db-wait;dur={db_timing.wait_time * 1000:.2f}, db-query;dur={db_timing.query_time * 1000:.2f}"
+                )
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            current_route.reset(route_token)
+            request_db_timing.reset(timing_token)
         
-        return f"{request.method}:{path}:{query}:{auth}"
\ No newline at end of file
+        # Log the API call
+        log_api_call(
+            method=scope["method"],
+            endpoint=scope["path"],
+            status_code=status_code,
+            execution_time=time.time() - start_time,
+            db_wait_time=db_timing.wait_time,
+            db_query_time=db_timing.query_time
+        )
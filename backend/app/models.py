@@ -1,7 +1,15 @@
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, func
+from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Index, func
+from sqlalchemy.dialects import sqlite
 from sqlalchemy.orm import relationship
 from database import Base 
 
+#SQLite (local testing) stores server_default timestamps as text without microseconds
+#Bound datetimes use the same format so comparisons, like the timeline cursor, match the stored text
+Timestamp = DateTime().with_variant(
+    sqlite.DATETIME(storage_format="%(year)04d-%(month)02d-%(day)02d %(hour)02d:%(minute)02d:%(second)02d"),
+    "sqlite",
+)
+
 class UserModel(Base):
     __tablename__ = "users"
 
@@ -18,8 +26,37 @@ class TweetsModel(Base):
     id = Column(Integer, primary_key=True, index=True)
     content = Column(String)
     owner_id = Column(Integer, ForeignKey("users.id")) #Foreignkey is referencing users.id
-    created_at = Column(DateTime, server_default=func.now())
+    created_at = Column(Timestamp, server_default=func.now())
     tags = Column(String, nullable=True) #Optional field
     likes = Column(Integer, default=0) #Number of likes
 
     owner = relationship("UserModel", back_populates="tweets") #Relationship with the "User" model
+    hashtags = relationship("TweetTagModel", cascade="all, delete-orphan") #Normalized copy of tags, for indexed tag lookups
+
+    __table_args__ = (
+        Index("ix_tweets_created_at_id", "created_at", "id"), #Keyset pagination of the timeline, newest first
+    )
+
+class TweetTagModel(Base):
+    __tablename__ = "tweet_tags"
+
+    #The primary key (tag, tweet_id) is the index for tag lookups, paged in tweet id order
+    tag = Column(String, primary_key=True) #Lowercase, without the #
+    tweet_id = Column(Integer, ForeignKey("tweets.id", ondelete="CASCADE"), primary_key=True, index=True)
+
+class TweetChangeModel(Base):
+    __tablename__ = "tweet_changes"
+
+    #Log of tweet creates and edits, in commit-ish id order, so every replica can catch up with the others' writes
+    id = Column(Integer, primary_key=True)
+    tweet_id = Column(Integer) #No foreign key, the log outlives deleted tweets
+    operation = Column(String) #"create" or "update"
+    added_tags = Column(String, nullable=True) #Space separated lookup form of the tags the write added, for trending
+    changed_at = Column(Timestamp, server_default=func.now(), index=True)
+
+class StartupTaskModel(Base):
+    __tablename__ = "startup_tasks"
+
+    #One-off startup jobs that have completed, so replicas skip them on later startups
+    name = Column(String, primary_key=True)
+    completed_at = Column(Timestamp, server_default=func.now())
@@ -0,0 +1,80 @@
+"""
+Keyset pagination for YAPPER2
+
+Timelines are ordered by (created_at, id) descending. A page is read with
+WHERE (created_at, id) < (last created_at, last id) on the composite index,
+so every page costs the same as the first one, where OFFSET would scan and
+throw away all the rows before it. The position of the last row is handed
+to the client as an opaque cursor. Lists in id order, like tag lookups,
+page the same way on the id alone.
+"""
+
+import base64
+import json
+import os
+from datetime import datetime
+from typing import Optional, Tuple
+from fastapi import HTTPException, Response, status
+from sqlalchemy import tuple_
+
+TIMELINE_PAGE_SIZE = int(os.environ.get("TIMELINE_PAGE_SIZE", 50))
+TIMELINE_MAX_PAGE_SIZE = int(os.environ.get("TIMELINE_MAX_PAGE_SIZE", 200))
+
+def page_size(limit: Optional[int]) -> int:
+    """Requested page size, defaulted and capped server side"""
+    if limit is None or limit < 1:
+        return TIMELINE_PAGE_SIZE
+    return min(limit, TIMELINE_MAX_PAGE_SIZE)
+
+def _encode(values: list) -> str:
+    payload = json.dumps(values, separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+def _decode(cursor: str) -> list:
+    padded = cursor + "=" * (-len(cursor) % 4)
+    return json.loads(base64.urlsafe_b64decode(padded.encode()))
+
+def _invalid_cursor() -> HTTPException:
+    return HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
+
+def encode_cursor(created_at: datetime, id: int) -> str:
+    """Opaque cursor for the position after a row"""
+    return _encode([created_at.isoformat(), id])
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    """(created_at, id) of the row a cursor points after, 400 if it isn't one of ours"""
+    try:
+        created_at, id = _decode(cursor)
+        return datetime.fromisoformat(created_at), int(id)
+    except (ValueError, TypeError):
+        raise _invalid_cursor()
+
+def encode_id_cursor(id: int) -> str:
+    """Opaque cursor for the position after a row in id order"""
+    return _encode([id])
+
+def decode_id_cursor(cursor: str) -> int:
+    """id of the row an id cursor points after, 400 if it isn't one of ours"""
+    try:
+        (id,) = _decode(cursor)
+        return int(id)
+    except (ValueError, TypeError):
+        raise _invalid_cursor()
+
+def before_cursor(created_at_column, id_column, position: Tuple[datetime, int]):
+    """Filter for the rows after a decoded cursor in (created_at, id) descending order"""
+    created_at, id = position
+    # Bound with the columns' types so values compare in the format the columns store
+    position = tuple_(created_at, id, types=[created_at_column.type, id_column.type])
+    return tuple_(created_at_column, id_column) < position
+
+def set_next_cursor(response: Response, path: str, cursor: Optional[str], limit: int):
+    """
+    Hand the next page's cursor to the client in headers, so the body stays a plain list
+    No cursor means this was the last page
+    """
+    if cursor is None:
+        return
+    response.headers["X-Next-Cursor"] = cursor
+    separator = "&" if "?" in path else "?"
+    response.headers["Link"] = f'<{path}{separator}cursor={cursor}&limit={limit}>; rel="next"'
@@ -0,0 +1,132 @@
+"""
+Connection pool metrics for YAPPER2
+
+Counts pool events on database.engine (checkouts, new connections,
+invalidations, checkout timeouts) and times how long each checkout waits for
+a connection. The wait and the time spent in queries are also added up per
+request, so a slow request can be told apart as pool starved or query bound.
+"""
+
+import threading
+import time
+from contextvars import ContextVar
+from typing import Dict, Any, Optional
+from sqlalchemy import event, exc
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+from query_profiler import LatencyHistogram
+
+class RequestDbTiming:
+    """Database time of one request, in seconds"""
+    __slots__ = ("wait_time", "query_time", "queries")
+
+    def __init__(self):
+        self.wait_time = 0.0
+        self.query_time = 0.0
+        self.queries = 0
+
+# Database timing of the request being handled, set by RequestLogMiddleware
+# The copied context in the threadpool shares the same object, so sync routes add to it
+request_db_timing: ContextVar[Optional[RequestDbTiming]] = ContextVar("request_db_timing", default=None)
+
+class PoolMetrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pool = None
+        self.wait_histogram = LatencyHistogram("CHECKOUT", "pool")
+        self.counters = self._empty_counters()
+
+    @staticmethod
+    def _empty_counters() -> Dict[str, int]:
+        return {
+            "checkouts": 0,
+            "checkins": 0,
+            "connects": 0,          # New DBAPI connections opened
+            "invalidations": 0,     # Connections discarded after an error
+            "soft_invalidations": 0,
+            "timeouts": 0,          # Checkouts that gave up after pool_timeout
+        }
+
+    def increment(self, counter: str) -> None:
+        with self.lock:
+            self.counters[counter] += 1
+
+    def record_wait(self, duration: float) -> None:
+        """Record how long one checkout waited for a connection"""
+        with self.lock:
+            self.wait_histogram.record(duration * 1000)
+        timing = request_db_timing.get()
+        if timing is not None:
+            timing.wait_time += duration
+
+    def get_stats(self) -> Dict[str, Any]:
+        pool = self.pool
+        with self.lock:
+            stats = {**self.counters, "checkout_wait": self.wait_histogram.to_dict()}
+        stats["checkout_wait"].pop("operation")
+        stats["checkout_wait"].pop("table")
+        if isinstance(pool, QueuePool):
+            stats.update({
+                "pool_size": pool.size(),
+                "in_use": pool.checkedout(),
+                "idle": pool.checkedin(),
+                # Connections open beyond pool_size, negative while the pool is not full yet
+                "overflow": pool.overflow(),
+                "max_overflow": pool._max_overflow,
+                "timeout_seconds": pool.timeout(),
+            })
+        elif pool is not None:
+            stats["status"] = pool.status()
+        return stats
+
+    def reset(self) -> None:
+        with self.lock:
+            self.counters = self._empty_counters()
+            self.wait_histogram = LatencyHistogram("CHECKOUT", "pool")
+
+# Global pool metrics for database.engine and database.async_engine
+pool_metrics = PoolMetrics()
+async_pool_metrics = PoolMetrics()
+
+class InstrumentedPoolMixin:
+    """Times how long each checkout waits, including opening a new connection"""
+    metrics: PoolMetrics
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            self.metrics.increment("timeouts")
+            raise
+        finally:
+            self.metrics.record_wait(time.perf_counter() - start)
+
+class InstrumentedQueuePool(InstrumentedPoolMixin, QueuePool):
+    metrics = pool_metrics
+
+class InstrumentedAsyncAdaptedQueuePool(InstrumentedPoolMixin, AsyncAdaptedQueuePool):
+    metrics = async_pool_metrics
+
+def instrument_pool(engine, metrics: PoolMetrics = pool_metrics) -> None:
+    """Count pool events on an engine, pass async_engine.sync_engine for an async engine"""
+    metrics.pool = engine.pool
+
+    @event.listens_for(engine, "checkout")
+    def on_checkout(dbapi_connection, connection_record, connection_proxy):
+        metrics.increment("checkouts")
+
+    @event.listens_for(engine, "checkin")
+    def on_checkin(dbapi_connection, connection_record):
+        metrics.increment("checkins")
+
+    @event.listens_for(engine, "connect")
+    def on_connect(dbapi_connection, connection_record):
+        metrics.increment("connects")
+
+    @event.listens_for(engine, "invalidate")
+    def on_invalidate(dbapi_connection, connection_record, exception):
+        metrics.increment("invalidations")
+
+    @event.listens_for(engine, "soft_invalidate")
+    def on_soft_invalidate(dbapi_connection, connection_record, exception):
+        metrics.increment("soft_invalidations")
@@ -0,0 +1,152 @@
+"""
+Query latency profiler for YAPPER2
+
+Statements are fingerprinted by replacing literals and bound parameter
+placeholders with ?, so every execution of the same query shape lands in one
+bucket. Fingerprints are cached per statement text, which SQLAlchemy reuses
+for a compiled statement, so the regexes only run the first time a statement
+is seen. Each fingerprint keeps a count and a fixed-bucket latency histogram.
+"""
+
+import os
+import re
+import threading
+from bisect import bisect_left
+from functools import lru_cache
+from typing import Dict, Any, List, Optional
+
+# Histogram bucket upper bounds in milliseconds, the last bucket catches everything slower
+LATENCY_BUCKETS_MS = [0.1, 0.5, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000]
+
+# Maximum number of fingerprints tracked, queries with new shapes are counted as "other" beyond this
+MAX_FINGERPRINTS = int(os.environ.get("QUERY_PROFILER_MAX_FINGERPRINTS", 500))
+FINGERPRINT_CACHE_SIZE = 4096
+OVERFLOW_FINGERPRINT = "other"
+
+STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+NUMBER_LITERAL = re.compile(r"(?<![\w.])-?\d+(?:\.\d+)?\b")
+PLACEHOLDER = re.compile(r"%\(\w+\)s|%s|\?|(?<!:):\w+")
+IN_LIST = re.compile(r"\bIN\s*\(\s*\?(?:\s*,\s*\?)*\s*\)", re.IGNORECASE)
+VALUES_LIST = re.compile(r"\bVALUES\s*\(\s*\?(?:\s*,\s*\?)*\s*\)(?:\s*,\s*\(\s*\?(?:\s*,\s*\?)*\s*\))*", re.IGNORECASE)
+WHITESPACE = re.compile(r"\s+")
+TABLE_NAME = re.compile(r"\b(?:FROM|INTO|UPDATE|JOIN)\s+\"?([\w.]+)\"?", re.IGNORECASE)
+
+class StatementFingerprint:
+    __slots__ = ("fingerprint", "operation", "table")
+
+    def __init__(self, fingerprint: str, operation: str, table: str):
+        self.fingerprint = fingerprint
+        self.operation = operation
+        self.table = table
+
+@lru_cache(maxsize=FINGERPRINT_CACHE_SIZE)
+def fingerprint_statement(statement: str) -> StatementFingerprint:
+    """Normalize a statement to its shape and find its operation and main table"""
+    normalized = STRING_LITERAL.sub("?", statement)
+    normalized = PLACEHOLDER.sub("?", normalized)
+    normalized = NUMBER_LITERAL.sub("?", normalized)
+    normalized = WHITESPACE.sub(" ", normalized).strip()
+    # Lists of any length are the same query
+    normalized = IN_LIST.sub("IN (...)", normalized)
+    normalized = VALUES_LIST.sub("VALUES (...)", normalized)
+
+    words = normalized.split(" ", 1)
+    operation = words[0].upper() if words[0] else "UNKNOWN"
+    table_match = TABLE_NAME.search(normalized)
+    table = table_match.group(1).lower() if table_match else "UNKNOWN"
+    return StatementFingerprint(normalized, operation, table)
+
+class LatencyHistogram:
+    __slots__ = ("operation", "table", "count", "total", "min", "max", "buckets")
+
+    def __init__(self, operation: str, table: str):
+        self.operation = operation
+        self.table = table
+        self.count = 0
+        self.total = 0.0
+        self.min = float("inf")
+        self.max = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+
+    def record(self, duration_ms: float) -> None:
+        self.count += 1
+        self.total += duration_ms
+        if duration_ms < self.min:
+            self.min = duration_ms
+        if duration_ms > self.max:
+            self.max = duration_ms
+        self.buckets[bisect_left(LATENCY_BUCKETS_MS, duration_ms)] += 1
+
+    def percentile(self, fraction: float) -> float:
+        """Upper bound of the bucket holding the given fraction of executions"""
+        target = fraction * self.count
+        seen = 0
+        for index, bucket_count in enumerate(self.buckets):
+            seen += bucket_count
+            if seen >= target:
+                return LATENCY_BUCKETS_MS[index] if index < len(LATENCY_BUCKETS_MS) else round(self.max, 3)
+        return round(self.max, 3)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "operation": self.operation,
+            "table": self.table,
+            "count": self.count,
+            "total_ms": round(self.total, 3),
+            "avg_ms": round(self.total / self.count, 3) if self.count else 0,
+            "min_ms": round(self.min, 3) if self.count else 0,
+            "max_ms": round(self.max, 3),
+            "p50_ms": self.percentile(0.5),
+            "p95_ms": self.percentile(0.95),
+            "p99_ms": self.percentile(0.99),
+            "histogram": {
+                **{f"le_{bound}ms": count for bound, count in zip(LATENCY_BUCKETS_MS, self.buckets)},
+                f"gt_{LATENCY_BUCKETS_MS[-1]}ms": self.buckets[-1],
+            },
+        }
+
+class QueryProfiler:
+    def __init__(self, max_fingerprints: int = MAX_FINGERPRINTS):
+        self.max_fingerprints = max_fingerprints
+        self.lock = threading.Lock()
+        # Structure: {fingerprint: LatencyHistogram}
+        self.histograms: Dict[str, LatencyHistogram] = {}
+
+    def record(self, statement: str, duration: float) -> StatementFingerprint:
+        """Record one execution, duration in seconds. Returns the statement's fingerprint info"""
+        info = fingerprint_statement(statement)
+        duration_ms = duration * 1000
+        with self.lock:
+            histogram = self.histograms.get(info.fingerprint)
+            if histogram is None:
+                if len(self.histograms) >= self.max_fingerprints:
+                    histogram = self.histograms.get(OVERFLOW_FINGERPRINT)
+                    if histogram is None:
+                        histogram = self.histograms[OVERFLOW_FINGERPRINT] = LatencyHistogram("UNKNOWN", "UNKNOWN")
+                else:
+                    histogram = self.histograms[info.fingerprint] = LatencyHistogram(info.operation, info.table)
+            histogram.record(duration_ms)
+        return info
+
+    def get_stats(self, sort_by: str = "total_ms", limit: Optional[int] = None) -> Dict[str, Any]:
+        """Per-fingerprint stats, slowest in total first"""
+        with self.lock:
+            queries: List[Dict[str, Any]] = [
+                {"fingerprint": fingerprint, **histogram.to_dict()}
+                for fingerprint, histogram in self.histograms.items()
+            ]
+        queries.sort(key=lambda query: query.get(sort_by, 0), reverse=True)
+        return {
+            "fingerprints": len(queries),
+            "total_queries": sum(query["count"] for query in queries),
+            "bucket_bounds_ms": LATENCY_BUCKETS_MS,
+            "fingerprint_cache": fingerprint_statement.cache_info()._asdict(),
+            "queries": queries[:limit] if limit else queries,
+        }
+
+    def reset(self) -> None:
+        with self.lock:
+            self.histograms.clear()
+
+# Global profiler, fed by the cursor events on database.engine
+profiler = QueryProfiler()
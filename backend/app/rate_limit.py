@@ -0,0 +1,360 @@
+"""
+Rate limiting engine for YAPPER2
+
+Token buckets keyed by client and rule. Each check refills the bucket from the
+time elapsed since the last one and takes a token, so checks are O(1) whatever
+the limit or window. Each rule keeps its buckets in least recently used order
+and clients idle for a whole window are evicted from the front, so memory is
+bounded by active clients.
+
+With several backend replicas, SharedRateLimiter takes tokens in batches from
+a shared store (see rate_limit_store.py) so the limit holds across the cluster.
+"""
+
+import ipaddress
+import math
+import os
+import time
+from collections import OrderedDict
+from typing import Dict, Any, List, Optional
+from rate_limit_store import RateLimitStore, RedisRateLimitStore
+
+# All rate limits, checked in order, the first rule matching the path and method applies
+# A rule's methods share one bucket per client, add separate rules for separate limits per method
+RATE_LIMIT_RULES = [
+    {
+        "name": "tweet-writes",
+        "path_prefix": "/tweets",
+        "methods": ("POST", "PUT", "DELETE"),
+        "limit": int(os.environ.get("RATE_LIMIT_TWEET_WRITES", 10)),
+        "window_seconds": int(os.environ.get("RATE_LIMIT_TWEET_WRITES_WINDOW", 60)),
+    },
+]
+
+# Maximum number of client buckets kept per rule, least recently used clients are dropped first
+RATE_LIMIT_MAX_CLIENTS = int(os.environ.get("RATE_LIMIT_MAX_CLIENTS", 100000))
+
+# Shared store for cluster-wide limits, per-replica limits are used when unset
+RATE_LIMIT_REDIS_URL = os.environ.get("RATE_LIMIT_REDIS_URL")
+# Fraction of a rule's limit a replica takes from the shared store at once
+RATE_LIMIT_BATCH_FRACTION = float(os.environ.get("RATE_LIMIT_BATCH_FRACTION", 0.1))
+# Smallest batch, so small limits still batch: the tweet-writes limit of 10 takes 3 tokens at a time, not 1
+# Never more than the rule's limit
+RATE_LIMIT_MIN_BATCH = int(os.environ.get("RATE_LIMIT_MIN_BATCH", 3))
+# Seconds a replica may keep unspent tokens before they are dropped
+# Leases last at least as long as the store takes to refill a batch, so dropped tokens would have refilled
+# anyway and a client writing slower than its limit doesn't lose allowance to them
+RATE_LIMIT_LEASE_SECONDS = float(os.environ.get("RATE_LIMIT_LEASE_SECONDS", 1))
+
+# Proxies whose X-Forwarded-For / X-Real-IP headers are believed, comma separated addresses or networks
+# e.g. "172.28.0.10", the nginx container's fixed address in docker-compose. Only list the proxies
+# themselves: the backends publish ports too, and a direct client connects from the docker network's gateway.
+# Empty trusts none, then every client is its peer address, which behind a proxy is the proxy itself
+RATE_LIMIT_TRUSTED_PROXIES = [
+    ipaddress.ip_network(proxy.strip(), strict=False)
+    for proxy in os.environ.get("RATE_LIMIT_TRUSTED_PROXIES", "").split(",")
+    if proxy.strip()
+]
+
+def is_trusted_proxy(address: str, trusted_proxies=RATE_LIMIT_TRUSTED_PROXIES) -> bool:
+    try:
+        ip = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    return any(ip in network for network in trusted_proxies)
+
+def client_address(peer: Optional[str], forwarded_for: Optional[str], real_ip: Optional[str], trusted_proxies=RATE_LIMIT_TRUSTED_PROXIES) -> str:
+    """
+    Address of the client that made a request, for keying its limits
+    Forwarding headers only count when the peer is a trusted proxy. X-Forwarded-For is read
+    right to left, skipping trusted proxies, so a client can't pick its address by sending its own
+    """
+    if peer is None:
+        return "unknown"
+    if not is_trusted_proxy(peer, trusted_proxies):
+        return peer
+    if forwarded_for:
+        hops = [hop.strip() for hop in forwarded_for.split(",") if hop.strip()]
+        for hop in reversed(hops):
+            if not is_trusted_proxy(hop, trusted_proxies):
+                return hop
+        if hops:
+            return hops[0]
+    if real_ip:
+        return real_ip.strip()
+    return peer
+
+class RateLimitRule:
+    """A limit of `limit` requests per `window_seconds` for matching requests"""
+    __slots__ = ("name", "path_prefix", "methods", "limit", "window_seconds", "refill_rate")
+
+    def __init__(self, name: str, path_prefix: str, methods, limit: int, window_seconds: float):
+        self.name = name
+        self.path_prefix = path_prefix
+        self.methods = frozenset(method.upper() for method in methods)
+        self.limit = limit
+        self.window_seconds = window_seconds
+        # Tokens added per second, a full bucket refills in one window
+        self.refill_rate = limit / window_seconds
+
+    def matches(self, path: str, method: str) -> bool:
+        return method in self.methods and path.startswith(self.path_prefix)
+
+class TokenBucket:
+    __slots__ = ("tokens", "updated", "rule")
+
+    def __init__(self, rule: RateLimitRule, now: float):
+        self.tokens = float(rule.limit)
+        self.updated = now
+        self.rule = rule
+
+    def refill(self, now: float) -> None:
+        rule = self.rule
+        self.tokens = min(rule.limit, self.tokens + (now - self.updated) * rule.refill_rate)
+        self.updated = now
+
+class RateLimitResult:
+    __slots__ = ("allowed", "limit", "remaining", "reset_after", "retry_after")
+
+    def __init__(self, allowed: bool, limit: int, remaining: int, reset_after: float, retry_after: float):
+        self.allowed = allowed
+        self.limit = limit
+        self.remaining = remaining
+        self.reset_after = reset_after      # Seconds until the bucket is full again
+        self.retry_after = retry_after      # Seconds until the next request is allowed, 0 if allowed
+
+    def headers(self) -> Dict[str, str]:
+        """X-RateLimit-* headers, plus Retry-After when the request was rejected"""
+        headers = {
+            "X-RateLimit-Limit": str(self.limit),
+            "X-RateLimit-Remaining": str(self.remaining),
+            "X-RateLimit-Reset": str(math.ceil(self.reset_after)),
+        }
+        if not self.allowed:
+            headers["Retry-After"] = str(math.ceil(self.retry_after))
+        return headers
+
+class RateLimiter:
+    def __init__(self, rules: Optional[List[Dict[str, Any]]] = None, max_clients: int = RATE_LIMIT_MAX_CLIENTS):
+        self.rules = [RateLimitRule(**rule) for rule in (RATE_LIMIT_RULES if rules is None else rules)]
+        self.max_clients = max_clients
+        # Buckets per rule, least recently used clients first
+        self._buckets: Dict[str, "OrderedDict[str, TokenBucket]"] = {rule.name: OrderedDict() for rule in self.rules}
+        self.stats = {
+            "allowed": 0,
+            "rejected": 0,
+            "evicted_idle": 0,
+            "evicted_capacity": 0,
+        }
+
+    def __len__(self) -> int:
+        return sum(len(buckets) for buckets in self._buckets.values())
+
+    def match(self, path: str, method: str) -> Optional[RateLimitRule]:
+        """Return the rule that applies to a request, or None if it is not limited"""
+        for rule in self.rules:
+            if rule.matches(path, method):
+                return rule
+        return None
+
+    def hit(self, client_id: str, rule: RateLimitRule, cost: float = 1) -> RateLimitResult:
+        """Take `cost` tokens from the client's bucket for a rule"""
+        now = time.monotonic()
+        buckets = self._buckets[rule.name]
+        self._evict_idle(rule, buckets, now)
+
+        bucket = buckets.get(client_id)
+        if bucket is None:
+            bucket = TokenBucket(rule, now)
+            buckets[client_id] = bucket
+            if len(buckets) > self.max_clients:
+                buckets.popitem(last=False)
+                self.stats["evicted_capacity"] += 1
+        else:
+            bucket.refill(now)
+            buckets.move_to_end(client_id)
+
+        allowed = bucket.tokens >= cost
+        if allowed:
+            bucket.tokens -= cost
+            self.stats["allowed"] += 1
+            retry_after = 0.0
+        else:
+            self.stats["rejected"] += 1
+            retry_after = (cost - bucket.tokens) / rule.refill_rate
+
+        return RateLimitResult(
+            allowed=allowed,
+            limit=rule.limit,
+            remaining=int(bucket.tokens),
+            reset_after=(rule.limit - bucket.tokens) / rule.refill_rate,
+            retry_after=retry_after,
+        )
+
+    async def acquire(self, client_id: str, rule: RateLimitRule) -> RateLimitResult:
+        """Same as hit, for callers that may also be given a SharedRateLimiter"""
+        return self.hit(client_id, rule)
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "clients": len(self),
+            "max_clients": self.max_clients,
+            "rules": [
+                {"name": rule.name, "path_prefix": rule.path_prefix, "methods": sorted(rule.methods), "limit": rule.limit, "window_seconds": rule.window_seconds}
+                for rule in self.rules
+            ],
+            **self.stats,
+        }
+
+    def _evict_idle(self, rule: RateLimitRule, buckets: "OrderedDict[str, TokenBucket]", now: float) -> None:
+        # A bucket untouched for a whole window is full again and behaves exactly like a new one
+        # Buckets are in last-used order, so idle ones are always at the front
+        # Amortized O(1), each bucket is evicted at most once per use
+        cutoff = now - rule.window_seconds
+        while buckets:
+            client_id, bucket = next(iter(buckets.items()))
+            if bucket.updated > cutoff:
+                break
+            del buckets[client_id]
+            self.stats["evicted_idle"] += 1
+
+class Allowance:
+    """Tokens a replica took from the shared store for one client and rule"""
+    __slots__ = ("tokens", "store_tokens", "expires_at", "retry_at")
+
+    def __init__(self, expires_at: float):
+        self.tokens = 0
+        self.store_tokens = 0.0     # Tokens left in the shared bucket at the last sync
+        self.expires_at = expires_at
+        self.retry_at = 0.0         # The shared bucket is empty until then, reject without asking the store
+
+class SharedRateLimiter:
+    """
+    Cluster-wide limiter. Each replica spends a local allowance and only calls the
+    store to take the next batch, limit * batch_fraction tokens at a time but at
+    least min_batch. Unspent tokens are dropped when their lease expires, so
+    replicas can admit less than the limit but never more. If the store is
+    unreachable the replica falls back to its own per-replica limits.
+    """
+
+    def __init__(self, store: RateLimitStore, rules: Optional[List[Dict[str, Any]]] = None, max_clients: int = RATE_LIMIT_MAX_CLIENTS, batch_fraction: float = RATE_LIMIT_BATCH_FRACTION, lease_seconds: float = RATE_LIMIT_LEASE_SECONDS, min_batch: int = RATE_LIMIT_MIN_BATCH):
+        self.store = store
+        self.fallback = RateLimiter(rules, max_clients)
+        self.rules = self.fallback.rules
+        self.max_clients = max_clients
+        self.batch_fraction = batch_fraction
+        self.lease_seconds = lease_seconds
+        self.min_batch = min_batch
+        # Allowances per rule, in order of expiry
+        self._allowances: Dict[str, "OrderedDict[str, Allowance]"] = {rule.name: OrderedDict() for rule in self.rules}
+        self.stats = {
+            "allowed": 0,
+            "rejected": 0,
+            "local_hits": 0,        # Decided from the local allowance without calling the store
+            "store_calls": 0,
+            "store_errors": 0,
+            "evicted_capacity": 0,
+        }
+
+    def __len__(self) -> int:
+        return sum(len(allowances) for allowances in self._allowances.values())
+
+    def match(self, path: str, method: str) -> Optional[RateLimitRule]:
+        return self.fallback.match(path, method)
+
+    async def acquire(self, client_id: str, rule: RateLimitRule) -> RateLimitResult:
+        """Take one token for the client, from the local allowance or a new batch from the store"""
+        now = time.monotonic()
+        allowances = self._allowances[rule.name]
+        self._evict_expired(allowances, now)
+
+        allowance = allowances.get(client_id)
+        if allowance is not None and allowance.tokens >= 1:
+            allowance.tokens -= 1
+            self.stats["local_hits"] += 1
+            self.stats["allowed"] += 1
+            return self._result(True, rule, allowance)
+        if allowance is not None and allowance.retry_at > now:
+            self.stats["local_hits"] += 1
+            self.stats["rejected"] += 1
+            return self._result(False, rule, allowance)
+
+        batch = self.batch_size(rule)
+        try:
+            granted, store_tokens = await self.store.take(f"{rule.name}:{client_id}", rule.limit, rule.window_seconds, batch)
+        except Exception as e:
+            self.stats["store_errors"] += 1
+            print(f"Rate limit store error, using per-replica limits: {e}")
+            return self.fallback.hit(client_id, rule)
+        self.stats["store_calls"] += 1
+
+        # Other requests for this client may have synced while we waited for the store
+        now = time.monotonic()
+        allowance = allowances.pop(client_id, None)
+        lease_seconds = self.lease(rule)
+        if allowance is None or allowance.expires_at <= now:
+            allowance = Allowance(now + lease_seconds)
+        allowance.expires_at = now + lease_seconds
+        allowance.tokens += granted
+        allowance.store_tokens = store_tokens
+        allowances[client_id] = allowance
+        if len(allowances) > self.max_clients:
+            allowances.popitem(last=False)
+            self.stats["evicted_capacity"] += 1
+
+        if allowance.tokens < 1:
+            allowance.retry_at = now + (1 - store_tokens) / rule.refill_rate
+            self.stats["rejected"] += 1
+            return self._result(False, rule, allowance)
+        allowance.tokens -= 1
+        self.stats["allowed"] += 1
+        return self._result(True, rule, allowance)
+
+    def batch_size(self, rule: RateLimitRule) -> int:
+        """Tokens taken from the store at once for a rule"""
+        return max(1, min(rule.limit, max(self.min_batch, math.ceil(rule.limit * self.batch_fraction))))
+
+    def lease(self, rule: RateLimitRule) -> float:
+        """Seconds unspent tokens are kept, at least the time the store takes to refill a batch"""
+        return max(self.lease_seconds, self.batch_size(rule) / rule.refill_rate)
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "store": type(self.store).__name__,
+            "clients": len(self),
+            "max_clients": self.max_clients,
+            "batch_fraction": self.batch_fraction,
+            "min_batch": self.min_batch,
+            "lease_seconds": self.lease_seconds,
+            "rules": [
+                {**rule_stats, "batch": self.batch_size(rule), "lease_seconds": self.lease(rule)}
+                for rule, rule_stats in zip(self.rules, self.fallback.get_stats()["rules"])
+            ],
+            **self.stats,
+            "fallback": {key: value for key, value in self.fallback.get_stats().items() if key != "rules"},
+        }
+
+    def _result(self, allowed: bool, rule: RateLimitRule, allowance: Allowance) -> RateLimitResult:
+        # Remaining is an estimate, other replicas may have spent from the store since the last sync
+        available = allowance.tokens + allowance.store_tokens
+        return RateLimitResult(
+            allowed=allowed,
+            limit=rule.limit,
+            remaining=int(available),
+            reset_after=max(0.0, rule.limit - available) / rule.refill_rate,
+            retry_after=0.0 if allowed else max(0.0, allowance.retry_at - time.monotonic()),
+        )
+
+    def _evict_expired(self, allowances: "OrderedDict[str, Allowance]", now: float) -> None:
+        # Leases for a rule all last as long, so the ones expiring first are at the front
+        while allowances:
+            client_id, allowance = next(iter(allowances.items()))
+            if allowance.expires_at > now:
+                break
+            del allowances[client_id]
+
+def create_rate_limiter():
+    """Cluster-wide limiter when a shared store is configured, per-replica limiter otherwise"""
+    if RATE_LIMIT_REDIS_URL:
+        return SharedRateLimiter(RedisRateLimitStore(RATE_LIMIT_REDIS_URL))
+    return RateLimiter()
@@ -0,0 +1,91 @@
+"""
+Shared rate limit stores for YAPPER2
+
+A store keeps one token bucket per key that every backend replica takes from,
+so a client gets the configured limit across the cluster instead of once per
+replica. Replicas take tokens in batches (see rate_limit.SharedRateLimiter),
+so the store is only called when a replica's local allowance runs out.
+
+RedisRateLimitStore is used in production, InMemoryRateLimitStore is an
+in-process fake so several limiters can share it on one machine.
+"""
+
+import math
+import time
+from abc import ABC, abstractmethod
+from typing import Dict, List, Tuple
+
+try:
+    import redis.asyncio as aioredis
+except ImportError:  # Optional dependency, only needed for RedisRateLimitStore
+    aioredis = None
+
+class RateLimitStore(ABC):
+    """Interface for a shared token bucket store"""
+
+    @abstractmethod
+    async def take(self, key: str, limit: int, window_seconds: float, requested: int) -> Tuple[int, float]:
+        """
+        Refill the bucket for `key` and take up to `requested` whole tokens atomically.
+        Returns (granted, tokens left in the bucket).
+        """
+
+    async def close(self) -> None:
+        pass
+
+class InMemoryRateLimitStore(RateLimitStore):
+    """In-process fake store, share one instance between limiters to simulate replicas"""
+
+    def __init__(self):
+        # Structure: {key: [tokens, updated]}
+        self.buckets: Dict[str, List[float]] = {}
+        self.calls = 0
+
+    async def take(self, key: str, limit: int, window_seconds: float, requested: int) -> Tuple[int, float]:
+        self.calls += 1
+        now = time.time()
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = [float(limit), now]
+        else:
+            bucket[0] = min(limit, bucket[0] + (now - bucket[1]) * limit / window_seconds)
+            bucket[1] = now
+        granted = min(requested, math.floor(bucket[0]))
+        bucket[0] -= granted
+        return granted, bucket[0]
+
+# Refill and take in one round trip, atomic on the server
+# Uses the server clock so replicas with skewed clocks agree
+TAKE_SCRIPT = """
+local limit = tonumber(ARGV[1])
+local window = tonumber(ARGV[2])
+local requested = tonumber(ARGV[3])
+local now_parts = redis.call('TIME')
+local now = tonumber(now_parts[1]) + tonumber(now_parts[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(state[1]) or limit
+local updated = tonumber(state[2]) or now
+tokens = math.min(limit, tokens + (now - updated) * limit / window)
+local granted = math.min(requested, math.floor(tokens))
+tokens = tokens - granted
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(window))
+return {granted, tostring(tokens)}
+"""
+
+class RedisRateLimitStore(RateLimitStore):
+    """Token buckets in Redis, keys expire after a window without requests"""
+
+    def __init__(self, url: str, key_prefix: str = "ratelimit:"):
+        if aioredis is None:
+            raise RuntimeError("RedisRateLimitStore needs the redis package")
+        self.client = aioredis.from_url(url)
+        self.key_prefix = key_prefix
+        self.script = self.client.register_script(TAKE_SCRIPT)
+
+    async def take(self, key: str, limit: int, window_seconds: float, requested: int) -> Tuple[int, float]:
+        granted, tokens = await self.script(keys=[self.key_prefix + key], args=[limit, window_seconds, requested])
+        return int(granted), float(tokens)
+
+    async def close(self) -> None:
+        await self.client.aclose()
@@ -0,0 +1,135 @@
+"""
+HTTP response cache engine for YAPPER2
+
+Byte-bounded LRU cache used by RequestCacheMiddleware. Lookups, inserts and
+evictions are O(1), entries expire lazily on access and in a periodic sweep,
+and all statistics are kept as counters so reading them costs nothing.
+"""
+
+import time
+from collections import OrderedDict
+from typing import Dict, Any, Optional
+
+# Rough per-entry bookkeeping overhead in bytes (dict, key, entry object)
+ENTRY_OVERHEAD_BYTES = 256
+
+class CachedResponse:
+    """A stored response with its pre-compressed variants, sized once when it is created"""
+    __slots__ = ("content", "variants", "status_code", "headers", "media_type", "timestamp", "size")
+
+    def __init__(self, key: str, content: bytes, status_code: int, headers: Dict[str, str], media_type: Optional[str], variants: Optional[Dict[str, bytes]] = None):
+        self.content = content
+        self.variants = variants or {}
+        self.status_code = status_code
+        self.headers = headers
+        self.media_type = media_type
+        self.timestamp = time.time()
+        self.size = (
+            len(content)
+            + sum(len(body) for body in self.variants.values())
+            + len(key)
+            + sum(len(name) + len(value) for name, value in headers.items())
+            + ENTRY_OVERHEAD_BYTES
+        )
+
+class ResponseCache:
+    def __init__(self, max_bytes: int, ttl: float, sweep_interval: float = 30):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.sweep_interval = sweep_interval
+        # Least recently used entries first
+        self._entries: "OrderedDict[str, CachedResponse]" = OrderedDict()
+        self._last_sweep = time.time()
+        self.current_bytes = 0
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+            "inserts": 0,
+            "evictions": 0,        # Removed to stay within max_bytes
+            "expirations": 0,      # Removed because they outlived the TTL
+            "rejected": 0,         # Too large to ever fit in the budget
+            "evicted_bytes": 0,
+        }
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._entries
+
+    def get(self, key: str) -> Optional[CachedResponse]:
+        """Return a fresh entry and mark it as recently used, or None"""
+        entry = self._entries.get(key)
+        if entry is None:
+            self.stats["misses"] += 1
+            return None
+
+        # Lazy expiry
+        if time.time() - entry.timestamp >= self.ttl:
+            self._remove(key)
+            self.stats["expirations"] += 1
+            self.stats["misses"] += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.stats["hits"] += 1
+        return entry
+
+    def set(self, key: str, content: bytes, status_code: int, headers: Dict[str, str], media_type: Optional[str], variants: Optional[Dict[str, bytes]] = None) -> bool:
+        """Store a response, evicting least recently used entries to stay within the byte budget"""
+        entry = CachedResponse(key, content, status_code, headers, media_type, variants)
+        if entry.size > self.max_bytes:
+            self.stats["rejected"] += 1
+            return False
+
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = entry
+        self.current_bytes += entry.size
+        self.stats["inserts"] += 1
+
+        self._maybe_sweep()
+        while self.current_bytes > self.max_bytes:
+            oldest_key, oldest = self._entries.popitem(last=False)
+            self.current_bytes -= oldest.size
+            self.stats["evictions"] += 1
+            self.stats["evicted_bytes"] += oldest.size
+        return True
+
+    def delete(self, key: str) -> None:
+        if key in self._entries:
+            self._remove(key)
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self.current_bytes = 0
+
+    def expire(self) -> int:
+        """Remove every expired entry, returns how many were removed"""
+        cutoff = time.time() - self.ttl
+        expired = [key for key, entry in self._entries.items() if entry.timestamp <= cutoff]
+        for key in expired:
+            self._remove(key)
+        self.stats["expirations"] += len(expired)
+        self._last_sweep = time.time()
+        return len(expired)
+
+    def get_stats(self) -> Dict[str, Any]:
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return {
+            "entries": len(self._entries),
+            "bytes": self.current_bytes,
+            "max_bytes": self.max_bytes,
+            "ttl_seconds": self.ttl,
+            **self.stats,
+            "hit_rate_percent": round(self.stats["hits"] / lookups * 100, 2) if lookups else 0,
+        }
+
+    def _remove(self, key: str) -> None:
+        entry = self._entries.pop(key)
+        self.current_bytes -= entry.size
+
+    def _maybe_sweep(self) -> None:
+        # Periodic expiry so entries that are never read again don't hold memory until evicted
+        if time.time() - self._last_sweep >= self.sweep_interval:
+            self.expire()
@@ -2,7 +2,10 @@ from fastapi import APIRouter, Depends, Response, status, Request
 import time
 from typing import Dict, Any
 from sqlalchemy.orm import Session
-from database import get_db
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import select
+from database import get_db, get_async_db
+from utils import set_surrogate_keys, cache_vary
 from routes.logs import increment_db_access_count
 import threading
 
@@ -92,8 +95,10 @@ batch_processor_thread = threading.Thread(target=background_batch_processor, dae
 batch_processor_thread.start()
 
 #Endpoint to add a like to a post
+#Sync so a batch write to the database runs in the threadpool instead of blocking the event loop
 @router.post("/{tweet_id}")
-async def add_like(tweet_id: str, db: Session = Depends(get_db)):
+def add_like(tweet_id: str, response: Response, db: Session = Depends(get_db)):
+    set_surrogate_keys(response, f"likes:{tweet_id}")
     #Add the like to the batch
     with batch_lock:
         current_time = time.time()
@@ -115,15 +120,16 @@ async def add_like(tweet_id: str, db: Session = Depends(get_db)):
     return {"message": f"Like added to post {tweet_id}"}
 
 #Endpoint to get current like count for a post (includes pending likes)
-@router.get("/{tweet_id}")
-async def get_likes(tweet_id: str, db: Session = Depends(get_db)):
+@router.get("/{tweet_id}", dependencies=[Depends(cache_vary("public"))])
+async def get_likes(tweet_id: str, response: Response, db: AsyncSession = Depends(get_async_db)):
+    set_surrogate_keys(response, f"likes:{tweet_id}")
     from models import TweetsModel
     
     #Log database access
     increment_db_access_count()
     
     #Get current likes from the database
-    tweet = db.query(TweetsModel).filter(TweetsModel.id == int(tweet_id)).first()
+    tweet = (await db.scalars(select(TweetsModel).filter(TweetsModel.id == int(tweet_id)))).first()
     db_likes = tweet.likes if tweet else 0
     
     #Add any pending likes from the batch
@@ -17,9 +17,9 @@ db_access_logs = []
 MAX_LOGS = 1000 #Maximum number of logs to keep for memory efficiency
 
 #Add a function to log API calls
-def log_api_call(method: str, endpoint: str, status_code: int = 200, execution_time: float = 0):
+def log_api_call(method: str, endpoint: str, status_code: int = 200, execution_time: float = 0, db_wait_time: float = 0, db_query_time: float = 0):
     """
-    Log API calls with method and endpoint
+    Log API calls with method and endpoint, and the time spent waiting for a db connection and in queries
     """
     global api_logs
     timestamp = datetime.now().isoformat()
@@ -28,7 +28,9 @@ def log_api_call(method: str, endpoint: str, status_code: int = 200, execution_t
         "method": method,
         "endpoint": endpoint,
         "status_code": status_code,
-        "execution_time_ms": round(execution_time * 1000, 2)
+        "execution_time_ms": round(execution_time * 1000, 2),
+        "db_wait_ms": round(db_wait_time * 1000, 2),
+        "db_query_ms": round(db_query_time * 1000, 2)
     }
     api_logs.append(log_entry)
     
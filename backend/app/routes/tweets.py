@@ -1,12 +1,20 @@
-from fastapi import APIRouter, Depends, HTTPException, status
-from typing import List
+from fastapi import APIRouter, Depends, HTTPException, Response, status
+from starlette.concurrency import run_in_threadpool
+from typing import List, Optional
+from urllib.parse import quote
 from sqlalchemy.orm import Session
-from sqlalchemy import or_
-from database import get_db
-from models import TweetsModel, UserModel
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import select
+from database import get_db, get_async_db
+from models import TweetsModel, UserModel, TweetTagModel
 from schemas import TweetCreate, TweetResponse
-from utils import get_current_user_id
-import re
+from utils import get_current_user_id, set_surrogate_keys, cache_vary
+from pagination import page_size, encode_cursor, decode_cursor, before_cursor, set_next_cursor, encode_id_cursor, decode_id_cursor
+from hot_timeline import hot_timeline, timeline_entry
+from search_index import search_index, matches
+from hashtags import extract_hashtags, tags_string, normalize_tag, tag_rows, distinct_tags
+from tweet_changes import log_change
+from trending import trending, TRENDING_WINDOWS, TRENDING_DEFAULT_LIMIT, TRENDING_CANDIDATES
 
 router = APIRouter(
     prefix="/tweets",
@@ -14,91 +22,114 @@ router = APIRouter(
 )
 
 # endpoints for tweets, get all tweets, create tweet, edit tweet and delete tweet 
-@router.get("", response_model=List[TweetResponse])
-def read_tweets(db: Session = Depends(get_db), skip: int = None, limit: int = None): # pagination if wanted
-    query = db.query(TweetsModel, UserModel.username.label("username"))\
+# read endpoints use the async session, writes stay on the sync one
+# the timeline is newest first, one page at a time, the next page's cursor is in the X-Next-Cursor header
+# the newest pages come from the in-memory hot timeline, older ones from the database
+@router.get("", response_model=List[TweetResponse], dependencies=[Depends(cache_vary("public"))])
+async def read_tweets(response: Response, db: AsyncSession = Depends(get_async_db), cursor: Optional[str] = None, limit: Optional[int] = None):
+    set_surrogate_keys(response, "timeline")
+    limit = page_size(limit)
+    position = decode_cursor(cursor) if cursor is not None else None
+
+    page = hot_timeline.page(position, limit)
+    if page is not None:
+        tweets, has_more = page
+        if has_more:
+            set_next_cursor(response, "/tweets", encode_cursor(tweets[-1]["created_at"], tweets[-1]["id"]), limit)
+        return tweets
+
+    query = select(TweetsModel, UserModel.username.label("username"))\
         .join(UserModel, TweetsModel.owner_id == UserModel.id)\
-        .offset(skip).limit(limit)
+        .order_by(TweetsModel.created_at.desc(), TweetsModel.id.desc())\
+        .limit(limit + 1) # one extra row tells whether there is a next page
+    if position is not None:
+        query = query.filter(before_cursor(TweetsModel.created_at, TweetsModel.id, position))
         
-    tweets_db = query.all() 
-
-    tweets = []
-    for tweet, username in tweets_db: 
-        tweet_dict = {
-            "id": tweet.id,
-            "content": tweet.content,
-            "owner_id": tweet.owner_id,
-            "created_at": tweet.created_at,
-            "tags": tweet.tags,
-            "username": username
+    tweets_db = (await db.execute(query)).all()
+    if len(tweets_db) > limit:
+        tweets_db = tweets_db[:limit]
+        last_tweet = tweets_db[-1][0]
+        set_next_cursor(response, "/tweets", encode_cursor(last_tweet.created_at, last_tweet.id), limit)
+
+    return [timeline_entry(tweet, username) for tweet, username in tweets_db]
+
+# searching for tweets, every word of the query has to start a word of the tweet, newest first
+@router.get("/search", response_model=List[TweetResponse], dependencies=[Depends(cache_vary("public"))])
+async def search_tweets(query: str, response: Response, db: AsyncSession = Depends(get_async_db), limit: Optional[int] = None):
+    set_surrogate_keys(response, "timeline")
+    limit = page_size(limit)
+    if search_index.ready:
+        # the index lock can be held by a write or a save, so don't wait for it on the event loop
+        tweet_ids = await run_in_threadpool(search_index.search, query, limit)
+        if not tweet_ids:
+            return []
+        search_query = select(TweetsModel, UserModel.username.label("username"))\
+            .join(UserModel, TweetsModel.owner_id == UserModel.id)\
+            .filter(TweetsModel.id.in_(tweet_ids))
+        # drop tweets edited or deleted on another replica since they were indexed
+        found = {
+            tweet.id: timeline_entry(tweet, username)
+            for tweet, username in (await db.execute(search_query)).all()
+            if matches(query, tweet.content)
         }
-        tweets.append(tweet_dict)
-    return tweets
+        return [found[tweet_id] for tweet_id in tweet_ids if tweet_id in found]
 
-# searching for tweets
-@router.get("/search", response_model=List[TweetResponse])
-def search_tweets(query: str, db: Session = Depends(get_db)):
-    search_query = db.query(TweetsModel, UserModel.username.label("username"))\
+    # the index is still being built, scan the tweets instead
+    search_query = select(TweetsModel, UserModel.username.label("username"))\
         .join(UserModel, TweetsModel.owner_id == UserModel.id)\
-        .filter(TweetsModel.content.ilike(f"%{query}%"))
-        
-    tweets_db = search_query.all()
-    
-    # format like in GET tweets
-    tweets = []
-    for tweet, username in tweets_db:
-        tweet_dict = {
-            "id": tweet.id,
-            "content": tweet.content,
-            "owner_id": tweet.owner_id,
-            "created_at": tweet.created_at,
-            "tags": tweet.tags,
-            "username": username
-        }
-        tweets.append(tweet_dict)
-    return tweets
-
-# searching for tags
-@router.get("/search/tags")
-def search_tweets_by_tags(tag: str, db: Session = Depends(get_db)):
-    search_tag = tag if tag.startswith("#") else f"#{tag}"
-    tweets_db = db.query(TweetsModel, UserModel.username.label("username"))\
+        .filter(TweetsModel.content.ilike(f"%{query}%"))\
+        .order_by(TweetsModel.id.desc())\
+        .limit(limit)
+    tweets_db = (await db.execute(search_query)).all()
+    return [timeline_entry(tweet, username) for tweet, username in tweets_db]
+
+# searching for tags, an exact case-insensitive match on the tweet_tags index, in tweet id order
+# paged like the timeline, the next page's cursor is in the X-Next-Cursor header
+@router.get("/search/tags", dependencies=[Depends(cache_vary("public"))])
+async def search_tweets_by_tags(tag: str, response: Response, db: AsyncSession = Depends(get_async_db), cursor: Optional[str] = None, limit: Optional[int] = None):
+    set_surrogate_keys(response, "timeline")
+    limit = page_size(limit)
+    tag_query = select(TweetsModel, UserModel.username.label("username"))\
+        .join(TweetTagModel, TweetTagModel.tweet_id == TweetsModel.id)\
         .join(UserModel, TweetsModel.owner_id == UserModel.id)\
-        .filter(
-            or_(
-                TweetsModel.tags.ilike(f"%{search_tag}%") , 
-                TweetsModel.tags == search_tag , #exact match 
-                TweetsModel.content.ilike(f"%{search_tag}%") #content match
-            )
-        ).all()
+        .filter(TweetTagModel.tag == normalize_tag(tag))\
+        .order_by(TweetTagModel.tweet_id)\
+        .limit(limit + 1)
+    if cursor is not None:
+        tag_query = tag_query.filter(TweetTagModel.tweet_id > decode_id_cursor(cursor))
+    tweets_db = (await db.execute(tag_query)).all()
+    if len(tweets_db) > limit:
+        tweets_db = tweets_db[:limit]
+        set_next_cursor(response, f"/tweets/search/tags?tag={quote(tag)}", encode_id_cursor(tweets_db[-1][0].id), limit)
     # format like in GET tweets
-    tweets = []
-    for tweet, username in tweets_db:
-        tweet_dict = {
-            "id": tweet.id,
-            "content": tweet.content,
-            "owner_id": tweet.owner_id,
-            "created_at": tweet.created_at,
-            "tags": tweet.tags,
-            "username": username
-        }
-        tweets.append(tweet_dict)
-    return tweets
+    return [timeline_entry(tweet, username) for tweet, username in tweets_db]
+
+# most used hashtags in the last 5m, 1h or 24h, estimated in memory by the trending counts
+# declared before /{tweet_id} so "trending" isn't read as a tweet id
+@router.get("/trending", dependencies=[Depends(cache_vary("public"))])
+async def read_trending(response: Response, window: str = "1h", limit: int = TRENDING_DEFAULT_LIMIT):
+    set_surrogate_keys(response, "timeline")
+    if window not in TRENDING_WINDOWS:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"window must be one of {', '.join(TRENDING_WINDOWS)}")
+    limit = min(max(limit, 1), TRENDING_CANDIDATES)
+    return {"window": window, "tags": trending.top(window, limit)}
 
 # get all tweets by user id
 # not used
-@router.get("/user/{user_id}", response_model=List[TweetResponse])
-def read_tweets_by_user(user_id: int, db: Session = Depends(get_db)):
-    tweets = db.query(TweetsModel).filter(TweetsModel.owner_id == user_id).all()
+@router.get("/user/{user_id}", response_model=List[TweetResponse], dependencies=[Depends(cache_vary("public"))])
+async def read_tweets_by_user(user_id: int, response: Response, db: AsyncSession = Depends(get_async_db)):
+    set_surrogate_keys(response, "timeline")
+    tweets = (await db.scalars(select(TweetsModel).filter(TweetsModel.owner_id == user_id))).all()
     if not tweets:
         return {"error": "No tweets found for this user"}
     return tweets
 
 
 # get a tweet by id
-@router.get("/{tweet_id}", response_model=TweetResponse)
-def read_tweet(tweet_id: int, db: Session = Depends(get_db)):
-    tweet = db.query(TweetsModel).filter(TweetsModel.id == tweet_id).first()
+@router.get("/{tweet_id}", response_model=TweetResponse, dependencies=[Depends(cache_vary("public"))])
+async def read_tweet(tweet_id: int, response: Response, db: AsyncSession = Depends(get_async_db)):
+    set_surrogate_keys(response, f"tweet:{tweet_id}")
+    tweet = (await db.scalars(select(TweetsModel).filter(TweetsModel.id == tweet_id))).first()
     if tweet is None:
         return {"error": "Tweet not found"}
     return tweet
@@ -108,31 +139,35 @@ def read_tweet(tweet_id: int, db: Session = Depends(get_db)):
 # when creating a tweet
 
 @router.post("", response_model=TweetResponse)
-def create_tweet(tweet: TweetCreate, db: Session = Depends(get_db), current_user_id: int = Depends(get_current_user_id)):
+def create_tweet(tweet: TweetCreate, response: Response, db: Session = Depends(get_db), current_user_id: int = Depends(get_current_user_id)):
     #regex finds words that start with a hashtag
-    hashtags = re.findall(r'#(\w+)', tweet.content)
-
-    # Adding hashtags to the tags_string to be stored in the database
-    tags_string = " ".join([f"#{tag}" for tag in hashtags])
+    hashtags = extract_hashtags(tweet.content)
 
+    # Adding hashtags to the tags string and the tweet_tags rows to be stored in the database
     tweet = TweetsModel(
         content=tweet.content,
         owner_id=current_user_id, # use id from token
-        tags=tags_string,
+        tags=tags_string(hashtags),
+        hashtags=tag_rows(hashtags),
     )
 
     db.add(tweet)
+    db.flush()
+    # other replicas index the new tweet and count its tags from the change log
+    change_id = log_change(db, tweet.id, "create", distinct_tags(hashtags))
     db.commit()
     db.refresh(tweet)
-    
-    #After creating a tweet, clear the database cache
-    from database import clear_db_cache
-    clear_db_cache()
+    username = db.query(UserModel.username).filter(UserModel.id == current_user_id).scalar()
+    if username is not None:
+        hot_timeline.add(tweet, username)
+    search_index.add(tweet.id, tweet.content)
+    trending.record(change_id, distinct_tags(hashtags))
+    set_surrogate_keys(response, "timeline", f"tweet:{tweet.id}")
     
     return tweet
 
 @router.put("/{tweet_id}")
-def update_tweet(tweet_id: int, tweet_data: TweetCreate, db: Session = Depends(get_db), current_user_id: int = Depends(get_current_user_id)):
+def update_tweet(tweet_id: int, tweet_data: TweetCreate, response: Response, db: Session = Depends(get_db), current_user_id: int = Depends(get_current_user_id)):
     # check if tweet exists
     db_tweet = db.query(TweetsModel).filter(TweetsModel.id == tweet_id).first()
     if not db_tweet:
@@ -144,8 +179,7 @@ def update_tweet(tweet_id: int, tweet_data: TweetCreate, db: Session = Depends(g
             status_code=status.HTTP_403_FORBIDDEN, 
             detail="Not authorized to edit this tweet")
     # extract hashtags from the content like in create_tweet
-    hashtags = re.findall(r'#(\w+)', tweet_data.content)
-    tags_string = " ".join([f"#{tag}" for tag in hashtags])
+    hashtags = extract_hashtags(tweet_data.content)
 
     # get existing tweet from db
     db_tweet = db.query(TweetsModel).filter(TweetsModel.id == tweet_id).first()
@@ -154,24 +188,35 @@ def update_tweet(tweet_id: int, tweet_data: TweetCreate, db: Session = Depends(g
     
 
     # update tweet content and tags
+    old_content = db_tweet.content
+    # tags the edit adds count towards trending, the ones it keeps were counted when they were added
+    old_tags = set(distinct_tags(extract_hashtags(old_content)))
+    added_tags = [tag for tag in distinct_tags(hashtags) if tag not in old_tags]
     db_tweet.content = tweet_data.content
-    db_tweet.tags = tags_string
+    db_tweet.tags = tags_string(hashtags)
+    db_tweet.hashtags = tag_rows(hashtags)
     db_tweet.owner_id = tweet_data.owner_id
+    change_id = log_change(db, tweet_id, "update", added_tags)
 
     # commit changes to db
     db.commit()
     db.refresh(db_tweet)
-    
-    #After updating a tweet, clear the database cache
-    from database import clear_db_cache
-    clear_db_cache()
+    # the owner may have changed, a tweet without a user isn't on the timeline
+    username = db.query(UserModel.username).filter(UserModel.id == db_tweet.owner_id).scalar()
+    if username is not None:
+        hot_timeline.update(db_tweet, username)
+    else:
+        hot_timeline.remove(db_tweet)
+    search_index.update(tweet_id, old_content, db_tweet.content)
+    trending.record(change_id, added_tags)
+    set_surrogate_keys(response, "timeline", f"tweet:{tweet_id}")
     
     return {"message": "Tweet updated successfully"}
 
 
 # delete a tweet
 @router.delete("/{tweet_id}")
-def delete_tweet(tweet_id: int, db: Session = Depends(get_db), current_user_id: int = Depends(get_current_user_id)):
+def delete_tweet(tweet_id: int, response: Response, db: Session = Depends(get_db), current_user_id: int = Depends(get_current_user_id)):
     # check if tweet exists
     db_tweet = db.query(TweetsModel).filter(TweetsModel.id == tweet_id).first()
     if not db_tweet:
@@ -184,10 +229,9 @@ def delete_tweet(tweet_id: int, db: Session = Depends(get_db), current_user_id:
     # delete tweet from db
     db.delete(db_tweet)
     db.commit()
-    
-    # After deleting a tweet, clear the database cache
-    from database import clear_db_cache
-    clear_db_cache()
+    hot_timeline.remove(db_tweet)
+    search_index.remove(tweet_id, db_tweet.content)
+    set_surrogate_keys(response, "timeline", f"tweet:{tweet_id}", f"likes:{tweet_id}")
     
     return {"message": "Tweet deleted successfully"}
 
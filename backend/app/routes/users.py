@@ -1,44 +1,45 @@
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Response
 from typing import List
 from sqlalchemy.orm import Session
-from database import get_db
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import select
+from database import get_db, get_async_db, get_cached_result
 from models import UserModel
 from schemas import UserCreate, UserResponse
-from utils import get_password_hash
+from utils import get_password_hash, set_surrogate_keys, cache_vary
 
 router = APIRouter(
     prefix="/users",
     tags=["users"]
 )
 
-@router.get("", response_model=List[UserResponse])
-def read_users(db: Session = Depends(get_db)):
-    from database import get_cached_query
-    query = db.query(UserModel)
-    users = get_cached_query(query).all()
+@router.get("", response_model=List[UserResponse], dependencies=[Depends(cache_vary("public"))])
+async def read_users(response: Response, db: AsyncSession = Depends(get_async_db)):
+    set_surrogate_keys(response, "users")
+    users = await get_cached_result(db, select(UserModel))
     return users
 
 # searching for users
-@router.get("/search", response_model=List[UserResponse])
-def search_users(query: str, db: Session = Depends(get_db)):
-    from database import get_cached_query
-    search_query = db.query(UserModel).filter(UserModel.username.ilike(f"%{query}%"))
-    users = get_cached_query(search_query).all() 
+@router.get("/search", response_model=List[UserResponse], dependencies=[Depends(cache_vary("public"))])
+async def search_users(query: str, response: Response, db: AsyncSession = Depends(get_async_db)):
+    set_surrogate_keys(response, "users")
+    search_query = select(UserModel).filter(UserModel.username.ilike(f"%{query}%"))
+    users = await get_cached_result(db, search_query)
     return users
 
 #get a user by id
-@router.get("/{user_id}", response_model=UserResponse)
-def read_user(user_id: int, db: Session = Depends(get_db)):
-    from database import get_cached_query
-    query = db.query(UserModel).filter(UserModel.id == user_id)
-    user = get_cached_query(query).first()
+@router.get("/{user_id}", response_model=UserResponse, dependencies=[Depends(cache_vary("public"))])
+async def read_user(user_id: int, response: Response, db: AsyncSession = Depends(get_async_db)):
+    set_surrogate_keys(response, f"user:{user_id}")
+    query = select(UserModel).filter(UserModel.id == user_id)
+    user = await get_cached_result(db, query, "first")
     if user is None:
         return {"error": "User not found"}
     return user
 
 #create account
 @router.post("", response_model=UserResponse)
-def create_user(user: UserCreate, db: Session = Depends(get_db)):
+def create_user(user: UserCreate, response: Response, db: Session = Depends(get_db)):
     # check if user exists
     existing_user = db.query(UserModel).filter(UserModel.username == user.username).first()
     if existing_user:
@@ -56,13 +57,15 @@ def create_user(user: UserCreate, db: Session = Depends(get_db)):
     db.add(db_user)
     db.commit()
     db.refresh(db_user)
+    set_surrogate_keys(response, "users")
 
     return db_user
 
 #not used
 @router.delete("/{user_id}")
-def delete_user(user_id: int, db: Session = Depends(get_db)):
+def delete_user(user_id: int, response: Response, db: Session = Depends(get_db)):
     user = db.query(UserModel).filter(UserModel.id == user_id).first()
     db.delete(user)
     db.commit()
+    set_surrogate_keys(response, "users", f"user:{user_id}", "timeline")
     return {"message": "User deleted successfully"}
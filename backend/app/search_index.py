@@ -0,0 +1,394 @@
+"""
+Full-text search index for YAPPER2
+
+An inverted index from each term to the sorted ids of the tweets containing
+it, stored as compact unsigned int arrays. A query's terms are ANDed, each
+term matches the words it is a prefix of ("hel" finds "hello"), and the
+newest matches come first. Tweet ids are assigned in insertion order, so
+recency is id order and the top k are found by walking the shortest
+posting list from its end.
+
+The index is updated by the tweet write routes, built from the database in
+the background at startup, and optionally saved to SEARCH_INDEX_PATH so a
+restart only has to index the tweets changed since. Tweets created or edited
+on other replicas are read from the tweet_changes log every
+SEARCH_INDEX_REFRESH_SECONDS and indexed with their current content. The
+words an edit removed stay in the index, so results are re-checked against
+the tweets' current content when they are fetched, and edits and deletes
+made elsewhere never show up as wrong matches.
+"""
+
+import json
+import os
+import re
+import struct
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from datetime import timedelta
+from typing import Dict, Any, Iterable, List, Optional, Tuple
+from sqlalchemy.orm import Session
+from models import TweetsModel
+from tweet_changes import ChangeCursor, utc_now, TWEET_CHANGES_RETENTION_SECONDS, TWEET_CHANGES_SETTLE_SECONDS
+
+SEARCH_INDEX_ENABLED = os.environ.get("SEARCH_INDEX_ENABLED", "True").lower() == "true"
+SEARCH_INDEX_PATH = os.environ.get("SEARCH_INDEX_PATH", "")  # Empty to keep the index in memory only
+SEARCH_INDEX_REFRESH_SECONDS = float(os.environ.get("SEARCH_INDEX_REFRESH_SECONDS", 10))
+SEARCH_INDEX_SAVE_SECONDS = float(os.environ.get("SEARCH_INDEX_SAVE_SECONDS", 300))
+# Shorter query terms only match whole words, a one letter prefix would match most of the vocabulary
+SEARCH_MIN_PREFIX_LENGTH = int(os.environ.get("SEARCH_MIN_PREFIX_LENGTH", 2))
+# Most words a prefix expands to, in alphabetical order
+SEARCH_MAX_PREFIX_TERMS = int(os.environ.get("SEARCH_MAX_PREFIX_TERMS", 256))
+MAX_TERM_LENGTH = 64
+BUILD_BATCH_SIZE = 5000
+
+POSTING_TYPE = "I"  # Unsigned 32-bit tweet ids
+INDEX_FILE_VERSION = 2
+TOKEN = re.compile(r"\w+")
+
+def tokenize(text: Optional[str]) -> List[str]:
+    """Lowercased words of a text in order, hashtags without their #"""
+    if not text:
+        return []
+    return [token for token in TOKEN.findall(text.lower()) if len(token) <= MAX_TERM_LENGTH]
+
+def query_terms(query: str) -> List[str]:
+    """Distinct terms of a search query"""
+    return list(dict.fromkeys(tokenize(query)))
+
+def matches(query: str, content: Optional[str]) -> bool:
+    """Whether a text matches a query the way the index matches it"""
+    words = set(tokenize(content))
+    for term in query_terms(query):
+        if term in words:
+            continue
+        if len(term) < SEARCH_MIN_PREFIX_LENGTH or not any(word.startswith(term) for word in words):
+            return False
+    return True
+
+class SearchIndex:
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Structure: {term: array of tweet ids, ascending}
+        self.postings: Dict[str, array] = {}
+        # Every term, sorted, for prefix lookups
+        self.vocabulary: List[str] = []
+        self.documents = 0
+        # Highest tweet id indexed
+        self.max_id = 0
+        # Position in tweet_changes, the creates and edits after it are indexed by catch_up
+        self.changes = ChangeCursor()
+        self.ready = False
+        self.dirty = False
+        # Writes made while a rebuild reads the database, replayed on the new index
+        self.pending: Optional[List[Tuple[str, int, Optional[str]]]] = None
+        self.stats = {"searches": 0, "rebuilds": 0, "catch_ups": 0, "saves": 0, "last_rebuild_seconds": None}
+
+    # Updates, called with the lock held
+
+    def _add(self, tweet_id: int, content: Optional[str]) -> None:
+        added = False
+        for term in set(tokenize(content)):
+            posting = self.postings.get(term)
+            if posting is None:
+                self.postings[term] = array(POSTING_TYPE, [tweet_id])
+                self.vocabulary.insert(bisect_left(self.vocabulary, term), term)
+                added = True
+            elif posting[-1] < tweet_id:
+                # New tweets have the highest ids, so this is almost always an append
+                posting.append(tweet_id)
+                added = True
+            else:
+                index = bisect_left(posting, tweet_id)
+                if index == len(posting) or posting[index] != tweet_id:
+                    posting.insert(index, tweet_id)
+                    added = True
+        if added:
+            self.documents += 1
+        self.max_id = max(self.max_id, tweet_id)
+        self.dirty = True
+
+    def _remove(self, tweet_id: int, content: Optional[str]) -> None:
+        removed = False
+        for term in set(tokenize(content)):
+            posting = self.postings.get(term)
+            if posting is None:
+                continue
+            index = bisect_left(posting, tweet_id)
+            if index < len(posting) and posting[index] == tweet_id:
+                del posting[index]
+                removed = True
+                if not posting:
+                    del self.postings[term]
+                    del self.vocabulary[bisect_left(self.vocabulary, term)]
+        if removed:
+            self.documents -= 1
+        self.dirty = True
+
+    def _record(self, operation: str, tweet_id: int, content: Optional[str]) -> None:
+        if self.pending is not None:
+            self.pending.append((operation, tweet_id, content))
+        if operation == "add":
+            self._add(tweet_id, content)
+        else:
+            self._remove(tweet_id, content)
+
+    def add(self, tweet_id: int, content: Optional[str]) -> None:
+        """A tweet was created"""
+        with self.lock:
+            self._record("add", tweet_id, content)
+
+    def remove(self, tweet_id: int, content: Optional[str]) -> None:
+        """A tweet was deleted, `content` is what it contained"""
+        with self.lock:
+            self._record("remove", tweet_id, content)
+
+    def update(self, tweet_id: int, old_content: Optional[str], new_content: Optional[str]) -> None:
+        """A tweet's content changed"""
+        with self.lock:
+            self._record("remove", tweet_id, old_content)
+            self._record("add", tweet_id, new_content)
+
+    # Queries
+
+    def _term_postings(self, term: str) -> List[array]:
+        """Posting lists of every word a query term matches"""
+        if len(term) < SEARCH_MIN_PREFIX_LENGTH:
+            posting = self.postings.get(term)
+            return [posting] if posting is not None else []
+        start = bisect_left(self.vocabulary, term)
+        words = []
+        for word in self.vocabulary[start:start + SEARCH_MAX_PREFIX_TERMS]:
+            if not word.startswith(term):
+                break
+            words.append(word)
+        return [self.postings[word] for word in words]
+
+    def search(self, query: str, limit: int) -> List[int]:
+        """Ids of the newest `limit` tweets matching every term of the query, newest first"""
+        terms = query_terms(query)
+        if not terms:
+            return []
+        with self.lock:
+            self.stats["searches"] += 1
+            groups = []
+            for term in terms:
+                postings = self._term_postings(term)
+                if not postings:
+                    return []
+                if len(postings) == 1:
+                    groups.append(postings[0])
+                else:
+                    # Union of the words a prefix matches
+                    groups.append(array(POSTING_TYPE, sorted(set().union(*postings))))
+            # Walk the shortest list newest first and check the others with binary search
+            groups.sort(key=len)
+            driver, others = groups[0], groups[1:]
+            results = []
+            for index in range(len(driver) - 1, -1, -1):
+                tweet_id = driver[index]
+                for posting in others:
+                    position = bisect_left(posting, tweet_id)
+                    if position == len(posting) or posting[position] != tweet_id:
+                        break
+                else:
+                    results.append(tweet_id)
+                    if len(results) >= limit:
+                        break
+            return results
+
+    # Building from the database
+
+    def rebuild(self, db: Session) -> None:
+        """Index every tweet in the database, searches keep using the old index meanwhile"""
+        start = time.perf_counter()
+        with self.lock:
+            self.pending = []
+        try:
+            # Changes that may not be visible to the read below are indexed again by the next catch-up
+            self.changes.start_after(db, utc_now() - timedelta(seconds=TWEET_CHANGES_SETTLE_SECONDS))
+            postings: Dict[str, array] = {}
+            documents = 0
+            max_id = 0
+            for tweet_id, content in self._read_tweets(db, 0):
+                terms = set(tokenize(content))
+                for term in terms:
+                    posting = postings.get(term)
+                    if posting is None:
+                        postings[term] = array(POSTING_TYPE, [tweet_id])
+                    else:
+                        posting.append(tweet_id)
+                if terms:
+                    documents += 1
+                max_id = tweet_id
+        except Exception:
+            with self.lock:
+                self.pending = None
+            raise
+
+        vocabulary = sorted(postings)
+        with self.lock:
+            pending, self.pending = self.pending, None
+            self.postings = postings
+            self.vocabulary = vocabulary
+            self.documents = documents
+            self.max_id = max_id
+            for operation, tweet_id, content in pending:
+                self._record(operation, tweet_id, content)
+            self.ready = True
+            self.dirty = True
+            self.stats["rebuilds"] += 1
+            self.stats["last_rebuild_seconds"] = round(time.perf_counter() - start, 3)
+
+    def catch_up(self, db: Session) -> int:
+        """Index the tweets created or edited since the last catch-up, on any replica. Returns how many"""
+        tweet_ids = sorted({change.tweet_id for change in self.changes.read(db)})
+        count = 0
+        for start in range(0, len(tweet_ids), BUILD_BATCH_SIZE):
+            # Deleted tweets are gone, their ids are dropped from results when they are fetched
+            tweets = db.query(TweetsModel.id, TweetsModel.content)\
+                .filter(TweetsModel.id.in_(tweet_ids[start:start + BUILD_BATCH_SIZE]))\
+                .all()
+            with self.lock:
+                # Adding is idempotent, tweets this replica wrote itself are already indexed
+                for tweet_id, content in tweets:
+                    self._record("add", tweet_id, content)
+            count += len(tweets)
+        if count:
+            with self.lock:
+                self.stats["catch_ups"] += 1
+        return count
+
+    @staticmethod
+    def _read_tweets(db: Session, after_id: int) -> Iterable[Tuple[int, Optional[str]]]:
+        """(id, content) of tweets with ids above `after_id`, in id order, a batch at a time"""
+        while True:
+            batch = db.query(TweetsModel.id, TweetsModel.content)\
+                .filter(TweetsModel.id > after_id)\
+                .order_by(TweetsModel.id)\
+                .limit(BUILD_BATCH_SIZE)\
+                .all()
+            for tweet_id, content in batch:
+                yield tweet_id, content
+            if len(batch) < BUILD_BATCH_SIZE:
+                return
+            after_id = batch[-1][0]
+
+    # Persistence
+    # File layout: 4-byte header length, JSON header with the terms and their posting lengths, then the postings
+
+    def save(self, path: str) -> None:
+        """Write the index to disk, replacing the previous file in one step"""
+        with self.lock:
+            terms = list(self.vocabulary)
+            lengths = [len(self.postings[term]) for term in terms]
+            data = b"".join(self.postings[term].tobytes() for term in terms)
+            header = json.dumps({
+                "version": INDEX_FILE_VERSION,
+                "itemsize": array(POSTING_TYPE).itemsize,
+                "documents": self.documents,
+                "max_id": self.max_id,
+                "last_change_id": self.changes.last_id,
+                "saved_at": time.time(),
+                "terms": terms,
+                "lengths": lengths,
+            }).encode()
+            self.dirty = False
+        temporary_path = f"{path}.tmp"
+        with open(temporary_path, "wb") as file:
+            file.write(struct.pack("<I", len(header)))
+            file.write(header)
+            file.write(data)
+        os.replace(temporary_path, path)
+        with self.lock:
+            self.stats["saves"] += 1
+
+    def load(self, path: str) -> bool:
+        """Read an index saved by save(), False if there is none or it can't be used"""
+        try:
+            with open(path, "rb") as file:
+                (header_length,) = struct.unpack("<I", file.read(4))
+                header = json.loads(file.read(header_length))
+                data = file.read()
+        except (OSError, ValueError, struct.error):
+            return False
+        itemsize = array(POSTING_TYPE).itemsize
+        if header.get("version") != INDEX_FILE_VERSION or header.get("itemsize") != itemsize:
+            return False
+        # The changes since it was saved may have been pruned from tweet_changes
+        if time.time() - header["saved_at"] > TWEET_CHANGES_RETENTION_SECONDS - TWEET_CHANGES_SETTLE_SECONDS:
+            return False
+
+        postings = {}
+        offset = 0
+        for term, length in zip(header["terms"], header["lengths"]):
+            posting = array(POSTING_TYPE)
+            posting.frombytes(data[offset:offset + length * itemsize])
+            postings[term] = posting
+            offset += length * itemsize
+        if offset != len(data):
+            return False
+
+        with self.lock:
+            self.postings = postings
+            self.vocabulary = list(header["terms"])
+            self.documents = header["documents"]
+            self.max_id = header["max_id"]
+            self.ready = True
+            self.dirty = False
+        self.changes.reset(header["last_change_id"])
+        return True
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                **self.stats,
+                "enabled": SEARCH_INDEX_ENABLED,
+                "ready": self.ready,
+                "documents": self.documents,
+                "terms": len(self.vocabulary),
+                "postings": sum(len(posting) for posting in self.postings.values()),
+                "max_id": self.max_id,
+                **self.changes.get_stats(),
+                "path": SEARCH_INDEX_PATH or None,
+            }
+
+# Global search index, read by GET /tweets/search and written by the tweet write routes
+search_index = SearchIndex()
+
+def start_search_index(session_factory) -> None:
+    """Load or build the search index in the background and keep it up to date"""
+    if SEARCH_INDEX_ENABLED:
+        threading.Thread(target=_maintain_search_index, args=(session_factory,), daemon=True).start()
+
+def _maintain_search_index(session_factory) -> None:
+    db = session_factory()
+    try:
+        if SEARCH_INDEX_PATH and search_index.load(SEARCH_INDEX_PATH):
+            search_index.catch_up(db)
+        else:
+            search_index.rebuild(db)
+            if SEARCH_INDEX_PATH:
+                search_index.save(SEARCH_INDEX_PATH)
+    except Exception as e:
+        print(f"Error building the search index: {str(e)}")
+    finally:
+        db.close()
+
+    last_save = time.time()
+    while SEARCH_INDEX_REFRESH_SECONDS > 0:
+        time.sleep(SEARCH_INDEX_REFRESH_SECONDS)
+        db = session_factory()
+        try:
+            if not search_index.ready:
+                search_index.rebuild(db)
+            else:
+                search_index.catch_up(db)
+            if SEARCH_INDEX_PATH and search_index.dirty and time.time() - last_save >= SEARCH_INDEX_SAVE_SECONDS:
+                search_index.save(SEARCH_INDEX_PATH)
+                last_save = time.time()
+        except Exception as e:
+            print(f"Error refreshing the search index: {str(e)}")
+        finally:
+            db.close()
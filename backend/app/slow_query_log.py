@@ -0,0 +1,148 @@
+"""
+Slow query log for YAPPER2
+
+Statements executed through database.engine or database.async_engine that
+take longer than SLOW_QUERY_THRESHOLD_MS are kept in a bounded ring with their
+parameters, the route that issued them and their duration. The first time a
+fingerprint is slow, its plan is captured with EXPLAIN on a background thread,
+so the request that ran the slow statement doesn't wait for it. EXPLAIN runs
+through the engine that ran the statement, whose driver its SQL and
+parameters were written for.
+"""
+
+import asyncio
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar
+from datetime import datetime
+from typing import Dict, Any, List, Optional
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import NullPool
+
+SLOW_QUERY_THRESHOLD_MS = float(os.environ.get("SLOW_QUERY_THRESHOLD_MS", 200))
+SLOW_QUERY_LOG_SIZE = int(os.environ.get("SLOW_QUERY_LOG_SIZE", 200))
+SLOW_QUERY_EXPLAIN = os.environ.get("SLOW_QUERY_EXPLAIN", "True").lower() == "true"
+# EXPLAIN ANALYZE runs the statement again, so it is off by default and only used for SELECTs
+SLOW_QUERY_EXPLAIN_ANALYZE = os.environ.get("SLOW_QUERY_EXPLAIN_ANALYZE", "False").lower() == "true"
+MAX_PARAMETERS_LENGTH = 500
+MAX_EXPLAINED_FINGERPRINTS = 1000
+
+# Route of the request being handled, set by RequestLogMiddleware
+# Context variables are copied into the threadpool that runs sync routes
+current_route: ContextVar[str] = ContextVar("current_route", default="")
+
+class SlowQueryLog:
+    def __init__(self, threshold_ms: float = SLOW_QUERY_THRESHOLD_MS, size: int = SLOW_QUERY_LOG_SIZE, explain: bool = SLOW_QUERY_EXPLAIN, explain_analyze: bool = SLOW_QUERY_EXPLAIN_ANALYZE):
+        self.threshold_ms = threshold_ms
+        self.explain = explain
+        self.explain_analyze = explain_analyze
+        self.lock = threading.Lock()
+        self.entries = deque(maxlen=size)
+        # Plans by fingerprint, None while the EXPLAIN is still running or if it failed
+        # Structure: {fingerprint: {"plan": [...] or None, "error": str or None, "driver": str, "captured_at": str}}
+        self.plans: Dict[str, Dict[str, Any]] = {}
+        self.total_slow = 0
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    def maybe_record(self, engine, statement: str, parameters, duration: float, fingerprint: str, operation: str, executemany: bool) -> None:
+        """Record the statement if it was slow, and capture its plan the first time its fingerprint is"""
+        duration_ms = duration * 1000
+        if duration_ms < self.threshold_ms or operation == "EXPLAIN":
+            return
+
+        entry = {
+            "timestamp": datetime.now().isoformat(),
+            "duration_ms": round(duration_ms, 2),
+            "route": current_route.get(),
+            "fingerprint": fingerprint,
+            "statement": statement,
+            "parameters": repr(parameters)[:MAX_PARAMETERS_LENGTH],
+        }
+        with self.lock:
+            self.entries.append(entry)
+            self.total_slow += 1
+            first_occurrence = fingerprint not in self.plans and len(self.plans) < MAX_EXPLAINED_FINGERPRINTS
+            if first_occurrence:
+                self.plans[fingerprint] = {"plan": None, "error": None, "driver": None, "captured_at": None}
+        print(f"Slow query ({entry['duration_ms']}ms) from {entry['route'] or 'no route'}: {fingerprint[:100]}")
+
+        if first_occurrence and self.explain and not executemany and operation in ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH"):
+            self._get_executor().submit(self._explain, engine, statement, parameters, fingerprint, operation)
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="slow-query-explain")
+        return self._executor
+
+    def _explain(self, engine, statement: str, parameters, fingerprint: str, operation: str) -> None:
+        """Run EXPLAIN for a statement with its original parameters, on the background thread"""
+        if engine.dialect.name == "postgresql":
+            analyze = self.explain_analyze and operation in ("SELECT", "WITH")
+            prefix = "EXPLAIN (ANALYZE, BUFFERS) " if analyze else "EXPLAIN "
+        elif engine.dialect.name == "sqlite":
+            prefix = "EXPLAIN QUERY PLAN "
+        else:
+            prefix = "EXPLAIN "
+
+        plan = None
+        error = None
+        try:
+            if engine.dialect.is_async:
+                plan = asyncio.run(self._explain_async(engine, prefix + statement, parameters))
+            else:
+                with engine.connect() as conn:
+                    result = conn.exec_driver_sql(prefix + statement, parameters)
+                    plan = [" | ".join(str(value) for value in row) for row in result]
+                    conn.rollback()
+        except Exception as e:
+            error = str(e)
+            print(f"EXPLAIN failed for slow query {fingerprint[:100]}: {e}")
+
+        with self.lock:
+            self.plans[fingerprint] = {
+                "plan": plan,
+                "error": error,
+                "driver": engine.dialect.driver,
+                "captured_at": datetime.now().isoformat(),
+            }
+
+    async def _explain_async(self, engine, statement: str, parameters) -> List[str]:
+        """
+        EXPLAIN for a statement from the async engine, on this thread's own event loop
+        Pooled async connections belong to the app's event loop, so it connects without a pool
+        """
+        explain_engine = create_async_engine(engine.url, poolclass=NullPool)
+        try:
+            async with explain_engine.connect() as conn:
+                result = await conn.exec_driver_sql(statement, parameters)
+                plan = [" | ".join(str(value) for value in row) for row in result]
+                await conn.rollback()
+            return plan
+        finally:
+            await explain_engine.dispose()
+
+    def get_entries(self) -> Dict[str, Any]:
+        """Slow queries, newest first, with the captured plan for each fingerprint"""
+        with self.lock:
+            entries: List[Dict[str, Any]] = list(reversed(self.entries))
+            plans = dict(self.plans)
+            total_slow = self.total_slow
+        return {
+            "threshold_ms": self.threshold_ms,
+            "explain": self.explain,
+            "explain_analyze": self.explain_analyze,
+            "capacity": self.entries.maxlen,
+            "total_slow_queries": total_slow,
+            "entries": [{**entry, "explain": plans.get(entry["fingerprint"])} for entry in entries],
+        }
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+            self.plans.clear()
+            self.total_slow = 0
+
+# Global slow query log, fed by the cursor events on database.engine and database.async_engine
+slow_query_log = SlowQueryLog()
@@ -0,0 +1,246 @@
+"""
+Trending hashtags for YAPPER2
+
+Counts hashtag uses over sliding 5 minute, 1 hour and 24 hour windows in
+bounded memory. Each window is split into TRENDING_BUCKETS time buckets,
+each with a count-min sketch, and keeps the sum of its live buckets' sketches
+so a tag's estimate costs TRENDING_DEPTH lookups. When a bucket falls out of
+the window its sketch is subtracted from the sum. Next to the sketch each
+window keeps the TRENDING_CANDIDATES tags with the highest estimates, so the
+trending list is read from that small set, never from the database.
+
+Tags are counted when a tweet is created and when an edit adds them. Writes
+on every replica are read from the tweet_changes log, which records the tags
+each write added, every TRENDING_REFRESH_SECONDS. Changes this replica
+already counted are skipped, and the state is rebuilt from the last 24 hours
+of the log at startup. Counts are estimates: the sketch can only overcount,
+by at most about total / TRENDING_WIDTH per tag with high probability.
+"""
+
+import os
+import threading
+import time
+from array import array
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Any, Iterable, List, Optional, Set
+from sqlalchemy.orm import Session
+from tweet_changes import ChangeCursor, added_tags, utc_now
+
+TRENDING_WIDTH = int(os.environ.get("TRENDING_WIDTH", 2048))
+TRENDING_DEPTH = int(os.environ.get("TRENDING_DEPTH", 4))
+TRENDING_BUCKETS = int(os.environ.get("TRENDING_BUCKETS", 30))
+TRENDING_CANDIDATES = int(os.environ.get("TRENDING_CANDIDATES", 100))
+TRENDING_REFRESH_SECONDS = float(os.environ.get("TRENDING_REFRESH_SECONDS", 5))
+TRENDING_DEFAULT_LIMIT = 10
+
+# Window name -> length in seconds
+TRENDING_WINDOWS = {"5m": 5 * 60, "1h": 60 * 60, "24h": 24 * 60 * 60}
+
+def to_timestamp(created_at: Optional[datetime]) -> float:
+    """Seconds since the epoch of a created_at value, which is stored in UTC without a timezone"""
+    if created_at is None:
+        return time.time()
+    if created_at.tzinfo is None:
+        created_at = created_at.replace(tzinfo=timezone.utc)
+    return created_at.timestamp()
+
+class CountMinSketch:
+    __slots__ = ("width", "depth", "counts")
+
+    def __init__(self, width: int = TRENDING_WIDTH, depth: int = TRENDING_DEPTH):
+        self.width = width
+        self.depth = depth
+        self.counts = array("q", bytes(8 * width * depth))
+
+    def _cells(self, key: str) -> List[int]:
+        return [row * self.width + hash((row, key)) % self.width for row in range(self.depth)]
+
+    def add(self, key: str, count: int = 1) -> int:
+        """Add to a key's count, returns its new estimate"""
+        counts = self.counts
+        estimate = None
+        for cell in self._cells(key):
+            counts[cell] += count
+            if estimate is None or counts[cell] < estimate:
+                estimate = counts[cell]
+        return estimate
+
+    def estimate(self, key: str) -> int:
+        counts = self.counts
+        return min(counts[cell] for cell in self._cells(key))
+
+    def subtract(self, other: "CountMinSketch") -> None:
+        """Remove another sketch's counts, it must have been added to this one"""
+        counts = self.counts
+        for cell, count in enumerate(other.counts):
+            if count:
+                counts[cell] -= count
+
+class SlidingWindow:
+    """Approximate tag counts over the last `seconds`, with the candidates for the top tags"""
+
+    def __init__(self, seconds: int, buckets: int = TRENDING_BUCKETS, candidates: int = TRENDING_CANDIDATES):
+        self.seconds = seconds
+        self.bucket_seconds = seconds / buckets
+        self.bucket_count = buckets
+        self.max_candidates = candidates
+        # Structure: {bucket number: sketch of the uses in that bucket}
+        self.buckets: Dict[int, CountMinSketch] = {}
+        # Sum of the live buckets
+        self.total = CountMinSketch()
+        # Structure: {tag: estimate}
+        self.candidates: Dict[str, int] = {}
+        # Candidates ranked, rebuilt on the first read after a change
+        self.top: Optional[List[Dict[str, Any]]] = None
+
+    def _advance(self, current: int) -> None:
+        """Drop the buckets that have left the window and re-estimate the candidates"""
+        expired = [number for number in self.buckets if number <= current - self.bucket_count]
+        if not expired:
+            return
+        for number in expired:
+            self.total.subtract(self.buckets.pop(number))
+        estimates = {tag: self.total.estimate(tag) for tag in self.candidates}
+        self.candidates = {tag: count for tag, count in estimates.items() if count > 0}
+        self.top = None
+
+    def add(self, tag: str, timestamp: float, now: float) -> None:
+        current = int(now // self.bucket_seconds)
+        self._advance(current)
+        # A clock ahead of ours counts in the current bucket
+        number = min(int(timestamp // self.bucket_seconds), current)
+        if number <= current - self.bucket_count:
+            return  # Older than the window
+        bucket = self.buckets.get(number)
+        if bucket is None:
+            bucket = self.buckets[number] = CountMinSketch()
+        bucket.add(tag)
+        estimate = self.total.add(tag)
+
+        if tag not in self.candidates and len(self.candidates) >= self.max_candidates:
+            weakest = min(self.candidates, key=self.candidates.get)
+            if estimate <= self.candidates[weakest]:
+                return
+            del self.candidates[weakest]
+        self.candidates[tag] = estimate
+        self.top = None
+
+    def get_top(self, now: float) -> List[Dict[str, Any]]:
+        """Candidates by estimated count, highest first"""
+        self._advance(int(now // self.bucket_seconds))
+        if self.top is None:
+            ranked = sorted(self.candidates.items(), key=lambda item: (-item[1], item[0]))
+            self.top = [{"tag": tag, "count": count} for tag, count in ranked]
+        return self.top
+
+class Trending:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.windows = {name: SlidingWindow(seconds) for name, seconds in TRENDING_WINDOWS.items()}
+        # Position in tweet_changes, the changes after it are counted by catch_up
+        self.changes = ChangeCursor()
+        # Changes the cursor hasn't passed yet that were already counted, from the write path or a catch-up
+        self.counted_ids: Set[int] = set()
+        # Only tracked while something catches up, otherwise counted_ids would only grow
+        self.track_counted = False
+        self.ready = False
+        self.stats = {"changes": 0, "uses": 0, "rebuilds": 0, "catch_ups": 0}
+
+    def _count(self, change_id: int, tags: Iterable[str], changed_at: Optional[datetime]) -> None:
+        """Count the tags a change added once, the lock must be held"""
+        if change_id <= self.changes.last_id or change_id in self.counted_ids:
+            return
+        if self.track_counted:
+            self.counted_ids.add(change_id)
+        self._count_tags(tags, changed_at)
+
+    def _count_tags(self, tags: Iterable[str], changed_at: Optional[datetime]) -> None:
+        timestamp = to_timestamp(changed_at)
+        now = time.time()
+        uses = 0
+        for tag in tags:
+            for window in self.windows.values():
+                window.add(tag, timestamp, now)
+            uses += 1
+        self.stats["changes"] += 1
+        self.stats["uses"] += uses
+
+    def record(self, change_id: int, tags: Iterable[str], changed_at: Optional[datetime] = None) -> None:
+        """A tweet was created or edited, `tags` are the normalized tags it added"""
+        tags = list(tags)
+        if not tags:
+            return
+        with self.lock:
+            self._count(change_id, tags, changed_at)
+
+    def top(self, window: str, limit: int = TRENDING_DEFAULT_LIMIT) -> List[Dict[str, Any]]:
+        """The most used tags in a window, highest estimate first"""
+        with self.lock:
+            return self.windows[window].get_top(time.time())[:limit]
+
+    def rebuild(self, db: Session) -> None:
+        """Replace the counts with the changes of the longest window"""
+        with self.lock:
+            self.windows = {name: SlidingWindow(seconds) for name, seconds in TRENDING_WINDOWS.items()}
+            self.counted_ids.clear()
+            self.changes.start_after(db, utc_now() - timedelta(seconds=max(TRENDING_WINDOWS.values())))
+            self.stats["rebuilds"] += 1
+        self.catch_up(db)
+        self.ready = True
+
+    def catch_up(self, db: Session) -> None:
+        """Count the tags added since the last catch-up, on any replica"""
+        changes = self.changes.read(db)
+        with self.lock:
+            for change in changes:
+                tags = added_tags(change)
+                if tags and change.id not in self.counted_ids:
+                    # The cursor has moved past it already, so _count's check doesn't apply
+                    self.counted_ids.add(change.id)
+                    self._count_tags(tags, change.changed_at)
+            self.counted_ids = {change_id for change_id in self.counted_ids if change_id > self.changes.last_id}
+            self.stats["catch_ups"] += 1
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                **self.stats,
+                "ready": self.ready,
+                **self.changes.get_stats(),
+                "windows": {
+                    name: {"buckets": len(window.buckets), "candidates": len(window.candidates)}
+                    for name, window in self.windows.items()
+                },
+                "sketch_bytes": sum((len(window.buckets) + 1) * TRENDING_WIDTH * TRENDING_DEPTH * 8 for window in self.windows.values()),
+                "refresh_seconds": TRENDING_REFRESH_SECONDS,
+            }
+
+# Global trending counts, fed by POST /tweets and PUT /tweets/{id} and read by GET /tweets/trending
+trending = Trending()
+
+def start_trending(session_factory) -> None:
+    """Rebuild the trending counts in the background and keep catching up with new tweets"""
+    trending.track_counted = TRENDING_REFRESH_SECONDS > 0
+    threading.Thread(target=_maintain_trending, args=(session_factory,), daemon=True).start()
+
+def _maintain_trending(session_factory) -> None:
+    db = session_factory()
+    try:
+        trending.rebuild(db)
+    except Exception as e:
+        print(f"Error rebuilding the trending counts: {str(e)}")
+    finally:
+        db.close()
+
+    while TRENDING_REFRESH_SECONDS > 0:
+        time.sleep(TRENDING_REFRESH_SECONDS)
+        db = session_factory()
+        try:
+            if not trending.ready:
+                trending.rebuild(db)
+            else:
+                trending.catch_up(db)
+        except Exception as e:
+            print(f"Error catching up the trending counts: {str(e)}")
+        finally:
+            db.close()
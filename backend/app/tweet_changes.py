@@ -0,0 +1,140 @@
+"""
+Tweet change log for YAPPER2
+
+Every tweet create and edit adds a tweet_changes row in the same transaction,
+with the tags it added. Each replica's search index and trending counts read
+the log in id order to pick up writes made on the other replicas, edits of
+old tweets included.
+
+Ids are handed out when rows are inserted, not when they are committed, so a
+lower id can become visible after a higher one. ChangeCursor doesn't move its
+watermark past a missing id until TWEET_CHANGES_SETTLE_SECONDS have passed,
+either since it first noticed the gap or since the row after the gap was
+written. The rows above the gap are read again meanwhile and skipped if they
+were already returned. Rows older than TWEET_CHANGES_RETENTION_SECONDS are
+pruned.
+"""
+
+import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterable, List, Optional, Set
+from sqlalchemy import Row, func
+from sqlalchemy.orm import Session
+from models import TweetChangeModel
+
+TWEET_CHANGES_SETTLE_SECONDS = float(os.environ.get("TWEET_CHANGES_SETTLE_SECONDS", 60))
+TWEET_CHANGES_RETENTION_SECONDS = float(os.environ.get("TWEET_CHANGES_RETENTION_SECONDS", 2 * 24 * 60 * 60))
+TWEET_CHANGES_PRUNE_SECONDS = float(os.environ.get("TWEET_CHANGES_PRUNE_SECONDS", 60 * 60))  # 0 to never prune
+READ_BATCH_SIZE = 5000
+
+def log_change(db: Session, tweet_id: int, operation: str, added_tags: Optional[Iterable[str]] = None) -> int:
+    """Add a change row for a tweet write, committed with it. Returns the change id"""
+    added_tags = " ".join(added_tags or ())
+    change = TweetChangeModel(tweet_id=tweet_id, operation=operation, added_tags=added_tags or None)
+    db.add(change)
+    db.flush()
+    return change.id
+
+def added_tags(change: Row) -> List[str]:
+    """Tags a change read from the log added"""
+    return change.added_tags.split() if change.added_tags else []
+
+def utc_now() -> datetime:
+    """Now in UTC without a timezone, like the stored timestamps"""
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+class ChangeCursor:
+    """Reads each tweet_changes row once, in id order, waiting for ids that commit late"""
+
+    def __init__(self, settle_seconds: float = TWEET_CHANGES_SETTLE_SECONDS):
+        self.settle_seconds = settle_seconds
+        self.lock = threading.Lock()
+        # Every change up to this id has been read, or never committed
+        self.last_id = 0
+        # Ids above last_id already read, waiting for a gap below them to fill
+        self.read_ids: Set[int] = set()
+        # Structure: {first missing id of a gap: time.monotonic() when it was noticed}
+        self.gaps: Dict[int, float] = {}
+
+    def reset(self, last_id: int) -> None:
+        with self.lock:
+            self.last_id = last_id
+            self.read_ids.clear()
+            self.gaps.clear()
+
+    def start_after(self, db: Session, since: datetime) -> None:
+        """Read from the first change at or after `since`, or only new changes if there is none"""
+        first_id = db.query(func.min(TweetChangeModel.id)).filter(TweetChangeModel.changed_at >= since).scalar()
+        if first_id is None:
+            first_id = latest_change_id(db) + 1
+        self.reset(first_id - 1)
+
+    def read(self, db: Session) -> List[Row]:
+        """Changes not read yet, in id order, with the columns of TweetChangeModel"""
+        with self.lock:
+            rows = []
+            after_id = self.last_id
+            while True:
+                batch = db.query(TweetChangeModel.id, TweetChangeModel.tweet_id, TweetChangeModel.operation, TweetChangeModel.added_tags, TweetChangeModel.changed_at)\
+                    .filter(TweetChangeModel.id > after_id)\
+                    .order_by(TweetChangeModel.id)\
+                    .limit(READ_BATCH_SIZE)\
+                    .all()
+                rows.extend(batch)
+                if len(batch) < READ_BATCH_SIZE:
+                    break
+                after_id = batch[-1].id
+            new_rows = [row for row in rows if row.id not in self.read_ids]
+            self.read_ids.update(row.id for row in new_rows)
+            self._advance(rows)
+            self.gaps = {gap: noticed for gap, noticed in self.gaps.items() if gap > self.last_id}
+            return new_rows
+
+    def _advance(self, rows) -> None:
+        """Move last_id over the rows read, up to the first gap that may still fill"""
+        now = time.monotonic()
+        settled_before = utc_now() - timedelta(seconds=self.settle_seconds)
+        for row in rows:
+            change_id, changed_at = row.id, row.changed_at
+            if change_id > self.last_id + 1:
+                gap = self.last_id + 1
+                noticed = self.gaps.setdefault(gap, now)
+                # A transaction holding a lower id for that long has rolled back, or its row was pruned
+                if now - noticed < self.settle_seconds and (changed_at is None or changed_at > settled_before):
+                    return
+                del self.gaps[gap]
+            self.last_id = change_id
+            self.read_ids.discard(change_id)
+
+    def get_stats(self) -> Dict[str, int]:
+        with self.lock:
+            return {"last_change_id": self.last_id, "waiting_gaps": len(self.gaps), "read_above_gaps": len(self.read_ids)}
+
+def latest_change_id(db: Session) -> int:
+    return db.query(func.max(TweetChangeModel.id)).scalar() or 0
+
+def prune_changes(db: Session, retention_seconds: float = TWEET_CHANGES_RETENTION_SECONDS) -> int:
+    """Delete changes older than the retention, returns how many"""
+    pruned = db.query(TweetChangeModel)\
+        .filter(TweetChangeModel.changed_at < utc_now() - timedelta(seconds=retention_seconds))\
+        .delete(synchronize_session=False)
+    db.commit()
+    return pruned
+
+def start_change_pruning(session_factory) -> None:
+    """Prune old changes every TWEET_CHANGES_PRUNE_SECONDS in the background"""
+    if TWEET_CHANGES_PRUNE_SECONDS > 0:
+        threading.Thread(target=_prune_changes, args=(session_factory,), daemon=True).start()
+
+def _prune_changes(session_factory) -> None:
+    while True:
+        db = session_factory()
+        try:
+            prune_changes(db)
+        except Exception as e:
+            print(f"Error pruning tweet changes: {str(e)}")
+        finally:
+            db.close()
+        time.sleep(TWEET_CHANGES_PRUNE_SECONDS)
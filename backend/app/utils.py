@@ -1,5 +1,5 @@
 #Utility functions for authentication
-from fastapi import Depends, HTTPException, status
+from fastapi import Depends, HTTPException, Response, status
 from fastapi.security import OAuth2PasswordBearer
 from sqlalchemy.orm import Session
 from jose import JWTError
@@ -33,6 +33,25 @@ def create_access_token(data: Dict[str, Any], expires_delta: timedelta = None) -
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
+#Declaring which cached data a response depends on (reads) or changes (writes)
+#The cache server uses these surrogate keys to purge only the affected entries
+def set_surrogate_keys(response: Response, *keys: str):
+    response.headers["Surrogate-Key"] = " ".join(keys)
+
+#Cache vary policy for GET routes, honored by RequestCacheMiddleware and the cache server
+#"public": the response is the same for every caller, so it is cached once and shared
+#"user": the response depends on the caller, so it is cached per Authorization header
+#Usage: @router.get("", dependencies=[Depends(cache_vary("public"))])
+def cache_vary(policy: str):
+    if policy not in ("public", "user"):
+        raise ValueError(f"Unknown cache vary policy: {policy}")
+
+    def set_cache_vary(response: Response):
+        response.headers["X-Cache-Vary"] = policy
+        if policy == "user":
+            response.headers["Vary"] = "Authorization"
+    return set_cache_vary
+
 #Function to get the current user ID 
 def get_current_user_id(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
     credentials_exception = HTTPException(
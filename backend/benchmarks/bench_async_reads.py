@@ -0,0 +1,136 @@
+"""
+Load benchmark for the sync and async read paths
+
+Runs the same tweet lookup as a sync route on a Session (the previous
+read_tweet, reproduced below) and as the current async route on an
+AsyncSession, with many requests in flight at once. Sync routes run in
+Starlette's threadpool, which has 40 threads, so at most 40 requests wait on
+the database at a time. Async routes wait on the event loop and are only
+limited by the connection pool.
+
+SQLite through aiosqlite stands in for Postgres. Every SELECT sleeps for
+DB_LATENCY_MS in the thread that runs it, to simulate a networked database.
+Both engines get a pool of POOL_SIZE connections, so the pool isn't the limit.
+
+    python benchmarks/bench_async_reads.py
+"""
+
+import asyncio
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import time
+import types
+from pathlib import Path
+
+import httpx
+from fastapi import Depends, FastAPI, Response
+from sqlalchemy import create_engine, event
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.orm import Session, sessionmaker
+
+#Make the app modules importable when run from anywhere
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "app"))
+DATABASE_FILE = os.path.join(tempfile.mkdtemp(), "bench_async_reads.db")
+sys.modules.setdefault("config", types.SimpleNamespace(SECRET_KEY="bench", ALGORITHM="HS256", DATABASE_URL=f"sqlite:///{DATABASE_FILE}"))
+
+from database import Base, SessionLocal, engine, get_async_db, get_db
+from models import TweetsModel, UserModel
+from routes import tweets
+from schemas import TweetResponse
+
+DB_LATENCY_MS = 50
+CONCURRENCY = [10, 40, 100, 200]
+#A sync request keeps its connection until its dependency is closed, which also needs a threadpool slot,
+#so the pool must cover every request in flight or the sync runs deadlock on pool timeouts
+POOL_SIZE = max(CONCURRENCY)
+REQUESTS = 400
+TWEETS = 200
+
+def simulate_latency(statement):
+    if statement.lstrip().upper().startswith("SELECT"):
+        time.sleep(DB_LATENCY_MS / 1000)
+
+#Previous sync route, as it was before the read routes moved to AsyncSession
+def read_tweet_sync(tweet_id: int, response: Response, db: Session = Depends(get_db)):
+    tweet = db.query(TweetsModel).filter(TweetsModel.id == tweet_id).first()
+    if tweet is None:
+        return {"error": "Tweet not found"}
+    return tweet
+
+def make_app() -> FastAPI:
+    url = engine.url.render_as_string(hide_password=False)
+    sync_engine = create_engine(url, pool_size=POOL_SIZE, max_overflow=0)
+    async_engine = create_async_engine(url.replace("sqlite://", "sqlite+aiosqlite://"), pool_size=POOL_SIZE, max_overflow=0)
+
+    @event.listens_for(sync_engine, "connect")
+    def on_sync_connect(dbapi_connection, connection_record):
+        dbapi_connection.set_trace_callback(simulate_latency)
+
+    #The callback runs on the aiosqlite connection's own thread, like a wait on the network
+    @event.listens_for(async_engine.sync_engine, "connect")
+    def on_async_connect(dbapi_connection, connection_record):
+        dbapi_connection.run_async(lambda connection: connection.set_trace_callback(simulate_latency))
+
+    sync_sessions = sessionmaker(bind=sync_engine)
+    async_sessions = async_sessionmaker(async_engine, expire_on_commit=False)
+
+    def bench_get_db():
+        db = sync_sessions()
+        try:
+            yield db
+        finally:
+            db.close()
+
+    async def bench_get_async_db():
+        async with async_sessions() as db:
+            yield db
+
+    app = FastAPI()
+    app.add_api_route("/sync/tweets/{tweet_id}", read_tweet_sync, methods=["GET"], response_model=TweetResponse)
+    app.add_api_route("/async/tweets/{tweet_id}", tweets.read_tweet, methods=["GET"], response_model=TweetResponse)
+    app.dependency_overrides[get_db] = bench_get_db
+    app.dependency_overrides[get_async_db] = bench_get_async_db
+    return app
+
+async def run(client: httpx.AsyncClient, path: str, concurrency: int) -> float:
+    """Requests per second with `concurrency` requests in flight"""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def request(index: int):
+        async with semaphore:
+            response = await client.get(f"{path}/{index % TWEETS + 1}")
+            assert response.status_code == 200, response.text
+
+    #Warm up the pool so opening connections isn't measured
+    await asyncio.gather(*(request(index) for index in range(concurrency)))
+    start = time.perf_counter()
+    await asyncio.gather(*(request(index) for index in range(REQUESTS)))
+    return REQUESTS / (time.perf_counter() - start)
+
+def seed():
+    Base.metadata.create_all(bind=engine)
+    db = SessionLocal()
+    db.add(UserModel(id=1, username="bench", hashed_password="x"))
+    db.add_all([TweetsModel(content=f"Tweet {i} #bench", owner_id=1, tags="#bench") for i in range(TWEETS)])
+    db.commit()
+    db.close()
+
+async def main():
+    seed()
+    app = make_app()
+    transport = httpx.ASGITransport(app=app)
+    print(f"{REQUESTS} requests per run, {DB_LATENCY_MS}ms simulated latency per SELECT, pool of {POOL_SIZE}")
+    print(f"Ideal throughput at full concurrency: {1000 / DB_LATENCY_MS:.0f} req/s per request in flight\n")
+    print(f"{'in flight':>9} {'sync req/s':>11} {'async req/s':>12} {'speedup':>8}")
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        for concurrency in CONCURRENCY:
+            with contextlib.redirect_stdout(io.StringIO()):
+                sync_rate = await run(client, "/sync/tweets", concurrency)
+                async_rate = await run(client, "/async/tweets", concurrency)
+            print(f"{concurrency:>9} {sync_rate:>11.0f} {async_rate:>12.0f} {async_rate / sync_rate:>7.1f}x")
+
+if __name__ == "__main__":
+    asyncio.run(main())
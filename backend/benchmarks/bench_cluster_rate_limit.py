@@ -0,0 +1,68 @@
+"""
+Simulation of cluster-wide rate limiting across backend replicas
+
+Three limiters stand in for python-backend-1..3 behind nginx round robin and
+receive one client's requests in turn. Per-replica limiters admit up to three
+times the limit, limiters sharing an InMemoryRateLimitStore admit the limit.
+Also reports how many store calls each batch size needs per request, and
+what RATE_LIMIT_MIN_BATCH does for a limit as small as tweet-writes (10).
+
+    python benchmarks/bench_cluster_rate_limit.py
+"""
+
+import asyncio
+import contextlib
+import io
+import sys
+from pathlib import Path
+
+#Make the app modules importable when run from anywhere
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "app"))
+
+from rate_limit import RateLimiter, SharedRateLimiter
+from rate_limit_store import InMemoryRateLimitStore
+
+REPLICAS = 3
+LIMIT = 100
+REQUESTS = 1000
+RULES = [{"name": "bench", "path_prefix": "/tweets", "methods": ("POST",), "limit": LIMIT, "window_seconds": 3600}]
+
+async def admitted(limiters) -> int:
+    """Send REQUESTS requests round robin over the limiters, return how many were allowed"""
+    allowed = 0
+    for i in range(REQUESTS):
+        limiter = limiters[i % len(limiters)]
+        result = await limiter.acquire("client", limiter.rules[0])
+        allowed += result.allowed
+    return allowed
+
+async def main():
+    print(f"{REPLICAS} replicas, limit {LIMIT} per window, {REQUESTS} requests from one client\n")
+
+    local = [RateLimiter(RULES) for _ in range(REPLICAS)]
+    print(f"Per-replica limiters:      {await admitted(local):5} admitted")
+
+    for batch_fraction in (0.01, 0.1, 0.25):
+        store = InMemoryRateLimitStore()
+        shared = [SharedRateLimiter(store, RULES, batch_fraction=batch_fraction) for _ in range(REPLICAS)]
+        with contextlib.redirect_stdout(io.StringIO()):
+            count = await admitted(shared)
+        print(
+            f"Shared store, batch {batch_fraction:<5}: {count:5} admitted, "
+            f"{store.calls} store calls ({store.calls / REQUESTS:.2f} per request)"
+        )
+
+    #The tweet-writes rule is small, RATE_LIMIT_MIN_BATCH keeps it batching
+    small_rules = [{**RULES[0], "limit": 10, "window_seconds": 60}]
+    for min_batch in (1, 3):
+        store = InMemoryRateLimitStore()
+        shared = [SharedRateLimiter(store, small_rules, min_batch=min_batch) for _ in range(REPLICAS)]
+        with contextlib.redirect_stdout(io.StringIO()):
+            allowed = 0
+            for i in range(10):
+                limiter = shared[i % REPLICAS]
+                allowed += (await limiter.acquire("client", limiter.rules[0])).allowed
+        print(f"Limit 10, min batch {min_batch}:     {allowed:5} of 10 admitted, {store.calls} store calls")
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,76 @@
+"""
+Benchmark for db_cache lookups
+
+Compares the cost of building a cache key the old way (compiling the statement
+with literal binds, stringifying it again for the SELECT check and hashing the
+SQL with MD5) with the structural key from SQLAlchemy's statement cache key,
+and puts both next to a cache hit and a real database round trip.
+
+Uses an in-memory SQLite database, a networked Postgres round trip costs more.
+
+    python benchmarks/bench_db_cache_lookup.py
+"""
+
+import contextlib
+import hashlib
+import io
+import sys
+import time
+import types
+from pathlib import Path
+
+#Make the app modules importable when run from anywhere
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "app"))
+sys.modules.setdefault("config", types.SimpleNamespace(SECRET_KEY="bench", ALGORITHM="HS256", DATABASE_URL="sqlite://"))
+
+import db_cache
+from database import Base, SessionLocal, engine, get_cached_query
+from models import TweetsModel, UserModel
+
+ITERATIONS = 5000
+
+def old_key(query) -> str:
+    """Previous key: literal-bind compilation plus MD5, after a stringified SELECT check"""
+    str(query.statement).strip().lower().startswith("select")
+    query_str = str(query.statement.compile(compile_kwargs={"literal_binds": True}))
+    return hashlib.md5(query_str.encode()).hexdigest()
+
+def measure(fn) -> float:
+    """Average microseconds per call"""
+    for _ in range(100):
+        fn()
+    start = time.perf_counter()
+    for _ in range(ITERATIONS):
+        fn()
+    return (time.perf_counter() - start) / ITERATIONS * 1e6
+
+def main():
+    Base.metadata.create_all(bind=engine)
+    db = SessionLocal()
+    db.add_all([UserModel(id=i, username=f"user{i}", hashed_password="x") for i in range(1, 51)])
+    db.add_all([TweetsModel(content=f"Tweet {i} #tag{i % 10}", owner_id=i % 50 + 1, tags=f"#tag{i % 10}") for i in range(1000)])
+    db.commit()
+
+    queries = {
+        "user by id": lambda: db.query(UserModel).filter(UserModel.id == 7),
+        "tweets by owner": lambda: db.query(TweetsModel).filter(TweetsModel.owner_id == 7).order_by(TweetsModel.created_at.desc()),
+        "username search": lambda: db.query(UserModel).filter(UserModel.username.ilike("%user1%")),
+    }
+
+    print(f"Average over {ITERATIONS} calls, in microseconds (query construction included)\n")
+    print(f"{'query':16} {'old key':>9} {'new key':>9} {'cache hit':>10} {'DB query':>9}")
+    with contextlib.redirect_stdout(io.StringIO()) as silenced:
+        rows = []
+        for name, build in queries.items():
+            old = measure(lambda: old_key(build()))
+            new = measure(lambda: db_cache.query_cache_key(build()))
+            get_cached_query(build()).all()
+            hit = measure(lambda: get_cached_query(build()).all())
+            uncached = measure(lambda: build().all())
+            rows.append((name, old, new, hit, uncached))
+    for name, old, new, hit, uncached in rows:
+        print(f"{name:16} {old:9.1f} {new:9.1f} {hit:10.1f} {uncached:9.1f}")
+    db.close()
+
+if __name__ == "__main__":
+    main()
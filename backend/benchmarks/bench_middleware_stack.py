@@ -0,0 +1,153 @@
+"""
+Benchmark for the backend middleware stack
+
+Compares the previous BaseHTTPMiddleware stack (rate limit, request cache and
+request log, reproduced below) with the current pure ASGI middleware, on a
+trivial endpoint so the numbers are the middleware overhead. Reports the time
+per request and requests per second for a cache hit, a cache miss and a POST.
+
+    python benchmarks/bench_middleware_stack.py
+"""
+
+import asyncio
+import contextlib
+import io
+import sys
+import time
+import types
+from collections import defaultdict
+from pathlib import Path
+
+import httpx
+from fastapi import FastAPI, Request, status
+from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.responses import Response
+
+#Make the app modules importable when run from anywhere
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "app"))
+#The middleware imports routes.logs, which needs a config module for the database url
+sys.modules.setdefault("config", types.SimpleNamespace(SECRET_KEY="bench", ALGORITHM="HS256", DATABASE_URL="sqlite://"))
+
+import middleware
+from middleware import RateLimitMiddleware, RequestCacheMiddleware, RequestLogMiddleware
+from rate_limit import RateLimiter
+
+REQUESTS = 2000
+
+#Logging itself is not what is being measured
+def log_api_call(**kwargs):
+    pass
+
+middleware.log_api_call = log_api_call
+
+#Previous implementation, kept here for comparison
+class LegacyRateLimitMiddleware(BaseHTTPMiddleware):
+    def __init__(self, app, max_requests: int = 10, window_seconds: int = 60):
+        super().__init__(app)
+        self.max_requests = max_requests
+        self.window_seconds = window_seconds
+        self.request_records = defaultdict(list)
+
+    async def dispatch(self, request: Request, call_next):
+        client_id = request.client.host
+        if request.url.path.startswith("/tweets") and request.method in ["POST", "PUT", "DELETE"]:
+            current_time = time.time()
+            self.request_records[client_id] = [
+                timestamp for timestamp in self.request_records[client_id]
+                if current_time - timestamp < self.window_seconds
+            ]
+            if len(self.request_records[client_id]) >= self.max_requests:
+                return Response(
+                    status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                    content=f"Rate limit exceeded. Try again in {self.window_seconds} seconds."
+                )
+            self.request_records[client_id].append(current_time)
+        return await call_next(request)
+
+class LegacyRequestCacheMiddleware(BaseHTTPMiddleware):
+    helper = RequestCacheMiddleware(None)
+
+    async def dispatch(self, request: Request, call_next):
+        if request.method != "GET":
+            return await call_next(request)
+        vary_policy = middleware.vary_policies.get(middleware.route_template(request.scope), middleware.DEFAULT_VARY_POLICY)
+        cache_key = self.helper._generate_cache_key(request.scope, request.headers, vary_policy)
+        cached_item = middleware.cache.get(cache_key)
+        if cached_item is not None:
+            response = self.helper._build_response(request.headers, cached_item.content, cached_item.variants, cached_item.status_code, cached_item.headers, cached_item.media_type)
+            response.headers["X-RequestCache-Status"] = "HIT"
+            return response
+        response = await call_next(request)
+        if 200 <= response.status_code < 300:
+            chunks = []
+            async for chunk in response.body_iterator:
+                chunks.append(chunk)
+            content = b"".join(chunks)
+            headers = {name: value for name, value in response.headers.items() if name not in ("content-length", "content-encoding")}
+            new_response = self.helper._build_response(request.headers, content, {}, response.status_code, headers, None)
+            middleware.cache.set(cache_key, content, response.status_code, headers, None, {})
+            new_response.headers["X-RequestCache-Status"] = "CACHED"
+            return new_response
+        return response
+
+def make_app(stack: str) -> FastAPI:
+    app = FastAPI()
+
+    @app.get("/tweets")
+    async def read_tweets(page: int = 0):
+        return [{"id": 1, "content": "hello"}]
+
+    @app.post("/tweets")
+    async def create_tweet():
+        return {"id": 1}
+
+    if stack == "legacy":
+        async def log_requests(request: Request, call_next):
+            start_time = time.time()
+            response = await call_next(request)
+            log_api_call(method=request.method, endpoint=request.url.path, status_code=response.status_code, execution_time=time.time() - start_time)
+            return response
+        app.middleware("http")(log_requests)
+        app.add_middleware(LegacyRateLimitMiddleware, max_requests=10 ** 9)
+        app.add_middleware(LegacyRequestCacheMiddleware)
+    elif stack == "asgi":
+        app.add_middleware(RequestLogMiddleware)
+        limiter = RateLimiter([{"name": "bench", "path_prefix": "/tweets", "methods": ("POST", "PUT", "DELETE"), "limit": 10 ** 9, "window_seconds": 60}])
+        app.add_middleware(RateLimitMiddleware, limiter=limiter)
+        app.add_middleware(RequestCacheMiddleware)
+    return app
+
+async def run(app, method: str, miss: bool) -> float:
+    middleware.cache.clear()
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        #Warm up, and fill the cache for the hit run
+        for _ in range(50):
+            await client.request(method, "/tweets")
+        start = time.perf_counter()
+        for i in range(REQUESTS):
+            #A different query string per request makes every GET a miss
+            response = await client.request(method, "/tweets", params={"page": i} if miss else None)
+        elapsed = time.perf_counter() - start
+        assert response.status_code == 200, response.status_code
+    return elapsed / REQUESTS
+
+async def main():
+    scenarios = [("GET hit", "GET", False), ("GET miss", "GET", True), ("POST", "POST", False)]
+    apps = {stack: make_app(stack) for stack in ("none", "legacy", "asgi")}
+
+    print(f"{REQUESTS} requests per run, times include the in-process HTTP client")
+    for name, method, miss in scenarios:
+        with contextlib.redirect_stdout(io.StringIO()):
+            timings = {stack: await run(app, method, miss) for stack, app in apps.items()}
+        baseline = timings["none"]
+        print(f"\n{name} (no middleware: {baseline * 1e6:.0f} us/req, a cache hit skips the endpoint)")
+        for stack in ("legacy", "asgi"):
+            per_request = timings[stack]
+            print(
+                f"  {stack:6}: {per_request * 1e6:7.0f} us/req {1 / per_request:7.0f} req/s"
+                f"  middleware overhead {(per_request - baseline) * 1e6:6.0f} us/req"
+            )
+
+if __name__ == "__main__":
+    asyncio.run(main())
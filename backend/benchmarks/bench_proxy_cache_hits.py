@@ -0,0 +1,84 @@
+"""
+Benchmark for cache_server hits
+
+Compares the old hit path (parsed JSON stored in the cache and re-encoded by FastAPI on
+every hit) with the current one (raw upstream bytes served as a plain Response).
+
+Run from backend/app so servers.json is found:
+    python ../benchmarks/bench_proxy_cache_hits.py
+"""
+
+import asyncio
+import json
+import sys
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import httpx
+from fastapi import FastAPI
+
+#Make the app modules importable when run from anywhere
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "app"))
+
+import cache_server
+
+TWEET_COUNT = 1000
+REQUESTS = 500
+
+def make_payload() -> bytes:
+    start = datetime(2025, 1, 1)
+    tweets = [
+        {
+            "id": i,
+            "content": f"Tweet number {i} with some #hashtag content to make it realistic",
+            "owner_id": i % 50,
+            "tags": "#hashtag",
+            "created_at": (start + timedelta(seconds=i)).isoformat(),
+            "username": f"user{i % 50}",
+        }
+        for i in range(TWEET_COUNT)
+    ]
+    return json.dumps(tweets).encode()
+
+async def run(app, path: str, headers=None) -> float:
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        #Warm up
+        for _ in range(20):
+            await client.get(path, headers=headers)
+        start = time.perf_counter()
+        for _ in range(REQUESTS):
+            response = await client.get(path, headers=headers)
+        elapsed = time.perf_counter() - start
+        assert response.status_code in (200, 304), response.status_code
+    return REQUESTS / elapsed
+
+async def main():
+    body = make_payload()
+
+    #Old behaviour: the parsed object is stored and returned through FastAPI's JSON encoding
+    old_app = FastAPI()
+    parsed = json.loads(body)
+
+    @old_app.get("/tweets")
+    async def old_hit():
+        return parsed
+
+    #New behaviour: the raw bytes are stored and replayed
+    upstream = httpx.Response(200, content=body, headers={"content-type": "application/json"})
+    cache_key = "GET:/tweets::noauth"
+    cache_server.store_cache_entry(cache_key, upstream, ["timeline"])
+    etag = cache_server.cache[cache_key]["etag"]
+
+    old_rps = await run(old_app, "/tweets")
+    new_rps = await run(cache_server.app, "/tweets")
+    not_modified_rps = await run(cache_server.app, "/tweets", headers={"If-None-Match": etag})
+
+    print(f"Payload: {TWEET_COUNT} tweets, {len(body) / 1024:.0f} KiB, {REQUESTS} hits per run")
+    print(f"Parsed object + JSON re-encoding: {old_rps:8.0f} req/s")
+    print(f"Raw bytes:                        {new_rps:8.0f} req/s ({new_rps / old_rps:.1f}x)")
+    print(f"If-None-Match (304):              {not_modified_rps:8.0f} req/s ({not_modified_rps / old_rps:.1f}x)")
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,126 @@
+"""
+Benchmark for tweet search
+
+Compares the previous search, a join filtered with content ILIKE '%q%' that
+returns every match, with the inverted index returning the newest 50 matches
+and fetching them by id. Also reports how long the index takes to build,
+save and load, and the size of its postings.
+
+Uses a SQLite file with TWEETS synthetic tweets (1M by default) drawn from a
+Zipf-like vocabulary, so there are common, rare and prefix-sharing words.
+Postgres would scan faster per row but still scans every row.
+
+    python benchmarks/bench_search_index.py [tweets]
+"""
+
+import contextlib
+import io
+import itertools
+import os
+import random
+import sys
+import tempfile
+import time
+import types
+from pathlib import Path
+
+#Make the app modules importable when run from anywhere
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "app"))
+WORK_DIR = tempfile.mkdtemp()
+sys.modules.setdefault("config", types.SimpleNamespace(SECRET_KEY="bench", ALGORITHM="HS256", DATABASE_URL=f"sqlite:///{os.path.join(WORK_DIR, 'bench_search.db')}"))
+
+from sqlalchemy import insert, select
+from database import Base, SessionLocal, engine
+from models import TweetsModel, UserModel
+from search_index import SearchIndex, matches
+
+TWEETS = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+VOCABULARY_SIZE = 20000
+LIMIT = 50
+RUNS = 5
+QUERIES = ["lorem", "quasar", "lo", "lorem ipsum", "quasar nebula", "zzzz"]
+
+def make_vocabulary():
+    random.seed(42)
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    words = ["lorem", "ipsum", "quasar", "nebula", "lorenzo", "lotus", "dolor", "python"]
+    while len(words) < VOCABULARY_SIZE:
+        words.append("".join(random.choice(letters) for _ in range(random.randint(3, 9))))
+    #Zipf-like weights, "lorem" and "ipsum" are common, "quasar" and "nebula" much rarer
+    weights = [1 / (rank + 1) for rank in range(len(words))]
+    weights[2] = weights[3] = weights[500]
+    return words, list(itertools.accumulate(weights))
+
+def seed():
+    Base.metadata.create_all(bind=engine)
+    words, cumulative_weights = make_vocabulary()
+    with engine.begin() as conn:
+        conn.execute(insert(UserModel), [{"id": 1, "username": "bench", "hashed_password": "x"}])
+        batch = []
+        for i in range(TWEETS):
+            content = " ".join(random.choices(words, cum_weights=cumulative_weights, k=random.randint(6, 14)))
+            if i % 7 == 0:
+                content += " #" + random.choice(words[:50])
+            batch.append({"content": content, "owner_id": 1})
+            if len(batch) == 10000:
+                conn.execute(insert(TweetsModel), batch)
+                batch = []
+        if batch:
+            conn.execute(insert(TweetsModel), batch)
+
+def timed(fn, runs: int = RUNS):
+    """Best time in milliseconds and the last result"""
+    best = float("inf")
+    result = None
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return best * 1000, result
+
+def ilike_search(db, query: str):
+    """Previous search: every tweet containing the text"""
+    statement = select(TweetsModel, UserModel.username)\
+        .join(UserModel, TweetsModel.owner_id == UserModel.id)\
+        .filter(TweetsModel.content.ilike(f"%{query}%"))
+    return db.execute(statement).all()
+
+def index_search(db, index: SearchIndex, query: str):
+    """Current search: newest matches from the index, then fetched by id"""
+    tweet_ids = index.search(query, LIMIT)
+    if not tweet_ids:
+        return []
+    statement = select(TweetsModel, UserModel.username)\
+        .join(UserModel, TweetsModel.owner_id == UserModel.id)\
+        .filter(TweetsModel.id.in_(tweet_ids))
+    found = {tweet.id: (tweet, username) for tweet, username in db.execute(statement).all() if matches(query, tweet.content)}
+    return [found[tweet_id] for tweet_id in tweet_ids if tweet_id in found]
+
+def main():
+    print(f"Seeding {TWEETS:,} tweets...")
+    start = time.perf_counter()
+    seed()
+    print(f"  {time.perf_counter() - start:.1f}s\n")
+
+    db = SessionLocal()
+    index = SearchIndex()
+    build_ms, _ = timed(lambda: index.rebuild(db), runs=1)
+    stats = index.get_stats()
+    path = os.path.join(WORK_DIR, "search.idx")
+    save_ms, _ = timed(lambda: index.save(path), runs=1)
+    load_ms, _ = timed(lambda: SearchIndex().load(path), runs=1)
+    print(f"Index: {stats['terms']:,} terms, {stats['postings']:,} postings ({stats['postings'] * 4 / 2**20:.1f} MiB of ids)")
+    print(f"  build {build_ms / 1000:.1f}s, save {save_ms:.0f}ms, load {load_ms:.0f}ms, file {os.path.getsize(path) / 2**20:.1f} MiB\n")
+
+    print(f"Best of {RUNS} runs, index returns the newest {LIMIT}")
+    print(f"{'query':16} {'ILIKE ms':>9} {'matches':>8} {'index ms':>9} {'returned':>9} {'speedup':>8}")
+    for query in QUERIES:
+        #The full scans are reported by the slow query log
+        with contextlib.redirect_stdout(io.StringIO()):
+            ilike_ms, ilike_rows = timed(lambda: ilike_search(db, query), runs=1 if TWEETS > 100000 else RUNS)
+            search_ms, rows = timed(lambda: index_search(db, index, query))
+        print(f"{query:16} {ilike_ms:>9.1f} {len(ilike_rows):>8} {search_ms:>9.2f} {len(rows):>9} {ilike_ms / search_ms:>7.0f}x")
+    db.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,23 @@
+"""
+Test setup for the YAPPER2 backend
+
+The app modules import each other by module name from backend/app, and read
+their settings from config.py, which isn't committed. The tests run against a
+SQLite file in a temporary directory, like the benchmarks.
+"""
+
+import os
+import sys
+import tempfile
+import types
+from pathlib import Path
+
+#Make the app modules importable when pytest runs from anywhere
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "app"))
+TEST_DIR = tempfile.mkdtemp()
+sys.modules.setdefault("config", types.SimpleNamespace(SECRET_KEY="test", ALGORITHM="HS256", DATABASE_URL=f"sqlite:///{os.path.join(TEST_DIR, 'test.db')}"))
+
+#Nothing reloads in the background during tests
+os.environ.setdefault("HOT_TIMELINE_REFRESH_SECONDS", "0")
+os.environ.setdefault("SEARCH_INDEX_REFRESH_SECONDS", "0")
+os.environ.setdefault("TRENDING_REFRESH_SECONDS", "0")
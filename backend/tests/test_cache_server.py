@@ -0,0 +1,318 @@
+import asyncio
+from pathlib import Path
+import httpx
+import pytest
+from starlette.requests import ClientDisconnect
+
+APP_DIR = Path(__file__).resolve().parent.parent / "app"
+
+@pytest.fixture
+def cache_server(monkeypatch):
+    """The cache server module with empty caches and fresh backends, it reads servers.json from the working directory"""
+    monkeypatch.chdir(APP_DIR)
+    import cache_server
+    for state in (cache_server.cache, cache_server.tag_index, cache_server.oversized_keys, cache_server.inflight_fetches, cache_server.vary_policies):
+        state.clear()
+    for counters in (cache_server.cache_counters, cache_server.coalescing_stats):
+        for name in counters:
+            counters[name] = 0
+    monkeypatch.setattr(cache_server, "load_balancer", cache_server.LoadBalancer(cache_server.servers))
+    return cache_server
+
+def use_upstream(cache_server, handler):
+    """Send every backend's requests to handler instead of over the network"""
+    for backend in cache_server.load_balancer.backends:
+        backend.client = httpx.AsyncClient(transport=httpx.MockTransport(handler), base_url=backend.url)
+
+class TrackedStream(httpx.AsyncByteStream):
+    """A response body of unknown length that remembers whether it was closed"""
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.closed = False
+
+    async def __aiter__(self):
+        for chunk in self.chunks:
+            yield chunk
+
+    async def aclose(self):
+        self.closed = True
+
+def json_response(body: bytes = b"[]", status_code: int = 200, headers=None) -> httpx.Response:
+    """An upstream JSON response, streamed like a real one so it can be read once"""
+    return httpx.Response(status_code, stream=TrackedStream([body]), headers={"content-type": "application/json", "content-length": str(len(body)), **(headers or {})})
+
+def test_cancelled_leader_closes_streamed_upstream(cache_server):
+    """A streamed response fetched for a leader whose client went away is closed, not left holding its connection"""
+    async def run():
+        released = asyncio.Event()
+        body = TrackedStream([b"x" * 1024] * 2048)
+
+        async def handler(request):
+            await released.wait()
+            return httpx.Response(200, stream=body, headers={"content-type": "application/json"})
+
+        use_upstream(cache_server, handler)
+        backend = cache_server.load_balancer.backends[0]
+
+        async def fetch():
+            return await cache_server.forward_request(backend, "GET", "/tweets", {}, b"", {})
+
+        leader = asyncio.create_task(cache_server.fetch_single_flight("GET:/tweets::noauth", fetch))
+        await asyncio.sleep(0)
+        leader.cancel()
+        released.set()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        while cache_server.inflight_fetches or cache_server.closing_upstreams:
+            await asyncio.sleep(0)
+
+        assert backend.in_flight == 0
+        assert body.closed
+
+    asyncio.run(run())
+
+async def get_all(cache_server, paths, headers=None):
+    """GET paths from the cache server concurrently"""
+    transport = httpx.ASGITransport(app=cache_server.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://proxy") as client:
+        return await asyncio.gather(*(client.get(path, headers=headers) for path in paths))
+
+def test_large_miss_is_streamed_to_leader_and_followers(cache_server, monkeypatch):
+    """A body over MAX_CACHEABLE_BODY_BYTES is never stored, and every coalesced request gets all of it"""
+    monkeypatch.setattr(cache_server, "MAX_CACHEABLE_BODY_BYTES", 1000)
+    bodies = []
+
+    async def handler(request):
+        await asyncio.sleep(0.01)
+        bodies.append(TrackedStream([b"[" + b"1," * 1000 + b"1]"]))
+        return httpx.Response(200, stream=bodies[-1], headers={"content-type": "application/json"})
+
+    use_upstream(cache_server, handler)
+    responses = asyncio.run(get_all(cache_server, ["/tweets"] * 5))
+
+    assert all(response.status_code == 200 and len(response.content) == 2003 for response in responses)
+    assert [response.headers["X-Proxy-Cache-Status"] for response in responses].count("MISS") == 1
+    assert not cache_server.cache
+    assert "GET:/tweets::noauth" in cache_server.oversized_keys
+    assert all(body.closed for body in bodies)
+    assert all(backend.in_flight == 0 for backend in cache_server.load_balancer.backends)
+
+def test_streamed_upstream_closed_when_client_leaves_before_first_chunk(cache_server):
+    """The body generator never starts when sending the headers fails, the upstream is closed anyway"""
+    body = TrackedStream([b"[]"])
+
+    async def handler(request):
+        return httpx.Response(200, stream=body)
+
+    async def run():
+        use_upstream(cache_server, handler)
+        backend = cache_server.load_balancer.backends[0]
+        upstream = await cache_server.forward_request(backend, "GET", "/tweets", {}, b"", {})
+
+        async def send(message):
+            raise OSError("client disconnected")
+
+        scope = {"type": "http", "asgi": {"spec_version": "2.4"}}
+        with pytest.raises(ClientDisconnect):
+            await upstream.to_response("MISS")(scope, None, send)
+        return backend
+
+    backend = asyncio.run(run())
+    assert body.closed
+    assert backend.in_flight == 0
+
+def test_client_appended_to_forwarded_for(cache_server):
+    """The backends read X-Forwarded-For right to left, so the cache server adds the client it saw"""
+    seen = []
+
+    async def handler(request):
+        seen.append(request.headers["x-forwarded-for"])
+        return json_response()
+
+    use_upstream(cache_server, handler)
+    asyncio.run(get_all(cache_server, ["/tweets", "/tweets/1/like"], headers={"X-Forwarded-For": "6.6.6.6"}))
+    assert seen == ["6.6.6.6, 127.0.0.1"] * 2
+
+def test_vary_policy_learned_once_per_route(cache_server):
+    """A policy declared by one tweet's response applies to every tweet id, keyed by its DB_READ_PATHS pattern"""
+    async def handler(request):
+        return json_response(b"{}", headers={"X-Cache-Vary": "public"})
+
+    use_upstream(cache_server, handler)
+    asyncio.run(get_all(cache_server, ["/tweets/1", "/tweets/2"], headers={"Authorization": "Bearer a"}))
+
+    assert cache_server.vary_policies == {r"^/tweets/\d+$": "public"}
+    assert cache_server.get_vary_policy("/tweets/999") == "public"
+    assert cache_server.get_vary_policy("/users/1") == "user"
+
+def cache_entry(cache_server, key: str, body: bytes, age: float, tags):
+    """Put an entry of the given age in the cache, as a fetch that long ago would have"""
+    cache_server.store_cache_entry(key, httpx.Response(200, content=body, headers={"content-type": "application/json"}), tags)
+    cache_server.cache[key]["timestamp"] -= age
+
+def test_concurrent_misses_share_one_fetch(cache_server):
+    calls = []
+
+    async def handler(request):
+        calls.append(request.url.path)
+        await asyncio.sleep(0.05)
+        return json_response(b"[1]")
+
+    use_upstream(cache_server, handler)
+    responses = asyncio.run(get_all(cache_server, ["/tweets"] * 5))
+
+    assert calls == ["/tweets"]
+    assert all(response.json() == [1] for response in responses)
+    assert sorted(response.headers["X-Proxy-Cache-Status"] for response in responses) == ["COALESCED"] * 4 + ["MISS"]
+    assert cache_server.coalescing_stats["leader_fetches"] == 1
+    assert cache_server.coalescing_stats["coalesced_requests"] == 4
+
+def test_followers_retry_once_when_the_shared_fetch_fails(cache_server):
+    """The leader reports its error, the followers start one new shared fetch between them"""
+    calls = []
+
+    async def handler(request):
+        calls.append(request.url.path)
+        await asyncio.sleep(0.05)
+        if len(calls) == 1:
+            raise httpx.ConnectError("backend down")
+        return json_response(b"[1]")
+
+    use_upstream(cache_server, handler)
+    responses = asyncio.run(get_all(cache_server, ["/tweets"] * 3))
+
+    assert len(calls) == 2
+    assert sorted(response.status_code for response in responses) == [200, 200, 500]
+    assert cache_server.coalescing_stats["leader_failures"] == 2
+
+def test_follower_fetches_on_its_own_when_the_shared_fetch_is_stuck(cache_server, monkeypatch):
+    monkeypatch.setattr(cache_server, "COALESCE_WAIT_TIMEOUT", 0.01)
+    calls = []
+
+    async def handler(request):
+        calls.append(request.url.path)
+        if len(calls) == 1:
+            await asyncio.sleep(0.2)
+        return json_response(b"[1]")
+
+    use_upstream(cache_server, handler)
+    responses = asyncio.run(get_all(cache_server, ["/tweets"] * 2))
+
+    assert len(calls) == 2
+    assert all(response.json() == [1] for response in responses)
+    assert cache_server.coalescing_stats["follower_timeouts"] == 1
+
+def test_stale_entry_served_while_one_refresh_runs(cache_server):
+    calls = []
+
+    async def handler(request):
+        calls.append(request.url.path)
+        return json_response(b"[2]")
+
+    async def run():
+        first = (await get_all(cache_server, ["/tweets"] * 3))
+        while cache_server.inflight_fetches:
+            await asyncio.sleep(0.01)
+        return first, (await get_all(cache_server, ["/tweets"]))[0]
+
+    use_upstream(cache_server, handler)
+    #Past the expiry, inside the 30s stale-while-revalidate window of /tweets
+    cache_entry(cache_server, "GET:/tweets::noauth", b"[1]", cache_server.CACHE_EXPIRATION + 10, ["timeline"])
+    stale, refreshed = asyncio.run(run())
+
+    assert all(response.json() == [1] and response.headers["X-Cache-Status"] == "STALE" for response in stale)
+    assert calls == ["/tweets"]
+    assert cache_server.cache_counters["revalidations"] == 1
+    assert refreshed.json() == [2]
+    assert refreshed.headers["X-Cache-Status"] == "HIT"
+
+@pytest.mark.parametrize("failure", ["status", "exception"])
+def test_stale_entry_served_when_the_backend_fails(cache_server, failure):
+    async def handler(request):
+        if failure == "exception":
+            raise httpx.ConnectError("backend down")
+        return json_response(b'{"error": "boom"}', status_code=500)
+
+    use_upstream(cache_server, handler)
+    #Too old to serve without asking, inside the 600s stale-if-error window of /tweets
+    cache_entry(cache_server, "GET:/tweets::noauth", b"[1]", cache_server.CACHE_EXPIRATION + 100, ["timeline"])
+    (response,) = asyncio.run(get_all(cache_server, ["/tweets"]))
+
+    assert response.status_code == 200
+    assert response.json() == [1]
+    assert response.headers["X-Cache-Status"] == "STALE_IF_ERROR"
+    assert cache_server.cache_counters["stale_if_error_hits"] == 1
+
+def test_writes_purge_entries_by_surrogate_key(cache_server):
+    """A write purges the keys its path maps to before forwarding, and the keys the backend declares after"""
+    async def handler(request):
+        if request.method == "POST" and request.url.path == "/likes/7":
+            return json_response(b"{}", headers={"Surrogate-Key": "user:1"})
+        return json_response()
+
+    use_upstream(cache_server, handler)
+    cache_entry(cache_server, "GET:/tweets::noauth", b"[1]", 0, ["timeline"])
+    cache_entry(cache_server, "GET:/users/1::noauth", b"{}", 0, ["user:1"])
+    cache_entry(cache_server, "GET:/likes/7::noauth", b"[]", 0, ["likes:7"])
+
+    async def post(path):
+        transport = httpx.ASGITransport(app=cache_server.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://proxy") as client:
+            return await client.post(path)
+
+    asyncio.run(post("/likes/7"))
+    assert set(cache_server.cache) == {"GET:/tweets::noauth"}
+
+    asyncio.run(post("/tweets"))
+    assert not cache_server.cache
+
+def make_balancer(cache_server, strategy: str, weights=(1, 1, 1)):
+    return cache_server.LoadBalancer([{"url": f"http://backend-{i}:8000", "weight": weight} for i, weight in enumerate(weights)], strategy)
+
+def test_round_robin_strategies(cache_server):
+    balancer = make_balancer(cache_server, "round_robin")
+    picks = [balancer.choose().url for _ in range(6)]
+    assert sorted(picks) == sorted([backend.url for backend in balancer.backends] * 2)
+
+    balancer = make_balancer(cache_server, "weighted_round_robin", (3, 1))
+    picks = [balancer.choose().url for _ in range(8)]
+    assert picks.count("http://backend-0:8000") == 6
+    #Smooth: the light backend isn't starved until the end of the cycle
+    assert "http://backend-1:8000" in picks[:4]
+
+def test_load_aware_strategies(cache_server):
+    balancer = make_balancer(cache_server, "least_outstanding", (1, 1, 2))
+    for backend, in_flight in zip(balancer.backends, (2, 3, 2)):
+        backend.in_flight = in_flight
+    #The weight 2 backend counts as half as busy
+    assert balancer.choose() is balancer.backends[2]
+
+    balancer = make_balancer(cache_server, "p2c_ewma", (1, 1))
+    fast, slow = balancer.backends
+    fast.ewma_latency, slow.ewma_latency = 0.01, 0.5
+    assert all(balancer.choose() is fast for _ in range(20))
+
+def test_failing_backend_is_ejected_then_slowly_ramped_back(cache_server, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cache_server.time, "time", lambda: now[0])
+    balancer = make_balancer(cache_server, "round_robin")
+    broken = balancer.backends[0]
+
+    for _ in range(cache_server.LB_EJECT_AFTER_FAILURES):
+        broken.start_request()
+        broken.finish_request(0.01, False)
+    assert broken.is_ejected(now[0])
+    assert broken not in balancer.available_backends()
+    assert all(balancer.choose() is not broken for _ in range(10))
+
+    #Every backend ejected: panic mode tries them all rather than failing every request
+    for backend in balancer.backends[1:]:
+        backend.ejected_until = now[0] + 60
+    assert balancer.available_backends() == balancer.backends
+
+    #Back after the ejection, at a fraction of its weight until the slow start window has passed
+    now[0] = broken.ejected_until + cache_server.LB_SLOW_START_SECONDS / 2
+    assert not broken.is_ejected(now[0])
+    assert broken.effective_weight(now[0]) == pytest.approx(broken.weight / 2)
+    now[0] = broken.ejected_until + cache_server.LB_SLOW_START_SECONDS
+    assert broken.effective_weight(now[0]) == broken.weight
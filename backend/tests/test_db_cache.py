@@ -0,0 +1,48 @@
+import pytest
+from sqlalchemy.orm import defer
+import db_cache
+from database import Base, engine, SessionLocal, get_cached_query
+from models import UserModel
+
+def setup_module():
+    Base.metadata.create_all(bind=engine)
+    db_cache.clear_cache()
+
+def test_entry_depends_on_its_tables_when_shapes_are_reset():
+    """Resetting the shape memo between building the key and storing the entry keeps its dependencies"""
+    db = SessionLocal()
+    try:
+        query = db.query(UserModel).filter(UserModel.username == "shape-reset")
+        query_key, info = db_cache.query_cache_key_info(query)
+        db_cache.statement_shapes.clear()
+        tables, row = db_cache.query_dependencies(query_key, info)
+        assert tables == frozenset({"users"})
+        assert row is None
+
+        assert get_cached_query(db.query(UserModel).filter(UserModel.username == "shape-reset")).all() == []
+        db_cache.statement_shapes.clear()
+        db.add(UserModel(username="shape-reset", hashed_password="x"))
+        db.commit()
+        users = get_cached_query(db.query(UserModel).filter(UserModel.username == "shape-reset")).all()
+        assert [user.username for user in users] == ["shape-reset"]
+    finally:
+        db.close()
+
+def test_partially_loaded_instances_are_not_cached():
+    """A snapshot would turn deferred columns into None, so such results are returned uncached"""
+    db = SessionLocal()
+    try:
+        db.add(UserModel(username="deferred", hashed_password="secret"))
+        db.commit()
+        query = db.query(UserModel).options(defer(UserModel.hashed_password)).filter(UserModel.username == "deferred")
+        user = query.first()
+        assert "hashed_password" in db_cache.inspect(user).unloaded
+        with pytest.raises(db_cache.PartiallyLoaded):
+            db_cache.snapshot(user)
+        key = ("deferred-test", ())
+        result = db_cache.store_in_cache(key, [user], frozenset({"users"}))
+        assert result == [user]
+        assert db_cache.get_from_cache(key) == (False, None)
+        assert result[0].hashed_password == "secret"
+    finally:
+        db.close()
@@ -0,0 +1,107 @@
+from datetime import datetime
+import pytest
+from fastapi import FastAPI, HTTPException
+from fastapi.testclient import TestClient
+from database import Base, engine, SessionLocal
+from hot_timeline import HotTimeline
+from models import TweetsModel, UserModel
+from pagination import TIMELINE_MAX_PAGE_SIZE, TIMELINE_PAGE_SIZE, decode_cursor, decode_id_cursor, encode_cursor, encode_id_cursor, page_size
+from routes import tweets
+
+def setup_module():
+    Base.metadata.create_all(bind=engine)
+    db = SessionLocal()
+    try:
+        if db.get(UserModel, 1) is None:
+            db.add(UserModel(id=1, username="paging", hashed_password="x"))
+        #Tweets sharing a created_at are ordered by id, so a page boundary inside them can't repeat or skip one
+        db.add_all([TweetsModel(content=f"same second {i}", owner_id=1, created_at=datetime(2030, 1, 1)) for i in range(5)])
+        db.add_all([TweetsModel(content=f"later {i}", owner_id=1, created_at=datetime(2030, 1, 1, 0, 0, i + 1)) for i in range(3)])
+        db.commit()
+    finally:
+        db.close()
+
+def timeline_ids():
+    """Every tweet on the timeline in its order, straight from the database"""
+    db = SessionLocal()
+    try:
+        rows = db.query(TweetsModel.id).join(UserModel, TweetsModel.owner_id == UserModel.id)\
+            .order_by(TweetsModel.created_at.desc(), TweetsModel.id.desc()).all()
+        return [id for (id,) in rows]
+    finally:
+        db.close()
+
+def walk_timeline(limit: int):
+    """Follow X-Next-Cursor from the first page to the last, returning the tweet ids in order"""
+    app = FastAPI()
+    app.include_router(tweets.router)
+    client = TestClient(app)
+    ids, url = [], f"/tweets?limit={limit}"
+    while True:
+        response = client.get(url)
+        assert response.status_code == 200
+        page = [tweet["id"] for tweet in response.json()]
+        assert len(page) <= limit
+        ids += page
+        cursor = response.headers.get("X-Next-Cursor")
+        if cursor is None:
+            return ids
+        assert response.headers["Link"] == f'</tweets?cursor={cursor}&limit={limit}>; rel="next"'
+        url = f"/tweets?limit={limit}&cursor={cursor}"
+
+def test_cursors_round_trip_and_reject_anything_else():
+    position = (datetime(2030, 1, 1, 12, 30), 42)
+    assert decode_cursor(encode_cursor(*position)) == position
+    assert decode_id_cursor(encode_id_cursor(42)) == 42
+    for cursor in ("garbage", encode_id_cursor(42)):
+        with pytest.raises(HTTPException) as error:
+            decode_cursor(cursor)
+        assert error.value.status_code == 400
+
+    assert page_size(None) == TIMELINE_PAGE_SIZE
+    assert page_size(0) == TIMELINE_PAGE_SIZE
+    assert page_size(10 ** 6) == TIMELINE_MAX_PAGE_SIZE
+
+def test_database_pages_cover_the_timeline_once(monkeypatch):
+    #An unloaded hot timeline sends every page to the database
+    monkeypatch.setattr(tweets, "hot_timeline", HotTimeline())
+    assert walk_timeline(3) == timeline_ids()
+
+def test_hot_timeline_pages_match_the_database(monkeypatch):
+    """Pages inside the window come from memory, the ones reaching past it from the database, in one order"""
+    hot = HotTimeline(size=4)
+    db = SessionLocal()
+    try:
+        hot.load(db)
+    finally:
+        db.close()
+    monkeypatch.setattr(tweets, "hot_timeline", hot)
+
+    assert walk_timeline(3) == timeline_ids()
+    assert hot.stats["hits"] >= 1
+    assert hot.stats["misses"] >= 1
+
+def test_hot_timeline_follows_writes():
+    hot = HotTimeline(size=4)
+    db = SessionLocal()
+    try:
+        hot.load(db)
+        newest = TweetsModel(content="newest", owner_id=1, created_at=datetime(2031, 1, 1))
+        db.add(newest)
+        db.commit()
+        hot.add(newest, "paging")
+        page, has_more = hot.page(None, 2)
+        assert [tweet["id"] for tweet in page] == timeline_ids()[:2]
+        assert page[0]["id"] == newest.id
+        assert has_more
+
+        newest.content = "edited"
+        hot.update(newest, "paging")
+        assert hot.page(None, 1)[0][0]["content"] == "edited"
+
+        hot.remove(newest)
+        db.delete(newest)
+        db.commit()
+        assert newest.id not in [tweet["id"] for tweet in hot.page(None, 2)[0]]
+    finally:
+        db.close()
@@ -0,0 +1,59 @@
+import asyncio
+import ipaddress
+import rate_limit
+from rate_limit import RateLimiter, SharedRateLimiter, client_address
+from rate_limit_store import InMemoryRateLimitStore, RateLimitStore
+
+NGINX = [ipaddress.ip_network("172.28.0.10")]
+
+def test_forwarding_headers_only_believed_from_trusted_proxies():
+    """A direct client on a published port arrives from the docker gateway and can't pick its own key"""
+    assert client_address("172.28.0.1", "1.2.3.4", "1.2.3.4", NGINX) == "172.28.0.1"
+    assert client_address("172.28.0.10", "1.2.3.4", "1.2.3.4", NGINX) == "1.2.3.4"
+    #Entries a client sent ahead of the proxy's own are skipped
+    assert client_address("172.28.0.10", "6.6.6.6, 1.2.3.4", None, NGINX) == "1.2.3.4"
+    assert client_address("172.28.0.10", None, None, NGINX) == "172.28.0.10"
+
+RULES = [{"name": "writes", "path_prefix": "/tweets", "methods": ("POST",), "limit": 3, "window_seconds": 60}]
+
+def test_token_bucket_rejects_past_the_limit_and_refills(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(rate_limit.time, "monotonic", lambda: now[0])
+    limiter = RateLimiter(RULES)
+    rule = limiter.match("/tweets", "POST")
+    assert limiter.match("/tweets", "GET") is None
+
+    assert [limiter.hit("client", rule).allowed for _ in range(4)] == [True, True, True, False]
+    rejected = limiter.hit("client", rule)
+    #One token refills every 20 seconds
+    assert rejected.headers()["Retry-After"] == "20"
+    assert rejected.headers()["X-RateLimit-Remaining"] == "0"
+    assert limiter.hit("other", rule).allowed
+
+    now[0] += 20
+    assert limiter.hit("client", rule).allowed
+    assert not limiter.hit("client", rule).allowed
+
+def test_replicas_sharing_a_store_admit_the_limit_once():
+    store = InMemoryRateLimitStore()
+    replicas = [SharedRateLimiter(store, RULES, batch_fraction=0.1, min_batch=1) for _ in range(3)]
+
+    async def send(count):
+        allowed = 0
+        for i in range(count):
+            limiter = replicas[i % len(replicas)]
+            allowed += (await limiter.acquire("client", limiter.rules[0])).allowed
+        return allowed
+
+    assert asyncio.run(send(12)) == 3
+
+class BrokenStore(RateLimitStore):
+    async def take(self, key, limit, window_seconds, requested):
+        raise ConnectionError("store down")
+
+def test_replica_falls_back_to_its_own_limit_when_the_store_fails():
+    limiter = SharedRateLimiter(BrokenStore(), RULES)
+    rule = limiter.rules[0]
+    results = [asyncio.run(limiter.acquire("client", rule)).allowed for _ in range(4)]
+    assert results == [True, True, True, False]
+    assert limiter.stats["store_errors"] == 4
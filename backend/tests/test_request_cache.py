@@ -0,0 +1,49 @@
+from fastapi import Depends, FastAPI, Response
+from fastapi.testclient import TestClient
+from middleware import RequestCacheMiddleware, RequestLogMiddleware, cache, vary_policies
+from utils import cache_vary, set_surrogate_keys
+
+def test_hit_does_not_replay_per_request_headers():
+    """A cached entry is stored without the origin's Server-Timing and Surrogate-Key, hits time themselves"""
+    app = FastAPI()
+
+    @app.get("/cached")
+    def cached(response: Response):
+        set_surrogate_keys(response, "timeline")
+        return {"ok": True}
+
+    app.add_middleware(RequestLogMiddleware)
+    app.add_middleware(RequestCacheMiddleware)
+    cache.clear()
+    client = TestClient(app)
+
+    first = client.get("/cached")
+    assert first.headers["X-RequestCache-Status"] == "CACHED"
+    assert first.headers["Surrogate-Key"] == "timeline"
+    assert "db-query" in first.headers["Server-Timing"]
+
+    hit = client.get("/cached")
+    assert hit.headers["X-RequestCache-Status"] == "HIT"
+    assert hit.json() == {"ok": True}
+    assert "Surrogate-Key" not in hit.headers
+    assert hit.headers.get_list("Server-Timing") == [hit.headers["Server-Timing"]]
+    assert hit.headers["Server-Timing"].startswith("request-cache;desc=hit;dur=")
+
+def test_vary_policy_learned_once_per_route():
+    """Every id of a route shares the policy its first response declared, and the map stays one entry per route"""
+    app = FastAPI()
+
+    @app.get("/items/{item_id}", dependencies=[Depends(cache_vary("public"))])
+    def item(item_id: int):
+        return {"id": item_id}
+
+    app.add_middleware(RequestCacheMiddleware)
+    cache.clear()
+    vary_policies.clear()
+    client = TestClient(app)
+
+    for item_id in range(1, 4):
+        assert client.get(f"/items/{item_id}", headers={"Authorization": "Bearer a"}).headers["X-RequestCache-Status"] == "CACHED"
+    assert vary_policies == {"/items/{item_id}": "public"}
+    #Public entries are shared, another caller hits them
+    assert client.get("/items/2", headers={"Authorization": "Bearer b"}).headers["X-RequestCache-Status"] == "HIT"
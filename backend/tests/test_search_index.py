@@ -0,0 +1,69 @@
+from database import Base, engine, SessionLocal
+from models import TweetsModel, TweetChangeModel, UserModel
+from search_index import SearchIndex
+from tweet_changes import log_change
+
+def setup_module():
+    Base.metadata.create_all(bind=engine)
+
+def create_tweet(db, content: str) -> TweetsModel:
+    """What POST /tweets does on the replica that handles it"""
+    tweet = TweetsModel(content=content, owner_id=1)
+    db.add(tweet)
+    db.flush()
+    log_change(db, tweet.id, "create")
+    db.commit()
+    return tweet
+
+def test_replica_picks_up_creates_and_edits_from_another_replica():
+    db = SessionLocal()
+    try:
+        if db.get(UserModel, 1) is None:
+            db.add(UserModel(id=1, username="replicas", hashed_password="x"))
+            db.commit()
+        replica_a, replica_b = SearchIndex(), SearchIndex()
+        replica_a.rebuild(db)
+        replica_b.rebuild(db)
+
+        # Created on replica A
+        tweet = create_tweet(db, "first draft about quokkas")
+        replica_a.add(tweet.id, tweet.content)
+        replica_b.catch_up(db)
+        assert replica_b.search("quokkas", 10) == [tweet.id]
+
+        # An old tweet edited on replica A
+        tweet.content = "second draft about wombats"
+        log_change(db, tweet.id, "update")
+        db.commit()
+        replica_a.update(tweet.id, "first draft about quokkas", tweet.content)
+        replica_b.catch_up(db)
+        assert replica_b.search("wombats", 10) == [tweet.id]
+        assert replica_a.search("wombats", 10) == [tweet.id]
+    finally:
+        db.close()
+
+def test_replica_picks_up_changes_committed_out_of_id_order():
+    db = SessionLocal()
+    try:
+        replica = SearchIndex()
+        replica.rebuild(db)
+        early = TweetsModel(content="committed late axolotl", owner_id=1)
+        late = TweetsModel(content="committed early pangolin", owner_id=1)
+        db.add_all([early, late])
+        db.commit()
+
+        # The transaction with the higher change id commits first
+        next_id = (db.query(TweetChangeModel.id).order_by(TweetChangeModel.id.desc()).limit(1).scalar() or 0) + 1
+        db.add(TweetChangeModel(id=next_id + 1, tweet_id=late.id, operation="create"))
+        db.commit()
+        replica.catch_up(db)
+        assert replica.search("pangolin", 10) == [late.id]
+        assert replica.changes.last_id == next_id - 1
+
+        db.add(TweetChangeModel(id=next_id, tweet_id=early.id, operation="create"))
+        db.commit()
+        replica.catch_up(db)
+        assert replica.search("axolotl", 10) == [early.id]
+        assert replica.changes.last_id == next_id + 1
+    finally:
+        db.close()
@@ -0,0 +1,27 @@
+import asyncio
+from sqlalchemy import select
+from database import Base, engine, AsyncSessionLocal
+from models import UserModel
+from slow_query_log import slow_query_log
+
+def test_slow_async_read_captures_plan():
+    """A slow statement from the async engine is explained with its own driver's SQL and parameters"""
+    Base.metadata.create_all(bind=engine)
+    slow_query_log.clear()
+    threshold_ms = slow_query_log.threshold_ms
+    slow_query_log.threshold_ms = 0  #Every statement is slow
+    try:
+        async def read():
+            async with AsyncSessionLocal() as db:
+                return (await db.scalars(select(UserModel).filter(UserModel.username == "nobody"))).all()
+        assert asyncio.run(read()) == []
+        #Wait for the background EXPLAIN, the executor has a single worker
+        slow_query_log._get_executor().submit(lambda: None).result(timeout=10)
+    finally:
+        slow_query_log.threshold_ms = threshold_ms
+
+    entries = slow_query_log.get_entries()["entries"]
+    entry = next(entry for entry in entries if "FROM users" in entry["statement"])
+    assert entry["explain"]["error"] is None
+    assert entry["explain"]["driver"] == "aiosqlite"
+    assert entry["explain"]["plan"]
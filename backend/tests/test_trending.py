@@ -0,0 +1,56 @@
+from datetime import timedelta
+from database import Base, engine, SessionLocal
+from models import TweetChangeModel, TweetsModel
+from trending import Trending
+from tweet_changes import log_change, utc_now
+
+def setup_module():
+    Base.metadata.create_all(bind=engine)
+
+def counts(trending: Trending, window: str = "1h"):
+    return {entry["tag"]: entry["count"] for entry in trending.top(window, 100)}
+
+def test_tags_added_on_any_replica_are_counted_once():
+    db = SessionLocal()
+    try:
+        writer, reader = Trending(), Trending()
+        for trending in (writer, reader):
+            trending.track_counted = True
+            trending.rebuild(db)
+
+        # POST /tweets on the writer
+        tweet = TweetsModel(content="#Capybara news", owner_id=1)
+        db.add(tweet)
+        db.flush()
+        change_id = log_change(db, tweet.id, "create", ["capybara"])
+        db.commit()
+        writer.record(change_id, ["capybara"])
+
+        # PUT /tweets/{id} on the writer, adding a tag and keeping one
+        tweet.content = "#capybara #tapir news"
+        change_id = log_change(db, tweet.id, "update", ["tapir"])
+        db.commit()
+        writer.record(change_id, ["tapir"])
+
+        for trending in (writer, reader):
+            trending.catch_up(db)
+            assert counts(trending)["capybara"] == 1
+            assert counts(trending)["tapir"] == 1
+    finally:
+        db.close()
+
+def test_rebuild_counts_the_last_day_of_changes():
+    db = SessionLocal()
+    try:
+        db.add_all([
+            TweetChangeModel(tweet_id=1, operation="create", added_tags="okapi", changed_at=utc_now() - timedelta(hours=30)),
+            TweetChangeModel(tweet_id=2, operation="create", added_tags="okapi narwhal", changed_at=utc_now() - timedelta(hours=2)),
+        ])
+        db.commit()
+        trending = Trending()
+        trending.rebuild(db)
+        assert counts(trending, "24h")["okapi"] == 1
+        assert counts(trending, "24h")["narwhal"] == 1
+        assert "narwhal" not in counts(trending, "1h")
+    finally:
+        db.close()